@@ -4,324 +4,245 @@ import json
 import base64
 import requests
 import re
+import time
+import os
+import functools
+import hashlib
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as futures_wait
+
+import azure_cache
+import azure_http
+import backlog_index
+import classification
+import generation
+import image_prep
+import push_journal
+import scheduler
+import telemetry
+from generation import ResultCache, generation_cache_key
 
 st.set_page_config(page_title="Generador de PBIs", page_icon="📋", layout="wide")
 
-SYSTEM_PROMPT = """Eres un experto en Product Management que genera Product Backlog Items (PBIs) completos y precisos para Azure DevOps.
-Tu audiencia son desarrolladores y QA que deben poder implementar y testear sin necesidad de preguntar al PM.
-El PBI es la fuente de verdad. Cada línea que escribas debe poder leerse de forma independiente y ser verificable.
+# ========== TELEMETRY ==========
 
----
+@st.cache_resource(show_spinner=False)
+def get_telemetry():
+    return telemetry.TelemetryStore(st.secrets.get("TELEMETRY_PATH", os.path.join(".cache", "telemetry.jsonl")))
 
-## EL INPUT DEL USUARIO PUEDE SER
 
-- Texto breve e informal: estructura y completa la información.
-- Descripción larga de una feature: propón la división óptima en PBIs.
-- Capturas de pantalla o prototipo: analízalas exhaustivamente antes de escribir.
+@st.cache_resource(show_spinner=False)
+def _metrics_server(port):
+    """Prometheus scrape endpoint at :port/metrics, started once per process."""
+    return telemetry.start_metrics_server(get_telemetry(), port)
 
----
 
-## FASE 1 — ANALIZAR EL PROTOTIPO (si hay capturas)
+def timed_op(op):
+    """Decorator recording latency and success of every call as a telemetry `op`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with get_telemetry().timed(op):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
 
-Antes de escribir el PBI, analiza cada captura:
 
-1. Identifica todos los elementos visuales: títulos, etiquetas, placeholders, botones, chips, banners.
-2. Copia los textos literales exactos. No parafrasees.
-3. Clasifica cada control: tipo Soul, opciones disponibles, valor por defecto, si es obligatorio.
-4. Identifica comportamientos condicionales: qué aparece, desaparece o cambia al interactuar.
-5. Identifica banners y mensajes de error: tipo (info/warning/error) y condición de aparición.
-6. Detecta estados especiales: vacío, deshabilitado, solo lectura.
-7. Lo que no puedes ver: si hay estados que las capturas no cubren, márcalo con [⚠️ A CONFIRMAR] en tech_notes. NUNCA lo inventes.
+if st.secrets.get("METRICS_PORT"):
+    _metrics_server(int(st.secrets["METRICS_PORT"]))
 
----
-
-## FASE 2 — DETECTAR DISCREPANCIAS
-
-Si hay descripción y capturas, compara y señala:
-- Contradicciones: la descripción contradice el prototipo.
-- Omisiones: elementos del prototipo no mencionados en la descripción.
-- Errores tipográficos: corrígelos en el PBI.
-Refleja el resultado en el campo "summary".
-
----
-
-## REGLAS DE DIVISIÓN EN PBIs
-
-- Un cambio puntual o flujo simple = 1 PBI.
-- Divide solo cuando hay flujos claramente independientes con valor entregable por separado.
-- Justifica la decisión en "summary".
-
----
-
-## HISTORIA DE USUARIO
-
-La historia describe una necesidad de negocio, no una pantalla ni una acción de UI.
-
-- "role": uno de los tres perfiles exactos de Endalia: Colaborador | Responsable | perfil RRHH. Si el PBI afecta a más de un perfil con experiencias distintas, debe dividirse en PBIs separados.
-- "when": contexto de negocio o momento del proceso. NO la ruta de navegación ni el nombre de la pantalla.
-- "then": resultado de negocio que el usuario obtiene. NO la descripción de la UI ni de los pasos.
-- "benefit": valor real para el usuario o la organización.
-
-Ejemplos de lo que NO debe aparecer en "then":
-❌ "puedo hacer clic en 'Añadir absentismos' y se abre un modal con checkboxes"
-✅ "puedo configurar qué tipos de absentismo aplican a cada política y bajo qué condiciones"
-
----
-
-## ESPECIFICACIÓN FUNCIONAL
-
-La functional_spec es la fuente de verdad para el desarrollador. Debe estar estructurada por zonas de pantalla, con encabezados claros. No es un párrafo continuo.
-
-### Estructura obligatoria:
+# ========== AZURE DEVOPS ==========
 
-Usa este patrón de encabezados en texto plano:
+@st.cache_resource(show_spinner=False)
+def _azure_pools():
+    """Every pooled Azure client of this process, for the connection stats."""
+    return []
 
-[ZONA O COMPONENTE]
-  - Elemento, comportamiento o regla concreta
 
-Ejemplo:
-ÁREA PRINCIPAL
-  - Título de sección: 'Tipos de absentismo'
-  - Botón 'Añadir absentismos' (accent, tamaño M), esquina superior derecha, siempre visible
-  - Texto de ayuda '* Campos obligatorios', esquina superior derecha
+@st.cache_resource(show_spinner=False)
+def _azure_pool(org, pat, pool_size):
+    """
+    Long-lived HTTP layer for one (org, PAT): a keep-alive, throttle-aware
+    session for the REST helpers and one SDK Connection, whose clients are
+    created once.
+    """
+    from azure.devops.connection import Connection
+    from msrest.authentication import BasicAuthentication
+    from requests.adapters import HTTPAdapter
 
-ESTADO VACÍO (sin tipos añadidos)
-  - Se muestra solo el título y el botón 'Añadir absentismos'
-  - No hay mensaje de estado vacío adicional
+    def _on_event(kind, **fields):
+        get_telemetry().append(dict(fields, op=f"azure_{kind}", org=org))
 
-### Reglas de contenido:
+    session = azure_http.ThrottledSession(
+        max_wait=float(st.secrets.get("AZURE_MAX_THROTTLE_WAIT", 30)),
+        failure_threshold=int(st.secrets.get("AZURE_CIRCUIT_FAILURES", 5)),
+        cooldown=float(st.secrets.get("AZURE_CIRCUIT_COOLDOWN", 60)),
+        on_event=_on_event)
+    session.auth = ("", pat)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    pool = {"session": session, "adapter": adapter, "requests": 0,
+            "connection": Connection(base_url=f"https://dev.azure.com/{org}", creds=BasicAuthentication("", pat))}
 
-- Textos literales siempre entre comillas dobles: "Añadir absentismos"
-- Nombres de campos y secciones entre comillas simples: 'Cantidad máxima'
-- Componentes Soul: usa SIEMPRE el nombre exacto del diccionario. No inventes variantes.
-- Comportamientos condicionales: especifica la condición exacta y el resultado exacto.
-- NO describas comportamientos estándar de Soul que el equipo ya conoce: hover, focus, disabled genérico, animaciones. Solo describe lo específico de esta feature.
-- NO incluyas comportamientos que no estén confirmados en el prototipo o la descripción. Si no estás seguro, usa [⚠️ A CONFIRMAR] en lugar de asumir.
-- NO describas implementación técnica (clases CSS, nombres de servicios, estructura de datos).
-- NO uses datos de ejemplo del prototipo como valores reales salvo que sean valores por defecto intencionales.
+    def _count(response, *args, **kwargs):
+        pool["requests"] += 1
 
----
+    session.hooks["response"].append(_count)
+    _azure_pools().append(pool)
+    return pool
 
-## DESIGN SYSTEM SOUL — COMPONENTES WEB
 
-Usa SIEMPRE los nombres exactos. No inventes componentes ni comportamientos que no estén aquí.
+def azure_pool(org=None, pat=None):
+    return _azure_pool(org or get_org(),
+                       pat or st.session_state.get("user_pat") or st.secrets.get("AZURE_PAT", ""),
+                       int(st.secrets.get("AZURE_POOL_SIZE", 10)))
 
-### FEEDBACK
 
-**Alert** — banner informativo inline, NO flotante
-- Tipos: info (azul) | warning (amarillo) | error (rojo). NO existe success en Alert.
-- Una sola línea de texto. Uso: mensajes contextuales dentro de pantalla.
-- Nomenclatura: "banner Alert de tipo info/warning/error"
+def azure_session(pat, org):
+    """Shared keep-alive session for REST calls to this org with this PAT."""
+    return azure_pool(org, pat)["session"]
 
-**Toast** — notificación flotante temporal, esquina de pantalla
-- Subtipos: Toast Informative (solo lectura) | Toast Interactive (con link de acción)
-- Tipos: success | warning | error | info
-- Uso: confirmaciones de acciones (guardar, eliminar). NO para validaciones de formulario.
 
-**Chip Feedback** — etiqueta de estado, no interactiva
-- Tipos: success | info | warning | error | neutral
-- Nomenclatura: "chip de estado [tipo]"
+def get_azure_connection():
+    return azure_pool()["connection"]
+
+
+def get_wit_client():
+    """Work item client of the pooled connection, keeping its HTTP session open between calls."""
+    wit_client = get_azure_connection().clients.get_work_item_tracking_client()
+    wit_client.config.keep_alive = True
+    return wit_client
+
+
+def azure_pool_status():
+    """Requests sent through the pooled sessions, TCP connections they had to open and throttling."""
+    status = {"clients": 0, "requests": 0, "new_connections": 0, "reused": 0,
+              "throttled": 0, "delayed_s": 0.0, "short_circuited": 0, "open_circuits": 0}
+    for pool in list(_azure_pools()):
+        status["clients"] += 1
+        status["requests"] += pool["requests"]
+        throttle = pool["session"].stats()
+        status["throttled"] += throttle["throttled"]
+        status["delayed_s"] += throttle["delayed_s"]
+        status["short_circuited"] += throttle["short_circuited"]
+        status["open_circuits"] += throttle["circuit"] != "closed"
+        try:
+            pools = pool["adapter"].poolmanager.pools
+            status["new_connections"] += sum(pools[key].num_connections for key in pools.keys())
+        except Exception:
+            pass
+    status["reused"] = max(0, status["requests"] - status["new_connections"])
+    return status
 
-**Tooltip** — texto informativo al hover.
 
-### INPUTS DE FORMULARIO
+def azure_degraded():
+    """True while Azure DevOps is throttling or failing for the current org/PAT."""
+    return azure_pool()["session"].circuit != "closed"
 
-**Text Field Simple**
-- Errores: SOLO al salir del campo (on blur). NUNCA al cargar la pantalla.
-- Mensaje error campo vacío obligatorio: "Campo obligatorio"
-- Opciones: icono ⓘ en label, sufijo de texto, asterisco (*) en obligatorios
 
-**Input Suffix** — Text Field Simple con sufijo fijo (ej: "días", "%")
+def _azure_cache_path():
+    return st.secrets.get("AZURE_CACHE_PATH", os.path.join(".cache", "azure.sqlite3"))
 
-**Select** — dropdown selección única.
-- Errores: solo al interactuar, igual que Text Field Simple.
-- Si solo hay una opción disponible: NO mostrar Select, mostrar directamente el contenido.
 
-**Switch Button Input** — toggle on/off
-- NO tiene estado error rojo. Puede mostrar mensaje informativo (azul) o alerta (amarillo).
+@st.cache_resource(show_spinner=False)
+def get_metadata_cache():
+    return azure_cache.MetadataCache(_azure_cache_path(), workers=int(st.secrets.get("AZURE_METADATA_WORKERS", 4)))
 
-**Checkbox Input** — selección múltiple.
-**Radio Button Input** — selección única. Siempre una opción seleccionada por defecto. No permite deseleccionar.
 
-**Reglas globales de formularios Endalia:**
-- Errores de campo: únicamente on blur, nunca al cargar
-- Botón Guardar/Continuar: deshabilitado mientras haya campos obligatorios vacíos o con error visible
-- No se puede avanzar en wizard hasta que todos los campos obligatorios estén correctos
+@st.cache_resource(show_spinner=False)
+def get_http_cache():
+    return azure_cache.HttpCache(_azure_cache_path())
 
-### CONTENEDORES
 
-**Collapsable Container**
-- Header clickable con chevron (▶ cerrado / ▼ abierto)
-- Estado por defecto: EXPANDIDO salvo que se especifique lo contrario
-- Nomenclatura: "sección colapsable '[Nombre]', expandida/colapsada por defecto"
+def _pat_scope(pat):
+    """Stands in for the PAT in persisted cache keys."""
+    return azure_cache.content_hash(pat.encode("utf-8"))[:16]
 
-**Modal Dialog** — 3 tamaños: pequeño (confirmación) | mediano (formulario) | grande (lateral)
-- Siempre: título + botón cierre (×) + footer con "Cancelar" (secundario) + acción primaria (accent)
-- Botón primario deshabilitado si hay campos obligatorios sin completar
-- NO cierra al hacer clic fuera — solo con botón × o botones del footer
 
-**Assistant Stepper** — wizard de pasos en Endalia
-- Pasos: completado (✓) | activo | pendiente
-- Errores de validación: se detectan SOLO al pulsar "Siguiente"
-- Retroceder sin lógica interna: vuelve sin modal. Con lógica interna creada: modal de confirmación.
-- Siempre termina en pantalla de resumen antes de ejecutar el proceso.
+@st.cache_resource(show_spinner=False)
+def get_single_flight():
+    """Collapses identical concurrent fetches (Azure access checks) across sessions."""
+    return azure_cache.SingleFlight()
 
-### BOTONES
 
-**Text & Icon Button / Text Button**
-- Variantes: accent (azul sólido) | accent outline | variant (neutro) | danger (rojo) | danger outline | success | success outline
-- Tamaños: M (por defecto) | S
+# How long a PAT that could read a project is trusted before it is checked again
+AZURE_ACCESS_TTL = 900
+# Answers that mean the PAT cannot read the project
+AZURE_ACCESS_DENIED = (401, 403, 404)
 
-**Link Button** — texto con estilo enlace, sin fondo. Uso: expandir secciones, acciones secundarias.
 
-**Chip Interactive Select** — chip seleccionable/deseleccionable (una selección).
-**Chip Interactive Multiselect** — igual, permite múltiple selección simultánea.
+@st.cache_resource(show_spinner=False)
+def _access_grants():
+    """(PAT scope, org, project) → time until which the PAT is known to read the project."""
+    return {}
 
-### VISUALIZACIÓN
 
-**Data Display** — campo de solo lectura con label
-- Estructura: icono + Label + valor + subtítulo opcional + acción opcional (botón S)
-- Nunca usar botón de acción y help text a la vez.
+def verify_azure_access(pat, org, project):
+    """
+    One cheap GET per PAT and project every AZURE_ACCESS_TTL seconds, so the
+    metadata itself can be cached per organization and shared by every user.
+    If Azure cannot be reached, a PAT that was granted access before keeps it.
+    """
+    grants = _access_grants()
+    key = (_pat_scope(pat), org.lower(), project.lower())
+    if grants.get(key, 0) > time.time():
+        return True
 
----
+    def check():
+        url = f"https://dev.azure.com/{org}/_apis/projects/{requests.utils.quote(project)}?api-version=7.1"
+        return azure_session(pat, org).get(url, timeout=10).status_code
 
-## GLOSARIO DE DOMINIO — TERMINOLOGÍA ENDALIA HR
+    try:
+        status = get_single_flight().do(("access",) + key, check)
+    except Exception:
+        return key in grants
+    if status == 200:
+        grants[key] = time.time() + AZURE_ACCESS_TTL
+        return True
+    if status in AZURE_ACCESS_DENIED:
+        grants.pop(key, None)
+        return False
+    # Throttled or failing (429, 5xx): no answer either way, keep what we knew
+    return key in grants
+
+
+def azure_get(pat, org, url, timeout=10):
+    """
+    GET through the pooled session, revalidating against the last stored body.
+    Bodies are shared per organization: callers check access with verify_azure_access.
+    """
+    return get_http_cache().get(azure_session(pat, org), url, org.lower(), timeout)
 
-Usa SIEMPRE los términos exactos. Nunca los sustituyas por sinónimos genéricos.
 
-### REGISTRO Y PLANIFICACIÓN HORARIA
+def azure_metadata(ttl):
+    """
+    Like st.cache_data(ttl=...), shared by every session and persisted to disk,
+    but an expired value is served while the background worker refreshes it.
+    The decorated function must take (pat, org, project) as its first arguments.
+    Values are cached per organization, not per PAT: a caller whose PAT cannot
+    read the project gets [] instead, and concurrent misses share one fetch.
+    """
+    def decorator(fn):
+        def key(pat, org, project, *args, **kwargs):
+            return json.dumps([fn.__name__, org.lower(), project.lower(), args, sorted(kwargs.items())],
+                              ensure_ascii=False)
 
-**Tramo** — Unidad mínima de planificación y/o registro. NO usar: "franja", "bloque", "período de tiempo".
-**Jornada** — Conjunto de registros de un empleado en un día. Estados: No iniciada | Iniciada | Finalizada | Validada | Cerrada. NO usar: "turno del día".
-**Horario** — Planificación constante (semanal o cíclica). Puede ser flexible, cíclico o alternativo. NO usar: "agenda".
-**Turno** — Unidad mínima de planificación para empleados gestionados por turnos. NO usar: "rotación".
-**Patrón de turnos** — Agrupación de turnos para planificación variable. NO usar: "ciclo de turnos".
-**Planificación** — Resultado de asignar horarios o turnos a un empleado. NO usar: "programación".
-**Registro** — Acción de añadir un tramo al sistema. NO usar en especificación técnica: "fichar".
-**Política de registro** — Configuración de modalidad, interfaces y restricciones para un colectivo.
-**Hora especial** — Planificación adicional al horario ordinario. NO usar: "hora extra" como genérico.
-**Compensación** — Proceso por el que una hora especial validada pasa a bolsa o nómina.
-**Compensaciones especiales** — Modalidad mensual. Fases: Apertura → Edición → Revisión → Cerrada.
-**Control horario** — Sección manager con subsecciones: Registro horario | Incidencias | Solicitudes | Compensaciones.
-**Incidencia** — Alerta automática por discrepancias entre planificación y registro.
-**Balance horario** — Vista tiempo trabajado vs. planificado. Granularidad: semanal | mensual | trimestral | por periodo.
-
-### VACACIONES Y AUSENCIAS
-
-**Absentismo / Tipo de absentismo** — Categoría de ausencia o permiso. NO usar: "tipo de vacación" como genérico.
-**Periodo** — (módulo V&A legacy) Configuración temporal de vacaciones.
-**Política de vacaciones y ausencias** — Configuración de comportamiento de absentismos para un colectivo.
-**Saldo** — Días u horas disponibles. Puede mostrarse como: Disponibles | Solicitado | Validado.
-**Bolsa de horas compensadas** — Saldo generado por compensaciones de horas especiales.
-
-### ESTRUCTURA GENERAL
-
-**Colaborador** — Perfil básico. Accede al menú "Yo".
-**Responsable / Manager** — Perfil con acceso a "Mi equipo".
-**RRHH** — Perfil administrativo con acceso a "Compañía".
-**Yo / Mi equipo / Compañía** — Las tres secciones del menú. NO usar: "sección personal", "sección admin".
-**Colectivo** — Agrupación de empleados para permisos o flujos de aprobación.
-**Flujo de aprobación** — Circuito de validación. Puede tener 0, 1 o 2 aprobaciones.
-
-### TÉRMINOS PROHIBIDOS
-
-| Evitar | Usar en su lugar |
-|---|---|
-| "franja horaria" | "tramo" |
-| "turno del día" | "jornada" o "turno" |
-| "horas extras" (genérico) | "horas especiales" |
-| "fichar" (en especificación) | "registrar" |
-| "admin" | "perfil RRHH" |
-| "panel de administración" | "apartado Compañía" |
-| "agenda" | "planificación" o "horario" |
-| "ciclo de turnos" | "patrón de turnos" |
-
----
-
-## CRITERIOS DE ACEPTACIÓN
-
-Tres grupos. Sin prefijos, sin códigos. Cada línea es una afirmación verificable con sí/no.
-Formato: acción o condición concreta → resultado exacto y observable.
-
-Reglas:
-- Una sola cosa por línea. Si necesitas "y" para unir dos resultados, son dos líneas.
-- Máximo 8 criterios por grupo. Si hay más, el PBI probablemente debe dividirse.
-- Solo incluye criterios verificables sin ambigüedad. Si no sabes el resultado exacto, es una nota técnica, no un criterio.
-- happy_path: flujo principal sin errores, paso a paso desde la acción hasta el resultado.
-- validations: condiciones de borde y validaciones de campo.
-- error_states: fallos del sistema, errores de carga, errores de guardado.
-
-Ejemplo de criterio correcto:
-✅ "Al hacer clic en 'Añadir' con al menos un tipo seleccionado → el modal se cierra y se crea un acordeón expandido para cada tipo"
-
-Ejemplo de criterio incorrecto:
-❌ "El sistema maneja correctamente los errores de validación"
-❌ "El modal funciona según lo especificado"
-
----
-
-## NOTAS TÉCNICAS
-
-Solo preguntas genuinas sin respuesta que bloquean o condicionan el desarrollo.
-Si no hay preguntas reales, devuelve el array vacío [].
-NO incluyas observaciones, resúmenes de lo desarrollado ni aclaraciones que ya están en la spec.
-
-Formato: pregunta directa y accionable.
-✅ "¿El valor por defecto de 'Cantidad máxima' se carga desde el tipo de absentismo base vía API o se configura manualmente en el wizard?"
-❌ "Hay que tener en cuenta los estados de error"
-
----
-
-## REGLAS GENERALES
-
-- La descripción es la fuente de la intención de negocio. Si indica que algo no debe desarrollarse aunque esté en el prototipo, omítelo.
-- No mezcles estado actual con estado objetivo.
-- Si el prototipo muestra un único estado y hay estados alternativos relevantes no cubiertos, márcalo en tech_notes.
-- Corrige errores tipográficos de la descripción o el prototipo en el PBI.
-
----
-
-RESPONDE SOLO JSON válido sin backticks ni markdown:
-{
-  "summary": "Justificación de la división (si hay más de 1 PBI) y análisis de discrepancias detectadas. Vacío si no aplica.",
-  "pbis": [{
-    "title": "Módulo - Feature - US X.X - Verbo + objeto concreto",
-    "objective": "Qué se consigue con este PBI en una frase. Orientado a negocio, no a UI.",
-    "role": "Colaborador | Responsable | perfil RRHH",
-    "when": "Contexto de negocio o momento del proceso, no ruta de navegación",
-    "then": "Resultado de negocio obtenido, no descripción de la UI",
-    "benefit": "Valor real para el usuario o la organización",
-    "functional_spec": "Especificación estructurada por zonas con encabezados en mayúsculas y listas con guión. Sin párrafos densos.",
-    "happy_path": [
-      "Acción concreta → resultado observable y verificable"
-    ],
-    "validations": [
-      "Condición de borde o validación → resultado exacto"
-    ],
-    "error_states": [
-      "Causa del error → comportamiento del sistema"
-    ],
-    "prototype_refs": [
-      "(Captura N) Descripción de lo que muestra la captura con textos literales"
-    ],
-    "dependencies": [],
-    "tech_notes": [
-      "Pregunta concreta y accionable para desarrollo o diseño"
-    ]
-  }]
-}
-"""
+        @functools.wraps(fn)
+        def wrapper(pat, org, project, *args, **kwargs):
+            if not verify_azure_access(pat, org, project):
+                return []
+            return get_metadata_cache().get(key(pat, org, project, *args, **kwargs),
+                                            lambda: fn(pat, org, project, *args, **kwargs), ttl)
 
+        def prefetch(pat, org, project, *args, **kwargs):
+            get_metadata_cache().prefetch(key(pat, org, project, *args, **kwargs),
+                                          lambda: fn(pat, org, project, *args, **kwargs), ttl)
 
-# ========== AZURE DEVOPS ==========
+        wrapper.prefetch = prefetch
+        return wrapper
+    return decorator
 
-def get_azure_connection():
-    from azure.devops.connection import Connection
-    from msrest.authentication import BasicAuthentication
-    pat = st.session_state.get("user_pat") or st.secrets.get("AZURE_PAT", "")
-    org = st.session_state.get("user_org") or st.secrets.get("AZURE_ORG", "")
-    credentials = BasicAuthentication("", pat)
-    return Connection(base_url=f"https://dev.azure.com/{org}", creds=credentials)
 
 def get_org():
     return st.session_state.get("user_org") or st.secrets.get("AZURE_ORG", "")
@@ -329,7 +250,7 @@ def get_org():
 def get_project():
     return st.session_state.get("user_project") or st.secrets.get("AZURE_PROJECT", "")
 
-@st.cache_data(show_spinner=False, ttl=60)
+@azure_metadata(ttl=60)
 def fetch_iterations(pat, org, project, team="CoreProduct1"):
     """Fetch sprint iterations under PRODUCT from Azure DevOps team settings."""
     try:
@@ -337,7 +258,7 @@ def fetch_iterations(pat, org, project, team="CoreProduct1"):
         for team_name in [team, f"{team} Team"]:
             team_enc = requests.utils.quote(team_name)
             url = f"https://dev.azure.com/{org}/{project}/{team_enc}/_apis/work/teamsettings/iterations?api-version=7.1"
-            resp = requests.get(url, auth=("", pat), timeout=10)
+            resp = azure_get(pat, org, url)
             if resp.status_code == 200:
                 iterations = resp.json().get("value", [])
                 result = []
@@ -361,39 +282,62 @@ def fetch_iterations(pat, org, project, team="CoreProduct1"):
     except Exception:
         return []
 
-@st.cache_data(show_spinner=False, ttl=300)
-def fetch_area_paths(pat, org, project):
-    """Fetch only SWArea\\Product\\Core\\CoreProductN paths."""
+# Levels indexed under each classification root for Area / Iteration Path autocomplete
+CLASSIFICATION_INDEX_DEPTH = 4
+
+
+@azure_metadata(ttl=300)
+def fetch_classification_paths(pat, org, project, group, path="", depth=1):
+    """
+    Paths of the `group` ("areas" or "iterations") subtree at `path`, at most
+    `depth` levels below it. Only that subtree is downloaded.
+    """
     try:
-        url = f"https://dev.azure.com/{org}/{project}/_apis/wit/classificationnodes/areas?$depth=10&api-version=7.1"
-        resp = requests.get(url, auth=("", pat), timeout=10)
+        node_url = "/".join(requests.utils.quote(s) for s in path.replace("\\", "/").split("/") if s)
+        url = (f"https://dev.azure.com/{org}/{project}/_apis/wit/classificationnodes/{group}"
+               f"{'/' + node_url if node_url else ''}?$depth={depth}&api-version=7.1")
+        resp = azure_get(pat, org, url)
         if resp.status_code != 200:
             return []
+        return classification.flatten(resp.json())
+    except Exception:
+        return []
 
-        def find_node(node, name):
-            if node.get("name") == name:
-                return node
-            for child in node.get("children", []):
-                result = find_node(child, name)
-                if result:
-                    return result
-            return None
 
-        root = resp.json()
-        # Navigate: root -> SWArea -> Product -> Core -> CoreProductN
-        swarea = find_node(root, "SWArea") or root
-        product = find_node(swarea, "Product")
-        core = find_node(product, "Core") if product else None
-        if core:
-            paths = []
-            for child in core.get("children", []):
-                name = child.get("name", "")
-                if re.match(r"CoreProduct\d+$", name):
-                    paths.append(f"SWArea\\Product\\Core\\{name}")
-            return sorted(paths)
-        return []
-    except Exception:
+@functools.lru_cache(maxsize=16)
+def _path_trie(paths):
+    return classification.PathTrie(paths)
+
+
+def get_path_trie(pat, org, project, group):
+    """Trie of the first CLASSIFICATION_INDEX_DEPTH levels of area or iteration paths."""
+    return _path_trie(tuple(fetch_classification_paths(pat, org, project, group, depth=CLASSIFICATION_INDEX_DEPTH)))
+
+
+def path_suggestions(group, value, limit=6):
+    """Known paths completing `value`; empty when value already is a known path."""
+    pat = st.session_state.get("user_pat") or st.secrets.get("AZURE_PAT", "")
+    trie = get_path_trie(pat, get_org(), get_project(), group)
+    if not value or not len(trie) or value in trie:
         return []
+    return trie.complete(value, limit)
+
+
+def render_path_suggestions(group, value):
+    suggestions = path_suggestions(group, value)
+    if suggestions:
+        st.caption("¿Quisiste decir? " + " · ".join(f"`{s}`" for s in suggestions))
+
+
+@azure_metadata(ttl=300)
+def fetch_area_paths(pat, org, project):
+    """Fetch only SWArea\\Product\\Core\\CoreProductN paths."""
+    # Product\Core directly under the project root, or under a nested SWArea node
+    for subtree in ("Product/Core", "SWArea/Product/Core"):
+        paths = fetch_classification_paths(pat, org, project, "areas", subtree, depth=1)
+        if paths:
+            return sorted(p for p in paths[1:] if re.match(r"CoreProduct\d+$", p.split("\\")[-1]))
+    return []
 
 def fetch_modules(pat, org, project):
     """Return known Endalia Module values."""
@@ -429,71 +373,162 @@ def fetch_modules(pat, org, project):
         "Vacaciones y ausencias",
     ]
 
-@st.cache_data(show_spinner=False, ttl=300)
-def fetch_sprint_members(pat, org, project, team, iteration_path):
-    """Fetch capacity members. Uses current sprint if iteration_path matches, else searches all."""
+# How long a team-name variant that returned 404 is not asked for again
+TEAM_MISS_TTL = 3600
+
+
+@st.cache_resource(show_spinner=False)
+def _team_index():
+    """
+    Process-wide memo of team-name → canonical team and
+    (team, iteration path) → iteration id, plus the name variants known not to exist.
+    """
+    return {"teams": {}, "iterations": {}, "missing": {}, "lock": threading.Lock()}
+
+
+def _team_variants(team):
+    variants = [team, f"{team} Team", team.replace(" Team", "")]
+    return list(dict.fromkeys(v for v in variants if v))
+
+
+def resolve_team(pat, org, project, team):
+    """Canonical name of `team`, trying its name variants concurrently. None if none exists."""
+    index = _team_index()
+    key = (org.lower(), project.lower(), team)
+    if key in index["teams"]:
+        return index["teams"][key]
+    now = time.time()
+    with index["lock"]:
+        variants = [v for v in _team_variants(team)
+                    if index["missing"].get((org.lower(), project.lower(), v), 0) < now]
+    session = azure_session(pat, org)
+
+    def lookup(variant):
+        url = f"https://dev.azure.com/{org}/_apis/projects/{project}/teams/{requests.utils.quote(variant)}?api-version=7.1"
+        return variant, session.get(url, timeout=10)
+
+    canonical = None
+    with ThreadPoolExecutor(max_workers=max(1, len(variants))) as pool:
+        # Results come back in variant order, so the preferred spelling wins
+        for variant, resp in pool.map(lookup, variants):
+            if resp.status_code == 200 and canonical is None:
+                canonical = resp.json().get("name", variant)
+            elif resp.status_code == 404:
+                with index["lock"]:
+                    index["missing"][(org.lower(), project.lower(), variant)] = now + TEAM_MISS_TTL
+    if canonical:
+        index["teams"][key] = canonical
+    return canonical
+
+
+def resolve_iteration(pat, org, project, team, iteration_path):
+    """Id of the team iteration matching iteration_path (full path or sprint name). None if not found."""
+    index = _team_index()
+    key = (org.lower(), project.lower(), team)
+    last_seg = iteration_path.split(chr(92))[-1]
+    known = index["iterations"].get(key)
+    if known is None or (iteration_path not in known and last_seg not in known):
+        url = f"https://dev.azure.com/{org}/{project}/{requests.utils.quote(team)}/_apis/work/teamsettings/iterations?api-version=7.1"
+        resp = azure_get(pat, org, url)
+        if resp.status_code != 200:
+            return None
+        known = {}
+        # One listing indexes every sprint of the team, by full path and by name
+        for it in resp.json().get("value", []):
+            known[it.get("path", "")] = it["id"]
+            known.setdefault(it.get("name", ""), it["id"])
+        index["iterations"][key] = known
+    return known.get(iteration_path) or known.get(last_seg)
+
+
+def _members(entries, field):
+    members = []
+    for entry in entries:
+        identity = entry.get(field, {})
+        name = identity.get("displayName", "")
+        uid = identity.get("uniqueName", "")
+        if name and not name.startswith("Azure"):
+            members.append({"name": name, "uniqueName": uid})
+    return sorted(members, key=lambda x: x["name"])
+
+
+def _sprint_remaining_work(pat, org, project, iteration_path):
+    """{uniqueName: remaining hours} of the open tasks of a sprint: one WIQL query plus batched reads."""
+    session = azure_session(pat, org)
+    base = f"https://dev.azure.com/{org}/{project}/_apis/wit"
+    query = ("SELECT [System.Id] FROM WorkItems WHERE [System.TeamProject] = @project"
+             " AND [System.WorkItemType] = 'Task' AND [System.State] NOT IN ('Done', 'Closed', 'Removed')"
+             f" AND [System.IterationPath] = {_wiql_literal(iteration_path)}")
+    resp = session.post(f"{base}/wiql?api-version=7.1", json={"query": query}, timeout=30)
+    resp.raise_for_status()
+    ids = [w["id"] for w in resp.json().get("workItems", [])]
+    remaining = {}
+    for i in range(0, len(ids), 200):
+        resp = session.post(f"{base}/workitemsbatch?api-version=7.1", timeout=30, json={
+            "ids": ids[i:i + 200], "fields": ["System.AssignedTo", "Microsoft.VSTS.Scheduling.RemainingWork"]})
+        resp.raise_for_status()
+        for w in resp.json().get("value", []):
+            assignee = (w["fields"].get("System.AssignedTo") or {}).get("uniqueName")
+            if assignee:
+                remaining[assignee] = remaining.get(assignee, 0) + (w["fields"].get("Microsoft.VSTS.Scheduling.RemainingWork") or 0)
+    return remaining
+
+
+@azure_metadata(ttl=300)
+def fetch_sprint_load(pat, org, project, team, iteration_path):
+    """
+    Capacity members of the sprint with their capacity per day and the
+    remaining work of their open tasks, in one cached pass per iteration.
+    "load" is remaining work in days of their own capacity (None without capacity).
+    """
     try:
-        for team_name in [team, team + " Team"]:
-            team_enc = requests.utils.quote(team_name)
-            base = f"https://dev.azure.com/{org}/{project}/{team_enc}/_apis/work/teamsettings/iterations"
-
-            # Try current sprint first (fastest)
-            resp_cur = requests.get(base + "?$timeframe=current&api-version=7.1",
-                                    auth=("", pat), timeout=10)
-            iter_id = None
-            if resp_cur.status_code == 200:
-                cur_iters = resp_cur.json().get("value", [])
-                if cur_iters:
-                    cur = cur_iters[0]
-                    # Check if this is the selected sprint
-                    cur_name = cur.get("name", "")
-                    last_seg = iteration_path.split(chr(92))[-1]
-                    if cur_name == last_seg or last_seg in cur.get("path", ""):
-                        iter_id = cur["id"]
-
-            # If not current, search all iterations
-            if not iter_id:
-                resp_all = requests.get(base + "?api-version=7.1",
-                                        auth=("", pat), timeout=10)
-                if resp_all.status_code == 200:
-                    last_seg = iteration_path.split(chr(92))[-1]
-                    for it in resp_all.json().get("value", []):
-                        if it.get("name", "") == last_seg:
-                            iter_id = it["id"]
-                            break
-
-            if not iter_id:
-                continue
-
-            # Fetch capacities
-            url_cap = f"{base}/{iter_id}/capacities?api-version=7.1"
-            resp2 = requests.get(url_cap, auth=("", pat), timeout=10)
-            if resp2.status_code != 200:
-                continue
-
-            data = resp2.json()
-            # API returns "teamMembers" (not "value")
-            entries = data.get("teamMembers") or data.get("value", [])
-            members = []
-            for entry in entries:
-                identity = entry.get("teamMember", {})
-                name = identity.get("displayName", "")
-                uid = identity.get("uniqueName", "")
-                if name and not name.startswith("Azure"):
-                    members.append({"name": name, "uniqueName": uid})
-            if members:
-                return sorted(members, key=lambda x: x["name"])
-        return []
+        team_name = resolve_team(pat, org, project, team)
+        if not team_name:
+            return []
+        iter_id = resolve_iteration(pat, org, project, team_name, iteration_path)
+        if not iter_id:
+            return []
+        url_cap = (f"https://dev.azure.com/{org}/{project}/{requests.utils.quote(team_name)}"
+                   f"/_apis/work/teamsettings/iterations/{iter_id}/capacities?api-version=7.1")
+        resp = azure_get(pat, org, url_cap)
+        if resp.status_code != 200:
+            return []
+        data = resp.json()
+        # API returns "teamMembers" (not "value")
+        entries = data.get("teamMembers") or data.get("value", [])
+        capacity = {e.get("teamMember", {}).get("uniqueName"): sum(a.get("capacityPerDay") or 0 for a in e.get("activities", []))
+                    for e in entries}
+        try:
+            remaining = _sprint_remaining_work(pat, org, project, iteration_path)
+        except Exception:
+            remaining = {}
+        members = _members(entries, "teamMember")
+        for m in members:
+            m["capacity_per_day"] = capacity.get(m["uniqueName"], 0)
+            m["remaining"] = remaining.get(m["uniqueName"], 0)
+            m["load"] = round(m["remaining"] / m["capacity_per_day"], 1) if m["capacity_per_day"] else None
+        return members
     except Exception:
         return []
 
 
-@st.cache_data(show_spinner=False, ttl=300)
+def fetch_sprint_members(pat, org, project, team, iteration_path):
+    """Fetch capacity members of the sprint."""
+    return [{"name": m["name"], "uniqueName": m["uniqueName"]} for m in fetch_sprint_load(pat, org, project, team, iteration_path)]
+
+
+def least_loaded(members):
+    """Member with the fewest days of remaining work among those with capacity, or None."""
+    candidates = [m for m in members if m.get("load") is not None]
+    return min(candidates, key=lambda m: (m["load"], m["name"])) if candidates else None
+
+
+@azure_metadata(ttl=300)
 def fetch_teams(pat, org, project):
     """Fetch all teams in the project, filtered to Core teams."""
     try:
         url = f"https://dev.azure.com/{org}/_apis/projects/{project}/teams?api-version=7.1"
-        resp = requests.get(url, auth=("", pat), timeout=10)
+        resp = azure_get(pat, org, url)
         if resp.status_code != 200:
             return []
         teams = resp.json().get("value", [])
@@ -503,29 +538,94 @@ def fetch_teams(pat, org, project):
     except Exception:
         return []
 
-@st.cache_data(show_spinner=False, ttl=300)
+@azure_metadata(ttl=300)
 def fetch_team_members(pat, org, project, team="CoreProduct1"):
     """Fetch team members from Azure DevOps."""
     try:
-        # Try exact name, then with/without " Team" suffix
-        for team_name in [team, f"{team} Team", team.replace(" Team", "")]:
-            url = f"https://dev.azure.com/{org}/_apis/projects/{project}/teams/{requests.utils.quote(team_name)}/members?api-version=7.1"
-            resp = requests.get(url, auth=("", pat), timeout=10)
-            if resp.status_code == 200:
-                members = resp.json().get("value", [])
-                result = []
-                for m in members:
-                    identity = m.get("identity", {})
-                    name = identity.get("displayName", "")
-                    uid = identity.get("uniqueName", "")
-                    if name and not name.startswith("Azure"):
-                        result.append({"name": name, "uniqueName": uid})
-                return sorted(result, key=lambda x: x["name"])
-        return []
+        team_name = resolve_team(pat, org, project, team)
+        if not team_name:
+            return []
+        url = f"https://dev.azure.com/{org}/_apis/projects/{project}/teams/{requests.utils.quote(team_name)}/members?api-version=7.1"
+        resp = azure_get(pat, org, url)
+        if resp.status_code != 200:
+            return []
+        return _members(resp.json().get("value", []), "identity")
     except Exception:
         return []
 
 
+def warm_azure_metadata(pat, org, project):
+    """Starts loading, in the background, everything the form and the cards will ask for."""
+    def warm():
+        fetch_area_paths.prefetch(pat, org, project)
+        for group in ("areas", "iterations"):
+            fetch_classification_paths.prefetch(pat, org, project, group, depth=CLASSIFICATION_INDEX_DEPTH)
+        for team in fetch_teams(pat, org, project):
+            if team.startswith("CoreProduct"):
+                fetch_iterations.prefetch(pat, org, project, team=team)
+                fetch_team_members.prefetch(pat, org, project, team=team)
+
+    get_metadata_cache().prefetch(("warm", org.lower(), project.lower()), warm, ttl=300)
+
+
+# ---------- Backlog mirror (duplicate detection) ----------
+
+@st.cache_resource(show_spinner=False)
+def get_backlog_index():
+    return backlog_index.BacklogIndex(_azure_cache_path())
+
+
+def _wiql_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+@azure_metadata(ttl=600)
+def sync_backlog(pat, org, project, area):
+    """
+    Brings the local mirror of the PBIs under `area` up to date: one WIQL
+    query for what changed since the last sync, then workitemsbatch in
+    chunks of 200. Runs in the background; the value is the sync summary.
+    """
+    session = azure_session(pat, org)
+    base = f"https://dev.azure.com/{org}/{project}/_apis/wit"
+
+    def changed_ids(since):
+        query = ("SELECT [System.Id] FROM WorkItems WHERE [System.TeamProject] = @project"
+                 " AND [System.WorkItemType] = 'Product Backlog Item'"
+                 f" AND [System.AreaPath] UNDER {_wiql_literal(area)}")
+        if since:
+            query += f" AND [System.ChangedDate] > {_wiql_literal(since)}"
+        resp = session.post(f"{base}/wiql?timePrecision=true&api-version=7.1", json={"query": query}, timeout=30)
+        resp.raise_for_status()
+        return [w["id"] for w in resp.json().get("workItems", [])]
+
+    def fetch_items(ids):
+        resp = session.post(f"{base}/workitemsbatch?api-version=7.1", timeout=30, json={
+            "ids": ids, "fields": ["System.Id", "System.Title", "System.Description", "System.State",
+                                   "System.AreaPath", "System.ChangedDate"]})
+        resp.raise_for_status()
+        return [{"id": w["id"], "area": w["fields"].get("System.AreaPath", area),
+                 "title": w["fields"].get("System.Title", ""), "text": w["fields"].get("System.Description", ""),
+                 "state": w["fields"].get("System.State"), "changed": w["fields"].get("System.ChangedDate")}
+                for w in resp.json().get("value", [])]
+
+    synced = get_backlog_index().sync(org, project, area, changed_ids, fetch_items)
+    return {"synced": synced, "at": time.time()}
+
+
+def find_duplicates(pbi, area):
+    """Existing PBIs under `area` similar to pbi, from the local mirror only (kicks off a sync)."""
+    pat = st.session_state.get("user_pat") or st.secrets.get("AZURE_PAT", "")
+    org, project = get_org(), get_project()
+    # The mirror is shared by the whole org, like the metadata cache
+    if not (pat and area) or not verify_azure_access(pat, org, project):
+        return []
+    sync_backlog.prefetch(pat, org, project, area)
+    return get_backlog_index().similar(org, project, area, pbi.get("title", ""), pbi.get("objective", ""))
+
+
+
+
 def upload_image_to_azure(wit_client, image_b64, filename, project):
     import io
     image_bytes = base64.b64decode(image_b64)
@@ -534,91 +634,493 @@ def upload_image_to_azure(wit_client, image_b64, filename, project):
     return attachment.url
 
 
-def push_pbi_to_azure(pbi, iteration_path=None, area_path=None, parent_id=None, figma_b64=None, figma_link=None, existing_id=None, endalia_module=None, microservice=None, value_area=None):
-    from azure.devops.v7_1.work_item_tracking.models import JsonPatchOperation
-    conn = get_azure_connection()
-    wit_client = conn.clients.get_work_item_tracking_client()
-    project = get_project()
+# Fields an update may touch, in the order they are sent
+UPDATE_FIELDS = ("System.Title", "System.Description", "System.IterationPath", "System.AreaPath",
+                 "Custom.EndaliaModule", "Custom.MicroserviceVersion", "Microsoft.VSTS.Common.ValueArea")
+_ATTACHMENT_URL = re.compile(r"https://[^\s\"'<>]+/_apis/wit/attachments/[^\s\"'<>]+")
+
+
+# Uploads are named captura_<n>_<digest prefix>.png
+_CAPTURE_NAME = re.compile(r"captura_\d+_([0-9a-f]{12})\.")
+
+
+def _linked_attachments(item):
+    """{capture digest prefix: url} of the attachments an existing work item already shows or links."""
+    linked = {}
+    # Attachment URLs in the description may carry the name as ?fileName=
+    for url in _ATTACHMENT_URL.findall((item.fields or {}).get("System.Description") or ""):
+        url = url.replace("&amp;", "&")
+        m = re.search(r"fileName=" + _CAPTURE_NAME.pattern, url)
+        if m:
+            linked[m.group(1)] = url
+    # AttachedFile relation URLs do not: the name is in the relation's attributes
+    for relation in item.relations or []:
+        if relation.rel != "AttachedFile":
+            continue
+        m = _CAPTURE_NAME.match((relation.attributes or {}).get("name") or "")
+        if m:
+            linked.setdefault(m.group(1), relation.url)
+    return linked
+
+
+def _squash_html(h):
+    # Azure re-serialises stored HTML: whitespace between tags and &amp; in URLs may change
+    return re.sub(r">\s+<", "><", (h or "").strip()).replace("&amp;", "&")
 
-    attachment_urls = []
-    if figma_b64:
-        for i, b64 in enumerate(figma_b64):
-            if b64:
-                try:
-                    url = upload_image_to_azure(wit_client, b64, f"captura_{i+1}.png", project)
-                    attachment_urls.append(url)
-                except Exception as e:
-                    st.warning(f"No se pudo subir Captura {i+1}: {e}")
-                    attachment_urls.append(None)
-            else:
-                attachment_urls.append(None)
 
-    html_desc = pbi_to_html_with_urls(pbi, attachment_urls, figma_link)
+def _same_field(field, current, wanted):
+    if field == "System.Description":
+        return _squash_html(current) == _squash_html(wanted)
+    if field in ("System.IterationPath", "System.AreaPath"):
+        return (current or "").replace("/", "\\").lower() == (wanted or "").replace("/", "\\").lower()
+    return (current or "") == (wanted or "")
+
+
+def pbi_update_ops(item, wanted):
+    """Patch with only the fields whose value differs from the work item's current one."""
+    fields = item.fields or {}
+    patch = []
+    for field in UPDATE_FIELDS:
+        value = wanted.get(field)
+        if value and not _same_field(field, fields.get(field), value):
+            patch.append({"op": "replace" if field in fields else "add", "path": f"/fields/{field}", "value": value})
+    return patch
+
+
+@timed_op("azure_push")
+def push_pbi_to_azure(pbi, iteration_path=None, area_path=None, parent_id=None, figma_b64=None, figma_link=None, existing_id=None, endalia_module=None, microservice=None, value_area=None, tags=None):
+    from azure.devops.v7_1.work_item_tracking.models import JsonPatchOperation
+    wit_client = get_wit_client()
+    project = get_project()
 
     if existing_id:
-        patch = [
-            {"op": "replace", "path": "/fields/System.Title", "value": pbi["title"]},
-            {"op": "replace", "path": "/fields/System.Description", "value": html_desc},
-        ]
-        if iteration_path:
-            patch.append({"op": "replace", "path": "/fields/System.IterationPath", "value": iteration_path})
-        if area_path:
-            patch.append({"op": "replace", "path": "/fields/System.AreaPath", "value": area_path})
-        if endalia_module:
-            patch.append({"op": "replace", "path": "/fields/Custom.EndaliaModule", "value": endalia_module})
-        if microservice:
-            patch.append({"op": "replace", "path": "/fields/Custom.MicroserviceVersion", "value": microservice})
-        if value_area:
-            patch.append({"op": "replace", "path": "/fields/Microsoft.VSTS.Common.ValueArea", "value": value_area})
+        # Diff against what is there now, reusing the captures it already shows
+        item = wit_client.get_work_item(existing_id, project=project, expand="Relations")
+        attachment_urls = upload_figma_attachments(wit_client, figma_b64, project, linked=_linked_attachments(item))
+        html_desc = pbi_to_html_with_urls(pbi, attachment_urls, figma_link)
+        patch = pbi_update_ops(item, {
+            "System.Title": pbi["title"], "System.Description": html_desc,
+            "System.IterationPath": iteration_path, "System.AreaPath": area_path,
+            "Custom.EndaliaModule": endalia_module, "Custom.MicroserviceVersion": microservice,
+            "Microsoft.VSTS.Common.ValueArea": value_area,
+        })
+        if not patch:
+            return item
         patch_ops = [JsonPatchOperation(**p) for p in patch]
         return wit_client.update_work_item(document=patch_ops, id=existing_id, project=project)
     else:
-        patch = [
-            {"op": "add", "path": "/fields/System.Title", "value": pbi["title"]},
-            {"op": "add", "path": "/fields/System.Description", "value": html_desc},
-        ]
-        if iteration_path:
-            patch.append({"op": "add", "path": "/fields/System.IterationPath", "value": iteration_path})
-        if area_path:
-            patch.append({"op": "add", "path": "/fields/System.AreaPath", "value": area_path})
-        if endalia_module:
-            patch.append({"op": "add", "path": "/fields/Custom.EndaliaModule", "value": endalia_module})
-        if microservice:
-            patch.append({"op": "add", "path": "/fields/Custom.MicroserviceVersion", "value": microservice})
-        if value_area:
-            patch.append({"op": "add", "path": "/fields/Microsoft.VSTS.Common.ValueArea", "value": value_area})
-        if parent_id:
-            patch.append({"op": "add", "path": "/relations/-", "value": {
-                "rel": "System.LinkTypes.Hierarchy-Reverse",
-                "url": f"https://dev.azure.com/{get_org()}/_apis/wit/workItems/{parent_id}",
-            }})
+        attachment_urls = upload_figma_attachments(wit_client, figma_b64, project)
+        html_desc = pbi_to_html_with_urls(pbi, attachment_urls, figma_link)
+        patch = pbi_create_ops(pbi, html_desc, iteration_path, area_path, endalia_module, microservice, value_area, parent_id, tags)
         patch_ops = [JsonPatchOperation(**p) for p in patch]
         return wit_client.create_work_item(document=patch_ops, project=project, type="Product Backlog Item")
 
 
-def create_child_tasks(wit_client, project, pbi_id, task_titles, iteration_path=None, area_path=None, assignees=None):
-    """Create Task work items as children of the given PBI, one per title in task_titles."""
+@st.cache_resource(show_spinner=False)
+def get_attachment_cache():
+    return azure_cache.AttachmentCache(st.secrets.get("ATTACHMENT_CACHE_PATH", os.path.join(".cache", "azure.sqlite3")))
+
+
+def upload_figma_attachments(wit_client, figma_b64, project, linked=None):
+    """
+    Returns the attachment URLs in Captura order (None where the upload failed).
+    Captures already uploaded to this org/project, or already attached to the
+    work item being updated (`linked`, by digest prefix), are reused by content
+    hash; the rest are uploaded concurrently.
+    """
+    cache = get_attachment_cache()
+    org = get_org()
+    attachment_urls = [None] * len(figma_b64 or [])
+    pending = {}
+    for i, b64 in enumerate(figma_b64 or []):
+        if not b64:
+            continue
+        digest = azure_cache.content_hash(base64.b64decode(b64))
+        url = (linked or {}).get(digest[:12]) or cache.get(org, project, digest)
+        if url:
+            attachment_urls[i] = url
+        else:
+            # The same capture twice in one push is uploaded once
+            pending.setdefault(digest, []).append(i)
+    if not pending:
+        return attachment_urls
+
+    def upload(digest):
+        first = pending[digest][0]
+        b64 = figma_b64[first]
+        # The digest in the name lets later updates recognise the capture on the work item
+        url = upload_image_to_azure(wit_client, b64, f"captura_{first+1}_{digest[:12]}.png", project)
+        cache.put(org, project, digest, url, len(b64) * 3 // 4)
+        return url
+
+    workers = min(len(pending), int(st.secrets.get("AZURE_UPLOAD_WORKERS", 4)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {digest: pool.submit(upload, digest) for digest in pending}
+    for digest, fut in futures.items():
+        try:
+            url = fut.result()
+        except Exception as e:
+            st.warning(f"No se pudo subir Captura {pending[digest][0]+1}: {e}")
+            url = None
+        for i in pending[digest]:
+            attachment_urls[i] = url
+    return attachment_urls
+
+
+def _parent_link(parent, org=None):
+    """org must be passed when called off the script thread (no session_state there)."""
+    return {"op": "add", "path": "/relations/-", "value": {
+        "rel": "System.LinkTypes.Hierarchy-Reverse",
+        "url": f"https://dev.azure.com/{org or get_org()}/_apis/wit/workItems/{parent}",
+    }}
+
+
+def pbi_create_ops(pbi, html_desc, iteration_path=None, area_path=None, endalia_module=None, microservice=None, value_area=None, parent_id=None, tags=None):
+    patch = [
+        {"op": "add", "path": "/fields/System.Title", "value": pbi["title"]},
+        {"op": "add", "path": "/fields/System.Description", "value": html_desc},
+    ]
+    if iteration_path:
+        patch.append({"op": "add", "path": "/fields/System.IterationPath", "value": iteration_path})
+    if area_path:
+        patch.append({"op": "add", "path": "/fields/System.AreaPath", "value": area_path})
+    if endalia_module:
+        patch.append({"op": "add", "path": "/fields/Custom.EndaliaModule", "value": endalia_module})
+    if microservice:
+        patch.append({"op": "add", "path": "/fields/Custom.MicroserviceVersion", "value": microservice})
+    if value_area:
+        patch.append({"op": "add", "path": "/fields/Microsoft.VSTS.Common.ValueArea", "value": value_area})
+    if parent_id:
+        patch.append(_parent_link(parent_id))
+    if tags:
+        patch.append({"op": "add", "path": "/fields/System.Tags", "value": tags})
+    return patch
+
+
+def task_create_ops(title, pbi_id, iteration_path=None, area_path=None, assignee=None, tags=None, org=None):
+    patch = [
+        {"op": "add", "path": "/fields/System.Title", "value": title or "Task"},
+        _parent_link(pbi_id, org),
+    ]
+    if iteration_path:
+        patch.append({"op": "add", "path": "/fields/System.IterationPath", "value": iteration_path})
+    if area_path:
+        patch.append({"op": "add", "path": "/fields/System.AreaPath", "value": area_path})
+    if assignee:
+        patch.append({"op": "add", "path": "/fields/System.AssignedTo", "value": assignee})
+    if tags:
+        patch.append({"op": "add", "path": "/fields/System.Tags", "value": tags})
+    return patch
+
+
+# Azure DevOps accepts at most 200 operations per $batch call
+AZURE_BATCH_LIMIT = 200
+
+
+@timed_op("azure_push_all")
+def push_all_pbis_to_azure(pbis, targets, figma_b64=None, figma_link=None, tasks=None):
+    """
+    Creates every PBI, its parent link and its child tasks through the
+    work item $batch endpoint. Items reference each other with temporary
+    negative IDs, so a PBI and its tasks always travel in the same request.
+    targets[i] holds the push_pbi_to_azure keyword arguments of pbis[i] and
+    tasks[i] is a list of (title, assignee) for it.
+
+    Pushes are journaled like push_pbi_journaled (same intent keys and tags):
+    PBIs already created are not sent again, and those a previous attempt
+    left half-done are resumed one by one instead of going into the batch.
+    Returns one {"id", "error", "queued", "tasks": [{"id", "error"}]} per PBI.
+    """
+    wit_client = get_wit_client()
+    org, project = get_org(), get_project()
+    journal = get_push_journal()
+    tasks = tasks or [[]] * len(pbis)
+    task_specs = [[{"title": title or pbi["title"], "assignee": assignee or ""} for title, assignee in pbi_tasks]
+                  for pbi, pbi_tasks in zip(pbis, tasks)]
+    results = [{"id": None, "error": None, "queued": False, "tasks": [None] * len(specs)} for specs in task_specs]
+    intents = []
+    for i, (pbi, target, specs) in enumerate(zip(pbis, targets, task_specs)):
+        try:
+            intents.append(_journal_intent(pbi, target, figma_b64, figma_link, specs))
+        except push_journal.InProgressError as e:
+            intents.append(None)
+            results[i]["error"] = str(e)
+    fresh = []
+    for i, intent in enumerate(intents):
+        if intent is None:
+            continue
+        key, entry = intent
+        if entry["state"] != push_journal.DONE and not entry["attempts"]:
+            fresh.append(i)
+            continue
+        try:
+            pbi_id, task_ids, queued = _push_journaled(key, entry, pbis[i], targets[i], figma_b64, figma_link,
+                                                       task_specs[i])
+            results[i].update(id=pbi_id, queued=queued,
+                              tasks=[{"id": t, "error": None} for t in task_ids] + results[i]["tasks"][len(task_ids):])
+        except Exception as e:
+            results[i]["error"] = str(e)
+    if not fresh:
+        return results
+
+    # Captures are uploaded once and shared by every PBI description
+    attachment_urls = upload_figma_attachments(wit_client, figma_b64, project)
+
+    groups = []
+    temp_id = 0
+    for i in fresh:
+        key, target = intents[i][0], targets[i]
+        temp_id -= 1
+        pbi_temp = temp_id
+        html_desc = pbi_to_html_with_urls(pbis[i], attachment_urls, figma_link)
+        ops = [{"op": "add", "path": "/id", "value": str(pbi_temp)}]
+        ops += pbi_create_ops(pbis[i], html_desc, target.get("iteration_path"), target.get("area_path"),
+                              target.get("endalia_module"), target.get("microservice"), target.get("value_area"),
+                              target.get("parent_id"), push_journal.pbi_tag(key))
+        group = [(i, None, "Product Backlog Item", ops)]
+        for t, spec in enumerate(task_specs[i]):
+            temp_id -= 1
+            task_ops = [{"op": "add", "path": "/id", "value": str(temp_id)}]
+            task_ops += task_create_ops(spec["title"], pbi_temp, target.get("iteration_path"), target.get("area_path"),
+                                        spec["assignee"], push_journal.task_tag(key, t), org)
+            group.append((i, t, "Task", task_ops))
+        groups.append(group)
+
+    chunks, current = [], []
+    for group in groups:
+        if current and len(current) + len(group) > AZURE_BATCH_LIMIT:
+            chunks.append(current)
+            current = []
+        current += group
+    if current:
+        chunks.append(current)
+
+    unreachable = set()
+    for chunk in chunks:
+        body = [{
+            "method": "PATCH",
+            "uri": f"/{requests.utils.quote(project)}/_apis/wit/workitems/${requests.utils.quote(wi_type)}?api-version=7.1",
+            "headers": {"Content-Type": "application/json-patch+json"},
+            "body": ops,
+        } for _, _, wi_type, ops in chunk]
+        try:
+            resp = azure_pool()["session"].post(f"https://dev.azure.com/{org}/_apis/wit/$batch?api-version=7.1",
+                                                json=body, timeout=60)
+            resp.raise_for_status()
+            responses = resp.json().get("value", [])
+        except Exception as e:
+            if _azure_unreachable(e):
+                unreachable |= {i for i, _, _, _ in chunk}
+            responses = [{"code": 0, "body": json.dumps({"message": str(e)})}] * len(chunk)
+        for (i, t, _, _), item in zip(chunk, responses):
+            try:
+                payload = json.loads(item.get("body") or "{}")
+            except (TypeError, json.JSONDecodeError):
+                payload = {}
+            ok = 200 <= item.get("code", 0) < 300
+            entry = {"id": payload.get("id") if ok else None,
+                     "error": None if ok else payload.get("message") or f"HTTP {item.get('code')}"}
+            if t is None:
+                results[i].update(entry)
+                if entry["id"]:
+                    journal.record_pbi(intents[i][0], entry["id"])
+            else:
+                results[i]["tasks"][t] = entry
+                if entry["id"]:
+                    journal.record_task(intents[i][0], t, entry["id"])
+
+    for i in fresh:
+        key = intents[i][0]
+        errors = [results[i]["error"]] + [t["error"] for t in results[i]["tasks"] if t]
+        errors = [e for e in errors if e]
+        if not errors:
+            journal.complete(key)
+        elif i in unreachable:
+            journal.to_outbox(key, errors[0])
+            results[i].update(queued=True, error=None)
+        else:
+            # Pushing again resumes from what was recorded above
+            journal.fail(key, "; ".join(errors))
+    return results
+
+
+@timed_op("azure_tasks")
+def create_child_tasks(wit_client, project, pbi_id, task_titles, iteration_path=None, area_path=None, assignees=None, tags=None,
+                       on_created=None):
+    """
+    Create Task work items as children of the given PBI, one per title in
+    task_titles, concurrently on the shared client. Returns the IDs in
+    task_titles order; on_created(i, id) is called as each one is created.
+    """
     from azure.devops.v7_1.work_item_tracking.models import JsonPatchOperation
+
+    # Resolved here: the workers have no access to the session's org
     org = get_org()
-    created = []
-    for i, title in enumerate(task_titles):
-        patch = [
-            {"op": "add", "path": "/fields/System.Title", "value": title or "Task"},
-            {"op": "add", "path": "/relations/-", "value": {
-                "rel": "System.LinkTypes.Hierarchy-Reverse",
-                "url": f"https://dev.azure.com/{org}/_apis/wit/workItems/{pbi_id}",
-            }},
-        ]
-        if iteration_path:
-            patch.append({"op": "add", "path": "/fields/System.IterationPath", "value": iteration_path})
-        if area_path:
-            patch.append({"op": "add", "path": "/fields/System.AreaPath", "value": area_path})
-        if assignees and i < len(assignees) and assignees[i]:
-            patch.append({"op": "add", "path": "/fields/System.AssignedTo", "value": assignees[i]})
+
+    def create(i):
+        assignee = assignees[i] if assignees and i < len(assignees) else None
+        patch = task_create_ops(task_titles[i], pbi_id, iteration_path, area_path, assignee,
+                                tags[i] if tags else None, org)
         patch_ops = [JsonPatchOperation(**p) for p in patch]
         task = wit_client.create_work_item(document=patch_ops, project=project, type="Task")
-        created.append(task.id)
-    return created
+        if on_created:
+            on_created(i, task.id)
+        return task.id
+
+    if not task_titles:
+        return []
+    workers = min(len(task_titles), int(st.secrets.get("AZURE_TASK_WORKERS", 4)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(create, i) for i in range(len(task_titles))]
+    # Every task has been attempted; the first failure, if any, is raised here
+    return [fut.result() for fut in futures]
+
+
+# ---------- Push journal and outbox ----------
+
+@st.cache_resource(show_spinner=False)
+def get_push_journal():
+    return push_journal.PushJournal(_azure_cache_path())
+
+
+def _azure_unreachable(error):
+    """Errors worth retrying later from the outbox, as opposed to rejected pushes."""
+    from msrest.exceptions import ClientRequestError
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, ClientRequestError))
+
+
+def _find_tagged(tags):
+    """{tag: work item id} of the journal tags already present in Azure."""
+    if not tags:
+        return {}
+    base = f"https://dev.azure.com/{get_org()}/{get_project()}/_apis/wit"
+    session = azure_pool()["session"]
+    condition = " OR ".join(f"[System.Tags] CONTAINS {_wiql_literal(t)}" for t in tags)
+    resp = session.post(f"{base}/wiql?api-version=7.1", timeout=30,
+                        json={"query": f"SELECT [System.Id] FROM WorkItems WHERE [System.TeamProject] = @project AND ({condition})"})
+    resp.raise_for_status()
+    ids = [w["id"] for w in resp.json().get("workItems", [])]
+    if not ids:
+        return {}
+    resp = session.post(f"{base}/workitemsbatch?api-version=7.1", timeout=30,
+                        json={"ids": ids[:200], "fields": ["System.Id", "System.Tags"]})
+    resp.raise_for_status()
+    found = {}
+    for w in resp.json().get("value", []):
+        for tag in (w["fields"].get("System.Tags") or "").split(";"):
+            if tag.strip() in tags:
+                found[tag.strip()] = w["id"]
+    return found
+
+
+def _journal_intent(pbi, target, figma_b64=None, figma_link=None, tasks=()):
+    """
+    Records the push intent. Returns (key, entry as it was before this attempt).
+    The captures are journaled by digest, their bytes once in the blob table.
+    """
+    journal = get_push_journal()
+    key = push_journal.intent_key(pbi, dict(target, tasks=list(tasks), org=get_org(), project=get_project()))
+    pat = st.session_state.get("user_pat") or st.secrets.get("AZURE_PAT", "")
+    captures, blobs = [], {}
+    for b64 in figma_b64 or []:
+        data = base64.b64decode(b64) if b64 else b""
+        digest = azure_cache.content_hash(data) if data else ""
+        captures.append(digest)
+        if data:
+            blobs[digest] = data
+    entry = journal.begin(key, _pat_scope(pat), {"pbi": pbi, "target": target, "captures": captures,
+                                                   "figma_link": figma_link, "tasks": list(tasks)}, blobs)
+    return key, entry
+
+
+def _journaled_captures(payload):
+    """figma_b64 of a journaled payload (older entries kept the images inline)."""
+    if "figma_b64" in payload:
+        return payload["figma_b64"]
+    journal = get_push_journal()
+    blobs = [journal.blob(d) if d else None for d in payload.get("captures", [])]
+    return [base64.b64encode(b).decode("utf-8") if b else "" for b in blobs]
+
+
+def _push_journaled(key, entry, pbi, target, figma_b64=None, figma_link=None, tasks=()):
+    """The steps of a journaled push that are still missing, one call each."""
+    journal = get_push_journal()
+    if entry["state"] == push_journal.DONE:
+        return entry["pbi_id"], [entry["task_ids"][n] for n in sorted(entry["task_ids"])], False
+    pbi_id, task_ids = entry["pbi_id"], dict(entry["task_ids"])
+    try:
+        if entry["attempts"]:
+            # A previous attempt may have created items without living to journal them
+            missing = ([] if pbi_id else [push_journal.pbi_tag(key)]) + [
+                push_journal.task_tag(key, n) for n in range(len(tasks)) if n not in task_ids]
+            found = _find_tagged(missing)
+            if not pbi_id and push_journal.pbi_tag(key) in found:
+                pbi_id = found[push_journal.pbi_tag(key)]
+                journal.record_pbi(key, pbi_id)
+            for n in range(len(tasks)):
+                if push_journal.task_tag(key, n) in found and n not in task_ids:
+                    task_ids[n] = found[push_journal.task_tag(key, n)]
+                    journal.record_task(key, n, task_ids[n])
+        if not pbi_id:
+            pbi_id = push_pbi_to_azure(pbi, figma_b64=figma_b64, figma_link=figma_link,
+                                       tags=push_journal.pbi_tag(key), **target).id
+            journal.record_pbi(key, pbi_id)
+        missing = [n for n in range(len(tasks)) if n not in task_ids]
+
+        def created(i, task_id):
+            task_ids[missing[i]] = task_id
+            journal.record_task(key, missing[i], task_id)
+
+        create_child_tasks(get_wit_client(), project=get_project(), pbi_id=pbi_id,
+            task_titles=[tasks[n]["title"] for n in missing], iteration_path=target.get("iteration_path"),
+            area_path=target.get("area_path"), assignees=[tasks[n]["assignee"] for n in missing],
+            tags=[push_journal.task_tag(key, n) for n in missing], on_created=created)
+        journal.complete(key)
+        return pbi_id, [task_ids[n] for n in sorted(task_ids)], False
+    except Exception as e:
+        if _azure_unreachable(e):
+            journal.to_outbox(key, str(e))
+            return pbi_id, [task_ids[n] for n in sorted(task_ids)], True
+        journal.fail(key, str(e))
+        raise
+
+
+def push_pbi_journaled(pbi, target, figma_b64=None, figma_link=None, task_titles=(), task_assignees=()):
+    """
+    Creates the PBI and its tasks at most once per (PBI, target), resuming
+    after the last step the journal saw complete. target holds the
+    push_pbi_to_azure keyword arguments. Returns (pbi_id, task_ids, queued):
+    queued means Azure was unreachable and the push waits in the outbox.
+    """
+    tasks = [{"title": t, "assignee": a} for t, a in zip(task_titles, list(task_assignees) + [""] * len(task_titles))]
+    key, entry = _journal_intent(pbi, target, figma_b64, figma_link, tasks)
+    return _push_journaled(key, entry, pbi, target, figma_b64, figma_link, tasks)
+
+
+@st.fragment(run_every=30)
+def flush_outbox():
+    """Retries, from the user's own session, the pushes parked while Azure was unreachable."""
+    pat = st.session_state.get("user_pat") or st.secrets.get("AZURE_PAT", "")
+    if not pat:
+        return
+    journal = get_push_journal()
+    for entry in journal.due(_pat_scope(pat)):
+        payload = entry["payload"]
+        try:
+            # begin() claims the entry: if another session got it first, it is theirs
+            pbi_id, _, queued = push_pbi_journaled(
+                payload["pbi"], payload["target"], _journaled_captures(payload), payload["figma_link"],
+                [t["title"] for t in payload["tasks"]], [t["assignee"] for t in payload["tasks"]])
+        except push_journal.InProgressError:
+            continue
+        except Exception as e:
+            st.toast(f"❌ No se pudo crear «{payload['pbi']['title']}»: {e}")
+            continue
+        if not queued:
+            st.toast(f"✅ PBI pendiente creado en Azure — #{pbi_id}")
+    pending = journal.stats(_pat_scope(pat)).get(push_journal.OUTBOX, 0)
+    if pending:
+        st.caption(f"📤 {pending} push(es) en cola, se reintentarán automáticamente")
 
 
 # ========== FIGMA ==========
@@ -639,22 +1141,141 @@ def parse_figma_url(url):
     return file_key, list(node_ids)
 
 
-def get_figma_images(file_key, node_ids, figma_token):
-    headers = {"X-Figma-Token": figma_token}
-    ids_str = ",".join(node_ids)
-    resp = requests.get(f"https://api.figma.com/v1/images/{file_key}?ids={ids_str}&format=png&scale=2", headers=headers)
+# Rendering big frames on Figma's side is slow; connecting is not
+FIGMA_CONNECT_TIMEOUT = 5
+FIGMA_CHUNK_SIZE = 64 * 1024
+
+
+@st.cache_resource(show_spinner=False)
+def get_figma_session():
+    """Keep-alive session shared by every export, sized for the concurrent render downloads."""
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    workers = int(st.secrets.get("FIGMA_DOWNLOAD_WORKERS", 8))
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=workers))
+    return session
+
+
+def _figma_timeout():
+    return (FIGMA_CONNECT_TIMEOUT, float(st.secrets.get("FIGMA_READ_TIMEOUT", 60)))
+
+
+def _download_render(session, img_url, timeout):
+    """Streams one rendered PNG; the read timeout applies to each chunk, not the whole body."""
+    with session.get(img_url, stream=True, timeout=timeout) as resp:
+        resp.raise_for_status()
+        return b"".join(resp.iter_content(chunk_size=FIGMA_CHUNK_SIZE))
+
+
+def _figma_node_id(node_id):
+    return node_id.replace("-", ":")
+
+
+def _export_figma_images(session, file_key, node_ids, figma_token, timeout, workers, progress):
+    """
+    Returns (images, errors). Renders are downloaded concurrently; a render
+    that fails is reported in errors and the others are still returned, in
+    the order of node_ids. Runs off the script thread, so it touches no
+    Streamlit API: progress["total"] and progress["events"] ((node_id, ok)
+    per finished download) are filled in for the sessions waiting on it.
+    """
+    try:
+        resp = session.get(f"https://api.figma.com/v1/images/{file_key}",
+                           params={"ids": ",".join(node_ids), "format": "png", "scale": 2},
+                           headers={"X-Figma-Token": figma_token}, timeout=timeout)
+    except requests.RequestException as e:
+        return [], [f"Error exportando imágenes de Figma: {e}"]
     if resp.status_code != 200:
-        st.error(f"Error exportando imágenes de Figma: {resp.status_code}")
-        return []
-    data = resp.json()
-    images = []
-    for node_id, img_url in data.get("images", {}).items():
-        if img_url:
-            img_resp = requests.get(img_url)
-            if img_resp.status_code == 200:
-                b64 = base64.b64encode(img_resp.content).decode("utf-8")
-                images.append({"data": b64, "media_type": "image/png", "node_id": node_id, "url": img_url})
-    return images
+        return [], [f"Error exportando imágenes de Figma: {resp.status_code}"]
+    # Figma may spell a node id as "1:2" or "1-2"; compare them in one form, each node once
+    renders = {_figma_node_id(node_id): url for node_id, url in resp.json().get("images", {}).items()}
+    node_ids = list(dict.fromkeys(_figma_node_id(node_id) for node_id in node_ids))
+    errors = [f"Figma no pudo renderizar el nodo {node_id}" for node_id in node_ids if not renders.get(node_id)]
+    pending = [(node_id, renders[node_id]) for node_id in node_ids if renders.get(node_id)]
+    progress["total"] = len(pending)
+    if not pending:
+        return [], errors
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(len(pending), workers), thread_name_prefix="figma-render") as pool:
+        futures = {pool.submit(_download_render, session, url, timeout): (node_id, url) for node_id, url in pending}
+        for future in as_completed(futures):
+            node_id, url = futures[future]
+            try:
+                results[node_id] = {"data": base64.b64encode(future.result()).decode("utf-8"),
+                                    "media_type": "image/png", "node_id": node_id, "url": url}
+            except Exception as e:
+                errors.append(f"No se pudo descargar el nodo {node_id}: {e}")
+            progress["events"].append((node_id, node_id in results))
+    return [results[node_id] for node_id, _ in pending if node_id in results], errors
+
+
+@st.cache_resource(show_spinner=False)
+def _figma_exports():
+    """Exports in flight, shared by every session: key → (future, progress)."""
+    return {"running": {}, "coalesced": 0, "lock": threading.Lock(),
+            "pool": ThreadPoolExecutor(max_workers=4, thread_name_prefix="figma-export")}
+
+
+@timed_op("figma_export")
+def get_figma_images(file_key, node_ids, figma_token, on_progress=None):
+    """
+    Sessions exporting the same frames at the same time share one export. It
+    runs in a worker, and each session draws its own progress from here
+    (on_progress(done, total, node_id, ok)), so a session that stops or
+    reruns only stops waiting and never breaks the export for the others.
+    """
+    exports = _figma_exports()
+    key = (file_key, tuple(sorted(node_ids)), _pat_scope(figma_token))
+    with exports["lock"]:
+        running = exports["running"].get(key)
+        if running:
+            exports["coalesced"] += 1
+        else:
+            progress = {"total": None, "events": []}
+            future = exports["pool"].submit(_export_figma_images, get_figma_session(), file_key, list(node_ids),
+                                            figma_token, _figma_timeout(),
+                                            int(st.secrets.get("FIGMA_DOWNLOAD_WORKERS", 8)), progress)
+            running = exports["running"][key] = (future, progress)
+
+            def finished(_, key=key):
+                with exports["lock"]:
+                    exports["running"].pop(key, None)
+
+            future.add_done_callback(finished)
+    future, progress = running
+    seen = 0
+    while True:
+        done = future.done()
+        events = progress["events"][seen:]
+        for n, (node_id, ok) in enumerate(events, seen + 1):
+            if on_progress:
+                on_progress(n, progress["total"] or len(node_ids), node_id, ok)
+        seen += len(events)
+        if done:
+            break
+        futures_wait([future], timeout=0.2)
+    images, errors = future.result()
+    if errors and not images:
+        st.error(errors[0])
+    elif errors:
+        st.warning(f"Exportadas {len(images)} de {len(images) + len(errors)} pantallas:\n\n"
+                   + "\n".join(f"- {e}" for e in errors))
+    return [dict(img) for img in images]
+
+
+def export_figma_with_progress(file_key, node_ids):
+    """get_figma_images with a progress bar that advances as each frame arrives."""
+    bar = st.progress(0.0, text=f"Renderizando {len(node_ids)} pantalla(s) en Figma...")
+
+    def on_progress(done, total, node_id, ok):
+        bar.progress(done / total, text=f"{'✅' if ok else '⚠️'} {done}/{total} · nodo {node_id}")
+
+    try:
+        return get_figma_images(file_key, node_ids, st.secrets["FIGMA_TOKEN"], on_progress)
+    finally:
+        bar.empty()
 
 
 # ========== HTML FORMATTING ==========
@@ -813,36 +1434,214 @@ def pbi_to_html_with_urls(p, attachment_urls=None, figma_link=None):
 
 # ========== GENERATION ==========
 
-def generate_pbis(module, feature, role, description, context, images):
-    client = anthropic.Anthropic(api_key=st.secrets["ANTHROPIC_API_KEY"])
-    user_content = []
-    text = f"MÓDULO: {module or 'No especificado'}\nFEATURE: {feature or 'No especificada'}\nROL AFECTADO: {role}\n\nIMPORTANTE: El título de cada PBI DEBE comenzar exactamente con '{module} - {feature} - US X.X - ' seguido de la acción concreta. No omitas estos prefijos.\n\nDESCRIPCIÓN:\n{description}"
-    if context:
-        text += f"\n\nCONTEXTO ADICIONAL:\n{context}"
-    if images:
-        text += f"\n\nSe adjuntan {len(images)} captura(s) del prototipo (Captura 1, 2...). Analízalas y referéncialas en los PBIs."
-    user_content.append({"type": "text", "text": text})
-    for img in images:
-        user_content.append({"type": "image", "source": {"type": "base64", "media_type": img["media_type"], "data": img["data"]}})
-    response = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=16000,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": user_content}]
+@st.cache_resource(show_spinner=False)
+def _anthropic_pool_stats():
+    """Process-wide counters for the shared Anthropic HTTP pool."""
+    return {"requests": 0, "new_connections": 0, "since": time.time(), "http_client": None}
+
+
+@st.cache_resource(show_spinner=False)
+def _pooled_anthropic_client(api_key, max_connections, max_keepalive, keepalive_expiry, timeout, connect_timeout):
+    import httpx
+    stats = _anthropic_pool_stats()
+
+    def _trace(event, info):
+        if event == "connection.connect_tcp.complete":
+            stats["new_connections"] += 1
+
+    def _on_request(request):
+        stats["requests"] += 1
+        request.extensions["trace"] = _trace
+
+    http_client = anthropic.DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=max_connections,
+                            max_keepalive_connections=max_keepalive,
+                            keepalive_expiry=keepalive_expiry),
+        timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        event_hooks={"request": [_on_request]},
     )
-    raw = "".join(block.text for block in response.content if block.type == "text")
-    # Clean markdown fences and control characters
-    clean = raw.replace("```json", "").replace("```", "").strip()
-    # Remove control chars that break JSON parsing
-    clean = re.sub(r'[--]', '', clean)
+    stats["http_client"] = http_client
+    return anthropic.Anthropic(api_key=api_key, http_client=http_client)
+
+
+def get_anthropic_client():
+    """One long-lived client per process, shared by every session (keep-alive reuse)."""
+    return _pooled_anthropic_client(
+        st.secrets["ANTHROPIC_API_KEY"],
+        int(st.secrets.get("ANTHROPIC_MAX_CONNECTIONS", 20)),
+        int(st.secrets.get("ANTHROPIC_MAX_KEEPALIVE", 10)),
+        float(st.secrets.get("ANTHROPIC_KEEPALIVE_EXPIRY", 120)),
+        float(st.secrets.get("ANTHROPIC_TIMEOUT", 600)),
+        float(st.secrets.get("ANTHROPIC_CONNECT_TIMEOUT", 10)),
+    )
+
+
+def anthropic_pool_status():
+    """Snapshot of the shared pool: open/idle connections and keep-alive reuse."""
+    stats = _anthropic_pool_stats()
+    status = {
+        "requests": stats["requests"],
+        "new_connections": stats["new_connections"],
+        "reused": max(0, stats["requests"] - stats["new_connections"]),
+        "open": 0,
+        "idle": 0,
+        "uptime_s": int(time.time() - stats["since"]),
+    }
     try:
-        return json.loads(clean)
-    except json.JSONDecodeError:
-        # Try to extract JSON object if there's extra text around it
-        match = re.search(r'\{.*\}', clean, re.DOTALL)
-        if match:
-            return json.loads(match.group())
-        raise
+        pool = stats["http_client"]._transport._pool
+        conns = list(pool.connections)
+        status["open"] = len(conns)
+        status["idle"] = sum(1 for c in conns if c.is_idle())
+    except Exception:
+        pass
+    return status
+
+
+@st.cache_resource(show_spinner=False)
+def get_scheduler():
+    """Rate-limit-aware fair queue shared by every session of this server."""
+    return scheduler.RateLimitScheduler(
+        requests_per_minute=int(st.secrets.get("ANTHROPIC_RPM", 50)),
+        tokens_per_minute=int(st.secrets.get("ANTHROPIC_ITPM", 30000)),
+        max_concurrent=int(st.secrets.get("ANTHROPIC_MAX_CONCURRENT", 8)),
+        max_retries=int(st.secrets.get("ANTHROPIC_MAX_RETRIES", 5)),
+    )
+
+
+def _scheduler_user():
+    """Fairness key: the Azure PAT identifies the PM across tabs; fall back to the session."""
+    pat = st.session_state.get("user_pat") or ""
+    if pat:
+        return hashlib.sha256(pat.encode("utf-8")).hexdigest()[:12]
+    return st.session_state.setdefault("_session_uid", uuid.uuid4().hex[:12])
+
+
+def _scheduled_client():
+    queue_box = st.empty()
+    last = {"pos": None}
+
+    def on_wait(pos):
+        if pos != last["pos"]:
+            last["pos"] = pos
+            queue_box.info(f"⏳ Hay otras generaciones en curso — tu petición está en la posición **{pos}** de la cola")
+
+    client = scheduler.ScheduledClient(get_anthropic_client(), get_scheduler(), _scheduler_user(), on_wait)
+    return client, queue_box
+
+
+def _record_usage(usage):
+    """Keep the token usage of the last generation for the results header."""
+    st.session_state["last_usage"] = {
+        "input": getattr(usage, "input_tokens", 0) or 0,
+        "output": getattr(usage, "output_tokens", 0) or 0,
+        "cache_read": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_creation": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+    }
+
+
+def _run_generation(mode, generate_fn, module, feature, role, description, context, images, **kwargs):
+    """Runs one of the generation.generate* functions, recording usage and a telemetry record."""
+    stats = generation.new_stats()
+    image_bytes = sum(len(img["data"]) * 3 // 4 for img in images)
+    client, queue_box = _scheduled_client()
+    with get_telemetry().timed("generate", mode=mode, images=len(images), image_bytes=image_bytes) as rec:
+        try:
+            result, usage = generate_fn(client, module, feature, role, description, context, images,
+                                        stats=stats, **kwargs)
+        finally:
+            queue_box.empty()
+            stats["retries"] += client.retries
+            rec["retries"] = stats["retries"]
+        rec.update(
+            input_tokens=getattr(usage, "input_tokens", 0) or 0,
+            output_tokens=getattr(usage, "output_tokens", 0) or 0,
+            cache_read_tokens=getattr(usage, "cache_read_input_tokens", 0) or 0,
+            cache_creation_tokens=getattr(usage, "cache_creation_input_tokens", 0) or 0,
+            ttft_s=round(stats["ttft_s"], 3) if stats["ttft_s"] is not None else None,
+            calls=stats["calls"],
+            continuations=stats["continuations"],
+            parse_fallback=stats["parse_fallback"],
+            missing_pbis=stats["missing_pbis"],
+            pbis=len(result.get("pbis", [])),
+        )
+    _record_usage(usage)
+    # Recovered from truncated / malformed output, or missing PBIs: shown, but not cached
+    st.session_state["last_generation_partial"] = stats["parse_fallback"] or bool(stats["missing_pbis"])
+    return result
+
+
+def generate_pbis(module, feature, role, description, context, images, use_cache=True):
+    return _run_generation("blocking", generation.generate, module, feature, role, description, context, images,
+                           use_cache=use_cache)
+
+
+def generate_pbis_stream(module, feature, role, description, context, images, on_summary=None, on_pbi=None, use_cache=True):
+    return _run_generation("stream", generation.generate_stream, module, feature, role, description, context, images,
+                           on_summary=on_summary, on_pbi=on_pbi, use_cache=use_cache)
+
+
+# Same threshold the form uses for "Feature compleja — 2+ PBIs"
+FANOUT_MIN_CHARS = 300
+
+
+def generate_pbis_fanout(module, feature, role, description, context, images, on_summary=None, on_pbi=None, use_cache=True):
+    return _run_generation("fanout", generation.generate_fanout, module, feature, role, description, context, images,
+                           on_summary=on_summary, on_pbi=on_pbi, use_cache=use_cache,
+                           max_workers=int(st.secrets.get("FANOUT_MAX_WORKERS", 6)))
+
+
+# Widget keys render_pbi_card creates for a card, which shadow the PBI values once set
+_CARD_WIDGET_PREFIXES = ("obj_", "role_", "when_", "then_", "ben_", "spec_", "hp_", "v_", "e_", "pr_", "tn_",
+                         "_html_hash_")
+
+
+def _reset_card_widgets(idx):
+    for k in list(st.session_state.keys()):
+        for prefix in _CARD_WIDGET_PREFIXES:
+            if k == f"{prefix}{idx}" or k.startswith(f"{prefix}{idx}_"):
+                del st.session_state[k]
+                break
+
+
+def refine_pbi_in_place(idx, instruction):
+    """
+    Refines st.session_state["result"]["pbis"][idx] from a PM instruction,
+    leaving every other PBI (and its manual edits) untouched. Returns the
+    number of patch operations applied, or None if the PBI was rewritten.
+    """
+    pbis = st.session_state["result"]["pbis"]
+    pbi = pbis[idx]
+    siblings = [p for i, p in enumerate(pbis) if i != idx]
+    stats = generation.new_stats()
+    client, queue_box = _scheduled_client()
+    with get_telemetry().timed("refine") as rec:
+        try:
+            new_pbi, changes, usage = generation.refine_pbi(client, pbi, instruction, siblings, idx,
+                use_cache=st.session_state.get("prompt_caching", True), stats=stats)
+        finally:
+            queue_box.empty()
+            rec["retries"] = stats["retries"] + client.retries
+        rec.update(input_tokens=usage.input_tokens, output_tokens=usage.output_tokens,
+                   cache_read_tokens=usage.cache_read_input_tokens, ttft_s=stats["ttft_s"],
+                   patch_ops=changes)
+    # Same dict object, so the card keeps rendering the updated PBI
+    pbi.clear()
+    pbi.update(new_pbi)
+    _reset_card_widgets(idx)
+    _record_usage(usage)
+    return changes
+
+
+# ========== RESULT CACHE ==========
+
+@st.cache_resource(show_spinner=False)
+def get_result_cache():
+    return ResultCache(
+        st.secrets.get("RESULT_CACHE_PATH", os.path.join(".cache", "generations.sqlite3")),
+        ttl=float(st.secrets.get("RESULT_CACHE_TTL", 7 * 24 * 3600)),
+        max_entries=int(st.secrets.get("RESULT_CACHE_MAX_ENTRIES", 500)),
+        max_bytes=int(st.secrets.get("RESULT_CACHE_MAX_BYTES", 50 * 1024 * 1024)),
+    )
 
 
 # ========== PBI CARD ==========
@@ -897,7 +1696,7 @@ def render_pbi_card(pbi, idx, total, default_iteration="", default_area="", defa
     """, height=80)
 
     # ── Action buttons ──
-    col_copy, col_push = st.columns([1, 1])
+    col_copy, col_push, col_refine = st.columns([1, 1, 1])
     with col_copy:
         st.components.v1.html(f"""
         <div style="margin:0;padding:0;">
@@ -944,6 +1743,7 @@ def render_pbi_card(pbi, idx, total, default_iteration="", default_area="", defa
                 c1, c2 = st.columns(2)
                 with c1:
                     iteration = st.text_input("Iteration Path", value=default_iteration, key=f"iter_{idx}")
+                    render_path_suggestions("iterations", iteration)
                     _modal_modules = st.session_state.get("_fetched_modules") or ["Registro y planificación horaria", "Vacaciones y ausencias"]
                     _emod_default = default_module if default_module in _modal_modules else _modal_modules[0]
                     endalia_module = st.selectbox("Endalia Module", _modal_modules,
@@ -956,6 +1756,7 @@ def render_pbi_card(pbi, idx, total, default_iteration="", default_area="", defa
                         key=f"varea_{idx}")
                 with c2:
                     area = st.text_input("Area Path", value=default_area, key=f"area_{idx}")
+                    render_path_suggestions("areas", area)
                     microservice = st.selectbox("Microservice Version",
                         ["Candidate", "Candidate+1"],
                         index=0 if default_microservice not in ["Candidate","Candidate+1"]
@@ -980,17 +1781,20 @@ def render_pbi_card(pbi, idx, total, default_iteration="", default_area="", defa
                         _iteration = st.session_state.get("default_iteration", "")
                         _members = []
                         if _team and _iteration and _iteration != "SWArea":
-                            _members = fetch_sprint_members(_pat, _org, _proj, _team, _iteration)
+                            _members = fetch_sprint_load(_pat, _org, _proj, _team, _iteration)
 
                         if not _members and _team:
-                            for _t in [_team, _team + " Team"]:
-                                _members = fetch_team_members(_pat, _org, _proj, team=_t)
-                                if _members:
-                                    break
+                            _members = fetch_team_members(_pat, _org, _proj, team=_team)
                         _member_names = ["— Sin asignar —"] + [m["name"] for m in _members]
                         _member_map = {"— Sin asignar —": ""} | {m["name"]: m["uniqueName"] for m in _members}
+                        _member_load = {m["name"]: m.get("load") for m in _members}
+                        st.session_state.setdefault("_task_member_map", {}).update(_member_map)
 
                         st.markdown("**Tasks**")
+                        _suggested = least_loaded(_members)
+                        if _suggested:
+                            st.caption(f"💡 Menos cargado en el sprint: **{_suggested['name']}** "
+                                       f"({_suggested['remaining']:g} h pendientes · {_suggested['load']:g} días)")
                         for t in range(int(num_tasks)):
                             tc1, tc2 = st.columns([3, 2])
                             with tc1:
@@ -1000,6 +1804,7 @@ def render_pbi_card(pbi, idx, total, default_iteration="", default_area="", defa
                             with tc2:
                                 selected_name = st.selectbox(f"Asignar a {t+1}",
                                     _member_names, key=f"task_assignee_{idx}_{t}",
+                                    format_func=lambda n: f"{n} · {_member_load[n]:g} d" if _member_load.get(n) is not None else n,
                                     label_visibility="collapsed")
                                 task_assignees.append(_member_map.get(selected_name, ""))
 
@@ -1013,30 +1818,54 @@ def render_pbi_card(pbi, idx, total, default_iteration="", default_area="", defa
                                 id_match = re.search(r'(\d+)/?$', parent.strip())
                                 if id_match:
                                     parent_id = int(id_match.group(1))
-                            result = push_pbi_to_azure(pbi,
+                            target = dict(
                                 iteration_path=iteration if iteration.strip() else None,
                                 area_path=area if area.strip() else None,
-                                parent_id=parent_id, figma_b64=figma_b64,
-                                figma_link=figma_link, existing_id=existing_id,
-                                endalia_module=endalia_module, microservice=microservice,
-                                value_area=value_area)
-                            pbi_url = f"https://dev.azure.com/{get_org()}/{get_project()}/_workitems/edit/{result.id}"
-                            st.success(f"✅ PBI {'actualizado' if existing_id else 'creado'} — **#{result.id}** — [Abrir ↗]({pbi_url})")
-                            st.session_state[pushed_key] = result.id
-
-                            if mode == "Crear nuevo PBI" and create_tasks and num_tasks > 0:
-                                with st.spinner(f"Creando {int(num_tasks)} task(s)..."):
-                                    conn = get_azure_connection()
-                                    wit_client = conn.clients.get_work_item_tracking_client()
-                                    task_ids = create_child_tasks(wit_client,
-                                        project=get_project(),
-                                        pbi_id=result.id, task_titles=task_titles,
-                                        iteration_path=iteration if iteration.strip() else None,
-                                        area_path=area if area.strip() else None,
-                                        assignees=task_assignees)
-                                    st.success(f"✅ {len(task_ids)} task(s) — IDs: {', '.join(f'**{t}**' for t in task_ids)}")
+                                parent_id=parent_id, endalia_module=endalia_module,
+                                microservice=microservice, value_area=value_area)
+                            if existing_id:
+                                pbi_id = push_pbi_to_azure(pbi, figma_b64=figma_b64, figma_link=figma_link,
+                                                           existing_id=existing_id, **target).id
+                                task_ids, queued = [], False
+                            else:
+                                # Journaled: clicking again after a failure resumes instead of duplicating
+                                with_tasks = create_tasks and num_tasks > 0
+                                pbi_id, task_ids, queued = push_pbi_journaled(pbi, target, figma_b64, figma_link,
+                                    task_titles if with_tasks else (), task_assignees if with_tasks else ())
+                            if queued:
+                                st.warning("📤 Azure DevOps no responde: el push queda en cola y se reintentará automáticamente.")
+                            if pbi_id:
+                                pbi_url = f"https://dev.azure.com/{get_org()}/{get_project()}/_workitems/edit/{pbi_id}"
+                                st.success(f"✅ PBI {'actualizado' if existing_id else 'creado'} — **#{pbi_id}** — [Abrir ↗]({pbi_url})")
+                                st.session_state[pushed_key] = pbi_id
+                            if task_ids:
+                                st.success(f"✅ {len(task_ids)} task(s) — IDs: {', '.join(f'**{t}**' for t in task_ids)}")
                         except Exception as e:
                             st.error(f"Error: {e}")
+        if azure_available and not pushed_info:
+            _dup_area = (st.session_state.get(f"area_{idx}") or default_area).strip()
+            for dup_id, dup_title, score in find_duplicates(pbi, _dup_area):
+                dup_url = f"https://dev.azure.com/{get_org()}/{get_project()}/_workitems/edit/{dup_id}"
+                st.caption(f"⚠️ Posible duplicado ({score:.0%}): [#{dup_id} {dup_title}]({dup_url})")
+
+    with col_refine:
+        result_pbis = st.session_state.get("result", {}).get("pbis", [])
+        if idx < len(result_pbis) and result_pbis[idx] is pbi:
+            with st.popover("✨ Refinar este PBI", use_container_width=True):
+                instruction = st.text_area("¿Qué hay que cambiar?", key=f"refine_instr_{idx}", height=90,
+                    placeholder="Ej: añade la validación de fechas solapadas y quita la nota técnica sobre la API")
+                if st.button("✨ Aplicar solo a este PBI", key=f"refine_{idx}", type="primary",
+                             use_container_width=True, disabled=not instruction.strip()):
+                    with st.spinner("Refinando PBI..."):
+                        try:
+                            changes = refine_pbi_in_place(idx, instruction.strip())
+                            st.session_state[f"_refined_{idx}"] = (
+                                "PBI reescrito" if changes is None else f"{changes} cambio(s) aplicados")
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Error al refinar: {e}")
+        if st.session_state.get(f"_refined_{idx}"):
+            st.caption(f"✨ {st.session_state[f'_refined_{idx}']}")
 
     # ── Objective ──
     st.markdown(f"""
@@ -1286,13 +2115,14 @@ def render_login():
             with st.spinner("Verificando credenciales..."):
                 try:
                     test_url = f"https://dev.azure.com/{org}/_apis/projects?api-version=7.1"
-                    resp = requests.get(test_url, auth=("", pat), timeout=8)
+                    resp = azure_session(pat, org).get(test_url, timeout=8)
                     if resp.status_code == 200:
                         st.session_state["user_pat"] = pat
                         st.session_state["user_org"] = org
                         st.session_state["user_project"] = project
                         st.session_state.pop("_logged_out", None)
                         teams = fetch_teams(pat, org, project)
+                        warm_azure_metadata(pat, org, project)
                         if len(teams) == 1:
                             st.session_state["user_team"] = teams[0]
                         st.rerun()
@@ -1405,6 +2235,10 @@ with col_form:
     st.session_state["_fetched_modules"] = _modules
 
     if _pat and _org and _proj:
+        # No-op once warmed (login already does it); covers PATs configured in secrets
+        warm_azure_metadata(_pat, _org, _proj)
+        if st.session_state.get("default_iteration", "SWArea") != "SWArea":
+            fetch_sprint_load.prefetch(_pat, _org, _proj, _derived_team, st.session_state["default_iteration"])
         _area_paths = fetch_area_paths(_pat, _org, _proj)
         _iterations = fetch_iterations(_pat, _org, _proj, team=_derived_team)
     else:
@@ -1426,6 +2260,7 @@ with col_form:
         else:
             default_area = st.text_input("Area Path", key="default_area",
                 value=st.session_state.get("default_area", "SWArea\\Product\\Core\\CoreProduct1"))
+            render_path_suggestions("areas", default_area)
 
         # Re-derive team from current selection (may differ from saved)
         _m2 = re.search(r"CoreProduct(\d+)", default_area)
@@ -1446,10 +2281,14 @@ with col_form:
                 default_iteration = _iter_paths[_iter_labels.index(_selected_iter)]
                 st.session_state["default_iteration"] = default_iteration
             else:
-                st.caption("⚠️ No se pudieron cargar sprints — escribe la ruta manualmente")
+                if azure_degraded():
+                    st.caption("⏳ Azure DevOps está limitando peticiones — reintentando en segundo plano")
+                else:
+                    st.caption("⚠️ No se pudieron cargar sprints — escribe la ruta manualmente")
                 default_iteration = st.text_input("Iteration Path", key="default_iteration",
                     value=_saved_iter or "SWArea",
                     help="Ej: SWArea/2026/PRODUCT/Q2/IT7 25.05 - 14.06")
+                render_path_suggestions("iterations", default_iteration)
             st.caption(f"👥 Equipo derivado: **{_team_display}**")
 
         with dcol2:
@@ -1465,15 +2304,101 @@ with col_form:
                     ["Product improvement", "Roadmap", "Operations improvement"],
                     key="default_value_area")
 
+        st.checkbox("⚡ Mostrar cada PBI en cuanto se genera (streaming)", value=True, key="stream_generation",
+            help="Los PBIs aparecen uno a uno mientras Claude los escribe, sin esperar al documento completo")
+        st.checkbox("🔀 Features complejas: un PBI por petición en paralelo", value=False, key="fanout_generation",
+            help=f"Con descripciones de {FANOUT_MIN_CHARS}+ caracteres, primero se planifica la división y luego cada PBI se genera a la vez")
+        st.checkbox("🧠 Caché de prompt en Anthropic", value=True, key="prompt_caching",
+            help="Reutiliza el system prompt y las capturas entre regeneraciones de la misma feature")
+
         if st.button("🔄 Nuevo PBI — limpiar todo", use_container_width=True):
             for k in ["result", "figma_images", "uploaded_b64", "last_voice_text",
-                      "figma_url", "_last_module", "desc_input"]:
+                      "figma_url", "_last_module", "desc_input", "last_usage", "result_from_cache",
+                      "last_image_report", "_push_all_report"]:
                 st.session_state.pop(k, None)
             for k in list(st.session_state.keys()):
-                if k.startswith("pushed_"):
+                if k.startswith("pushed_") or k.startswith("_refined_"):
                     del st.session_state[k]
             st.rerun()
 
+    with st.expander("🩺 Estado del servicio", expanded=False):
+        _pool = anthropic_pool_status()
+        pc1, pc2, pc3, pc4 = st.columns(4)
+        pc1.metric("Peticiones", _pool["requests"])
+        pc2.metric("Conexiones nuevas", _pool["new_connections"])
+        pc3.metric("Reutilizadas", _pool["reused"])
+        pc4.metric("Abiertas / ociosas", f"{_pool['open']} / {_pool['idle']}")
+        st.caption(f"Cliente Anthropic compartido por todas las sesiones · activo desde hace {_pool['uptime_s'] // 60} min")
+        _md = get_metadata_cache().stats()
+        st.caption(f"🗂️ Metadatos Azure: {_md['hits']} aciertos · {_md['stale_hits']} servidos mientras se refrescaban · "
+                   f"{_md['misses']} cargas en primer plano · {_md['refreshes']} refrescos en segundo plano · "
+                   f"{_md['restored']} recuperados de disco")
+        _sf = get_single_flight().stats()
+        _coalesced = _md["coalesced"] + _sf["coalesced"] + _figma_exports()["coalesced"]
+        st.caption(f"🤝 Peticiones compartidas: {_coalesced} esperaron a una idéntica en curso "
+                   f"en vez de repetirla · {len(_access_grants())} acceso(s) PAT verificados")
+        _hc = get_http_cache().stats()
+        st.caption(f"♻️ Revalidación: {_hc['not_modified']} respuestas 304 sin cambios · {_hc['downloads']} descargas completas · "
+                   f"{_hc['stale_served']} servidas desde la última copia buena")
+        _az = azure_pool_status()
+        st.caption(f"🔌 Azure DevOps: {_az['requests']} peticiones · {_az['new_connections']} conexiones nuevas · "
+                   f"{_az['reused']} reutilizadas · {_az['clients']} cliente(s) por org/PAT")
+        st.caption(f"🚦 Limitación Azure: {_az['throttled']} respuestas 429/503 · {_az['delayed_s']:.0f} s de espera · "
+                   f"{_az['short_circuited']} peticiones evitadas con el circuito abierto"
+                   + (f" · ⚠️ {_az['open_circuits']} circuito(s) abierto(s)" if _az["open_circuits"] else ""))
+        _rc = get_result_cache().stats()
+        rc1, rc2, rc3 = st.columns(3)
+        rc1.metric("Caché: aciertos", _rc["hits"])
+        rc2.metric("Caché: fallos", _rc["misses"])
+        rc3.metric("Entradas", f"{_rc['entries']} · {_rc['bytes'] / 1024 / 1024:.1f} MB")
+        _ac = get_attachment_cache().stats()
+        st.caption(f"📎 Adjuntos reutilizados: {_ac['hits']} · subidos: {_ac['misses']} · "
+                   f"{_ac['entries']} en caché ({_ac['bytes'] / 1024 / 1024:.1f} MB)")
+        _sched = get_scheduler().snapshot()
+        sc1, sc2, sc3, sc4 = st.columns(4)
+        sc1.metric("En cola", f"{_sched['queued']} ({_sched['users_waiting']} PMs)")
+        sc2.metric("En curso", _sched["in_flight"])
+        sc3.metric("429 / reintentos", f"{_sched['throttled']} / {_sched['retries']}")
+        sc4.metric("Fallidas", _sched["failed"])
+        st.caption(f"Margen actual: {_sched['requests_available']} peticiones · {_sched['tokens_available']:,} tokens de entrada por minuto")
+
+        st.markdown("**⏱️ Latencias (últimos 7 días)**")
+        # Reading the telemetry is not free: only when asked for, not on every rerun
+        if st.toggle("Mostrar latencias", key="show_latencies"):
+            _records = get_telemetry().read(since=time.time() - 7 * 24 * 3600)
+            _op_labels = {"generate": "Generación", "refine": "Refinar PBI", "figma_export": "Export Figma",
+                          "azure_push": "Push Azure", "azure_tasks": "Tasks Azure",
+                          "azure_push_all": "Push en lote Azure"}
+            _op = st.selectbox("Operación", list(_op_labels), format_func=_op_labels.get, key="metrics_op",
+                               label_visibility="collapsed")
+            _op_records = [r for r in _records if r.get("op") == _op]
+            _lat = [r["latency_s"] for r in _op_records if r.get("latency_s") is not None]
+            mc1, mc2, mc3, mc4 = st.columns(4)
+            mc1.metric("Llamadas", len(_op_records))
+            mc2.metric("p50", f"{telemetry.percentile(_lat, 50) or 0:.1f} s")
+            mc3.metric("p95", f"{telemetry.percentile(_lat, 95) or 0:.1f} s")
+            if _op == "generate":
+                _ttft = [r["ttft_s"] for r in _op_records if r.get("ttft_s") is not None]
+                mc4.metric("TTFT p50", f"{telemetry.percentile(_ttft, 50) or 0:.1f} s")
+                st.caption(f"Tokens — entrada: {sum(r.get('input_tokens', 0) for r in _op_records):,} · "
+                           f"salida: {sum(r.get('output_tokens', 0) for r in _op_records):,} · "
+                           f"caché leída: {sum(r.get('cache_read_tokens', 0) for r in _op_records):,} · "
+                           f"reintentos: {sum(r.get('retries', 0) for r in _op_records)} · "
+                           f"JSON recuperado: {sum(1 for r in _op_records if r.get('parse_fallback'))}")
+            else:
+                mc4.metric("Errores", sum(1 for r in _op_records if not r.get("ok", True)))
+            _series = telemetry.latency_series(_op_records)
+            if _series:
+                st.line_chart({
+                    "hora": [time.strftime("%d/%m %H:00", time.localtime(s[0])) for s in _series],
+                    "p50 (s)": [s[1] for s in _series],
+                    "p95 (s)": [s[2] for s in _series],
+                }, x="hora", height=180)
+            st.download_button("⬇️ Métricas (formato Prometheus)", get_telemetry().prometheus(),
+                               file_name="metrics.txt", mime="text/plain", use_container_width=True)
+        if st.secrets.get("METRICS_PORT"):
+            st.caption(f"Endpoint para scraping: `:{st.secrets['METRICS_PORT']}/metrics`")
+
     # ── Main form ──
     with st.container(border=True):
         c1, c2 = st.columns(2)
@@ -1501,7 +2426,7 @@ with col_form:
             st.caption("")
         elif desc_len < 80:
             st.caption(f"🟢 Cambio puntual — 1 PBI esperado · {desc_len} caracteres")
-        elif desc_len < 300:
+        elif desc_len < FANOUT_MIN_CHARS:
             st.caption(f"🟡 Feature media — 1-2 PBIs · {desc_len} caracteres")
         else:
             st.caption(f"🔴 Feature compleja — 2+ PBIs · {desc_len} caracteres")
@@ -1534,16 +2459,15 @@ with col_form:
                     if file_key:
                         st.success("✅ Archivo detectado")
                         if st.button("📸 Exportar desde Figma"):
-                            with st.spinner("Exportando..."):
-                                if not node_ids:
-                                    st.warning("No se detectó nodo en la URL.")
+                            if not node_ids:
+                                st.warning("No se detectó nodo en la URL.")
+                            else:
+                                figma_images = export_figma_with_progress(file_key, node_ids)
+                                if figma_images:
+                                    st.session_state["figma_images"] = figma_images
+                                    st.success(f"✅ {len(figma_images)} captura(s)")
                                 else:
-                                    figma_images = get_figma_images(file_key, node_ids, st.secrets["FIGMA_TOKEN"])
-                                    if figma_images:
-                                        st.session_state["figma_images"] = figma_images
-                                        st.success(f"✅ {len(figma_images)} captura(s)")
-                                    else:
-                                        st.error("No se pudo exportar.")
+                                    st.error("No se pudo exportar.")
                         if "figma_images" in st.session_state and st.session_state["figma_images"]:
                             for i, img in enumerate(st.session_state["figma_images"]):
                                 st.image(base64.b64decode(img["data"]), caption=f"Captura {i+1}", use_container_width=True)
@@ -1551,11 +2475,10 @@ with col_form:
                             if extra_nodes and st.button("➕ Añadir"):
                                 extra_key, extra_ids = parse_figma_url(extra_nodes)
                                 if extra_key and extra_ids:
-                                    with st.spinner("Exportando..."):
-                                        extra_images = get_figma_images(extra_key, extra_ids, st.secrets["FIGMA_TOKEN"])
-                                        if extra_images:
-                                            st.session_state["figma_images"].extend(extra_images)
-                                            st.rerun()
+                                    extra_images = export_figma_with_progress(extra_key, extra_ids)
+                                    if extra_images:
+                                        st.session_state["figma_images"].extend(extra_images)
+                                        st.rerun()
                     else:
                         st.error("URL no válida.")
             else:
@@ -1571,11 +2494,33 @@ with col_form:
                         st.image(f, caption=f"Captura {i+1}", width=100)
 
         st.markdown("")
+        st.checkbox("♻️ Forzar regeneración (ignorar resultados en caché)", key="force_regenerate")
         generate_btn = st.button("🚀 Generar PBIs", type="primary", use_container_width=True)
 
 
 # ========== PROCESS ==========
 
+def _card_defaults():
+    return dict(
+        default_iteration=st.session_state.get("default_iteration", ""),
+        default_area=st.session_state.get("default_area", ""),
+        default_module=st.session_state.get("default_module", "Registro y planificación horaria"),
+        default_microservice=st.session_state.get("default_microservice", "Candidate"),
+        default_value_area=st.session_state.get("default_value_area", "Product improvement"))
+
+
+def _card_target(i, defaults, parent_id=None):
+    """push_pbi_to_azure keyword arguments from card i's settings, falling back to the sidebar defaults."""
+    card_parent = re.search(r'(\d+)/?$', (st.session_state.get(f"parent_{i}") or "").strip())
+    return dict(
+        iteration_path=(st.session_state.get(f"iter_{i}") or defaults["default_iteration"]).strip() or None,
+        area_path=(st.session_state.get(f"area_{i}") or defaults["default_area"]).strip() or None,
+        parent_id=int(card_parent.group(1)) if card_parent else parent_id,
+        endalia_module=st.session_state.get(f"emodule_{i}") or defaults["default_module"],
+        microservice=st.session_state.get(f"msvc_{i}") or defaults["default_microservice"],
+        value_area=st.session_state.get(f"varea_{i}") or defaults["default_value_area"])
+
+
 uploaded_files = uploaded_files if 'uploaded_files' in dir() else []
 
 if generate_btn:
@@ -1600,11 +2545,53 @@ if generate_btn:
                 all_images.append({"data": b64, "media_type": f.type or "image/png"})
                 uploaded_b64_list.append(b64)
             st.session_state["uploaded_b64"] = uploaded_b64_list
+        cache = get_result_cache()
+        cache_key = generation_cache_key(module, feature, role, description, context, all_images)
+        cached = None
+        if not st.session_state.get("force_regenerate"):
+            with get_telemetry().timed("result_cache") as rec:
+                cached = cache.get(cache_key)
+                rec["hit"] = bool(cached)
+        if cached:
+            st.session_state["result"] = cached
+            st.session_state["result_from_cache"] = True
+            st.session_state.pop("last_usage", None)
+            st.rerun()
         with col_results:
             with st.spinner("Analizando y generando PBIs..."):
                 try:
-                    result = generate_pbis(module, feature, role, description, context, all_images)
+                    # Cache key is computed on the original captures; preprocessing only runs on a miss
+                    all_images, image_report = image_prep.prepare_images(all_images)
+                    st.session_state["last_image_report"] = image_report
+                    use_cache = st.session_state.get("prompt_caching", True)
+                    fanout = st.session_state.get("fanout_generation", False) and len(description) >= FANOUT_MIN_CHARS
+                    if fanout or st.session_state.get("stream_generation", True):
+                        stream_box = st.container()
+
+                        def _show_summary(summary):
+                            if summary:
+                                stream_box.info(f"💡 {summary}")
+
+                        def _show_pbi(pbi, i):
+                            # Read-only preview: the editable cards, and their widget keys, only
+                            # exist once the result is final
+                            with stream_box:
+                                with st.expander(f"US {i+1} — {pbi.get('title', '')}", expanded=True):
+                                    try:
+                                        st.markdown(_build_pbi_html_body(pbi), unsafe_allow_html=True)
+                                    except KeyError:
+                                        st.markdown(f"**{pbi.get('title', '')}**")
+
+                        generate_fn = generate_pbis_fanout if fanout else generate_pbis_stream
+                        result = generate_fn(module, feature, role, description, context, all_images,
+                            on_summary=_show_summary, on_pbi=_show_pbi, use_cache=use_cache)
+                    else:
+                        result = generate_pbis(module, feature, role, description, context, all_images,
+                            use_cache=use_cache)
+                    if not st.session_state.get("last_generation_partial"):
+                        cache.put(cache_key, result)
                     st.session_state["result"] = result
+                    st.session_state["result_from_cache"] = False
                     st.rerun()
                 except Exception as e:
                     st.error(f"Error al generar: {e}")
@@ -1613,6 +2600,7 @@ if generate_btn:
 # ========== DISPLAY RESULTS ==========
 
 with col_results:
+    flush_outbox()
     if "result" in st.session_state:
         result = st.session_state["result"]
         n = len(result["pbis"])
@@ -1623,17 +2611,75 @@ with col_results:
         with rc2:
             st.markdown(f"<div style='background:#2563EB;color:white;border-radius:20px;padding:4px 14px;font-size:13px;font-weight:600;text-align:center;'>{n} PBI{'s' if n!=1 else ''}</div>", unsafe_allow_html=True)
 
+        usage = st.session_state.get("last_usage")
+        if st.session_state.get("result_from_cache"):
+            st.caption("⚡ Resultado recuperado de caché — marca «Forzar regeneración» para volver a llamar a Claude")
+        elif usage:
+            st.caption(f"🔢 Tokens — entrada: {usage['input']:,} · salida: {usage['output']:,} · "
+                       f"caché leída: {usage['cache_read']:,} · caché creada: {usage['cache_creation']:,}")
+            img_report = st.session_state.get("last_image_report")
+            if img_report and img_report["captures"]:
+                extra = f" · {img_report['duplicates']} duplicada(s) descartada(s)" if img_report["duplicates"] else ""
+                extra += f" · {img_report['tiles']} recorte(s) de capturas largas" if img_report["tiles"] else ""
+                st.caption(f"🖼️ Capturas: {img_report['bytes_before'] / 1024:,.0f} KB → {img_report['bytes_after'] / 1024:,.0f} KB · "
+                           f"~{img_report['tokens_before']:,} → ~{img_report['tokens_after']:,} tokens de imagen{extra}")
+
         if result.get("summary"):
             st.info(f"💡 {result['summary']}")
 
+        pending = [i for i in range(n) if not st.session_state.get(f"pushed_{i}")]
+        if pending and (st.session_state.get("user_pat") or st.secrets.get("AZURE_PAT")):
+            with st.popover(f"🚀 Push de todos los PBIs pendientes ({len(pending)})", use_container_width=True):
+                st.caption("Se crean en una sola petición por lotes, con sus tasks y el enlace al Feature. "
+                           "Usa la configuración de cada tarjeta (iteración, área, módulo, tasks).")
+                all_parent = st.text_input("Parent Feature ID para las tarjetas sin uno (opcional)", placeholder="Ej: 177040", key="push_all_parent")
+                all_tasks = st.checkbox("Crear una task por PBI si la tarjeta no tiene tasks configuradas", key="push_all_tasks")
+                if st.button("✅ Crear todos en Azure", key="push_all", type="primary", use_container_width=True):
+                    defaults = _card_defaults()
+                    parent_id = None
+                    id_match = re.search(r'(\d+)/?$', all_parent.strip()) if all_parent else None
+                    if id_match:
+                        parent_id = int(id_match.group(1))
+                    member_map = st.session_state.get("_task_member_map", {})
+                    tasks = []
+                    for i in pending:
+                        if st.session_state.get(f"create_tasks_{i}"):
+                            tasks.append([(st.session_state.get(f"task_title_{i}_{t}", result["pbis"][i]["title"]),
+                                           member_map.get(st.session_state.get(f"task_assignee_{i}_{t}", ""), ""))
+                                          for t in range(int(st.session_state.get(f"num_tasks_{i}", 1)))])
+                        else:
+                            tasks.append([(result["pbis"][i]["title"], "")] if all_tasks else [])
+                    figma_b64 = [img.get("data", "") for img in st.session_state.get("figma_images", [])]
+                    figma_b64 += st.session_state.get("uploaded_b64", [])
+                    with st.spinner(f"Enviando {len(pending)} PBI(s) a Azure DevOps..."):
+                        try:
+                            # Card-level settings win over the sidebar defaults, as in the single push
+                            outcomes = push_all_pbis_to_azure([result["pbis"][i] for i in pending],
+                                [_card_target(i, defaults, parent_id) for i in pending],
+                                figma_b64=figma_b64, figma_link=st.session_state.get("figma_url"), tasks=tasks)
+                            st.session_state["_push_all_report"] = []
+                            for i, outcome in zip(pending, outcomes):
+                                if outcome["id"]:
+                                    st.session_state[f"pushed_{i}"] = outcome["id"]
+                                task_errors = [t["error"] for t in outcome["tasks"] if t and t["error"]]
+                                st.session_state["_push_all_report"].append(
+                                    (i, outcome["id"], outcome["error"] or "; ".join(task_errors),
+                                     [t["id"] for t in outcome["tasks"] if t and t["id"]], outcome["queued"]))
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"Error: {e}")
+        for i, pbi_id, error, task_ids, queued in st.session_state.get("_push_all_report", []):
+            if queued:
+                st.warning(f"US {i+1}: 📤 Azure DevOps no responde, queda en cola y se reintentará automáticamente")
+            elif error:
+                st.error(f"US {i+1}: {error}")
+            else:
+                tasks_txt = f" · tasks {', '.join(f'#{t}' for t in task_ids)}" if task_ids else ""
+                st.caption(f"✅ US {i+1} → [#{pbi_id}](https://dev.azure.com/{get_org()}/{get_project()}/_workitems/edit/{pbi_id}){tasks_txt}")
+
         for i, pbi in enumerate(result["pbis"]):
             with st.expander(f"{'✅ ' if st.session_state.get(f'pushed_{i}') else ''}US {i+1}/{n} — {pbi['title']}", expanded=True):
-                render_pbi_card(pbi, i, n,
-                    default_iteration=st.session_state.get("default_iteration", ""),
-                    default_area=st.session_state.get("default_area", ""),
-                    default_module=st.session_state.get("default_module", "Registro y planificación horaria"),
-                    default_microservice=st.session_state.get("default_microservice", "Candidate"),
-                    default_value_area=st.session_state.get("default_value_area", "Product improvement"))
+                render_pbi_card(pbi, i, n, **_card_defaults())
     else:
         st.markdown("""
         <div class="empty-panel">
@@ -0,0 +1,330 @@
+"""
+Persistent caches in front of Azure DevOps.
+
+AttachmentCache remembers which capture bytes were already uploaded as work
+item attachments, so pushing several PBIs from the same prototype (or updating
+one twice) reuses the attachment URL instead of uploading the image again.
+Entries are scoped by organization and project, since an attachment URL is
+only readable inside the project that owns it.
+
+MetadataCache holds teams, area paths, sprints and members with
+stale-while-revalidate semantics: a background worker refreshes entries
+before they expire, and an expired entry is still served while it is being
+refreshed, so the render path never waits on Azure once a value is known.
+Given a path, its values are also kept in SQLite, so after a restart they are
+served straight away and revalidated in the background.
+
+SingleFlight collapses identical concurrent loads into one: when ten sessions
+ask for the same key at once, one request goes out and the others wait for its
+result. MetadataCache loads through it.
+
+HttpCache stores the last body of each Azure GET together with its ETag /
+Last-Modified and sends them back as If-None-Match / If-Modified-Since, so a
+refresh whose data did not change is answered with an empty 304. While Azure
+is throttling or down, the stored body is served as last-known-good data.
+"""
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class AttachmentCache:
+    """SQLite map of (org, project, sha256 of the bytes) → attachment URL."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS attachments (
+            org TEXT NOT NULL, project TEXT NOT NULL, digest TEXT NOT NULL,
+            url TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL,
+            PRIMARY KEY (org, project, digest))""")
+        self._db.commit()
+
+    def get(self, org, project, digest):
+        with self._lock:
+            row = self._db.execute("SELECT url FROM attachments WHERE org = ? AND project = ? AND digest = ?",
+                                   (org.lower(), project.lower(), digest)).fetchone()
+            if row:
+                self.hits += 1
+                return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, org, project, digest, url, size):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?, ?)",
+                             (org.lower(), project.lower(), digest, url, size, time.time()))
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM attachments").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count, "bytes": size}
+
+
+class SingleFlight:
+    """Runs fn once per key at a time; concurrent callers with the same key share its result."""
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Only an Exception from fn is shared with the waiting callers. If the
+        leader is interrupted (a BaseException, e.g. Streamlit stopping its
+        session), the callers waiting on it start the call again themselves.
+        """
+        while True:
+            with self._lock:
+                call = self._inflight.get(key)
+                leader = call is None
+                if leader:
+                    call = self._inflight[key] = {"done": threading.Event(), "value": None, "error": None,
+                                                  "abandoned": False}
+                    self.calls += 1
+                else:
+                    self.coalesced += 1
+            if not leader:
+                call["done"].wait()
+                if call["abandoned"]:
+                    continue
+                if call["error"] is not None:
+                    raise call["error"]
+                return call["value"]
+            try:
+                call["value"] = fn()
+                return call["value"]
+            except Exception as e:
+                call["error"] = e
+                raise
+            except BaseException:
+                call["abandoned"] = True
+                raise
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                call["done"].set()
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._inflight)}
+
+
+class MetadataCache:
+    """
+    In-memory stale-while-revalidate cache. Only the very first read of a key
+    loads synchronously; afterwards, entries older than refresh_ratio × ttl are
+    refreshed in the background as long as someone read them in the last
+    idle_after seconds. A refresh that comes back empty never replaces a
+    non-empty value (the fetchers return [] when Azure is unreachable).
+    Concurrent loads of the same key, foreground or background, share one call.
+    """
+
+    def __init__(self, path=None, workers=4, refresh_ratio=0.8, idle_after=3600, tick=5.0):
+        self.refresh_ratio = refresh_ratio
+        self.idle_after = idle_after
+        self.tick = tick
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._entries = {}
+        self._refreshing = set()
+        self.restored = 0
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL, fetched REAL NOT NULL)""")
+            self._db.commit()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="azure-metadata")
+        threading.Thread(target=self._run, name="azure-metadata-refresh", daemon=True).start()
+
+    def get(self, key, loader, ttl):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key) or self._restore(key, loader, ttl)
+            if entry:
+                entry["read"] = now
+                entry["loader"] = loader
+                if now - entry["fetched"] < ttl:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+                    self._schedule(key)
+                return copy.deepcopy(entry["value"])
+            self.misses += 1
+        value = self._flights.do(key, lambda: self._store(key, loader(), loader, ttl, now))
+        return copy.deepcopy(value)
+
+    def prefetch(self, key, loader, ttl):
+        """Loads key in the background unless it is already cached."""
+        with self._lock:
+            if key in self._refreshing:
+                return
+            entry = self._entries.get(key) or self._restore(key, loader, ttl)
+            if entry:
+                if time.time() - entry["fetched"] >= ttl:
+                    self._schedule(key)
+                return
+            self._refreshing.add(key)
+        self._pool.submit(self._load, key, loader, ttl)
+
+    def _restore(self, key, loader, ttl):
+        """Caller holds the lock. Loads a persisted entry into memory; None if there is none."""
+        if self._db is None or not isinstance(key, str):
+            return None
+        row = self._db.execute("SELECT value, fetched FROM metadata WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        self.restored += 1
+        entry = {"value": json.loads(row[0]), "fetched": row[1], "ttl": ttl, "loader": loader, "read": 0}
+        self._entries[key] = entry
+        return entry
+
+    def _store(self, key, value, loader, ttl, read):
+        """Returns the value now cached for key."""
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous and previous["value"] and not value:
+                return previous["value"]
+            fetched = time.time()
+            self._entries[key] = {"value": value, "fetched": fetched, "ttl": ttl,
+                                  "loader": loader, "read": max(read, previous["read"] if previous else 0)}
+            if self._db is not None and isinstance(key, str):
+                self._db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)",
+                                 (key, json.dumps(value, ensure_ascii=False), fetched))
+                self._db.commit()
+            return value
+
+    def _load(self, key, loader, ttl):
+        try:
+            self._flights.do(key, lambda: self._store(key, loader(), loader, ttl, 0))
+            with self._lock:
+                self.refreshes += 1
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _schedule(self, key):
+        """Caller holds the lock."""
+        if key in self._refreshing:
+            return
+        entry = self._entries[key]
+        self._refreshing.add(key)
+        self._pool.submit(self._load, key, entry["loader"], entry["ttl"])
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            now = time.time()
+            with self._lock:
+                for key, entry in list(self._entries.items()):
+                    if now - entry["read"] > self.idle_after:
+                        continue
+                    if now - entry["fetched"] >= entry["ttl"] * self.refresh_ratio:
+                        self._schedule(key)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses,
+                    "refreshes": self.refreshes, "restored": self.restored, "entries": len(self._entries),
+                    "coalesced": self._flights.coalesced,
+                    "refreshing": len(self._refreshing)}
+
+
+class StoredResponse:
+    """The part of requests.Response the fetchers use, rebuilt from a cached body."""
+
+    status_code = 200
+    from_cache = True
+
+    def __init__(self, body):
+        self._body = body
+
+    def json(self):
+        return json.loads(self._body)
+
+
+class HttpCache:
+    """SQLite store of GET bodies with their validators, keyed by URL and credential scope."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.not_modified = 0
+        self.downloads = 0
+        self.stale_served = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS http (
+            key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT,
+            body TEXT NOT NULL, fetched REAL NOT NULL)""")
+        self._db.commit()
+
+    def get(self, session, url, scope, timeout=10):
+        """
+        Conditional GET through `session`. `scope` separates credentials that may
+        see different data for the same URL (e.g. a hash of the PAT).
+        """
+        key = content_hash(f"{scope}\n{url}".encode("utf-8"))
+        with self._lock:
+            row = self._db.execute("SELECT etag, last_modified, body FROM http WHERE key = ?", (key,)).fetchone()
+        headers = {}
+        if row and row[0]:
+            headers["If-None-Match"] = row[0]
+        if row and row[1]:
+            headers["If-Modified-Since"] = row[1]
+        try:
+            resp = session.get(url, headers=headers, timeout=timeout)
+        except Exception:
+            if not row:
+                raise
+            return self._stale(row)
+        if row and (resp.status_code == 429 or resp.status_code >= 500):
+            return self._stale(row)
+        if resp.status_code == 304 and row:
+            with self._lock:
+                self.not_modified += 1
+                self._db.execute("UPDATE http SET fetched = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+            return StoredResponse(row[2])
+        with self._lock:
+            self.downloads += 1
+            etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+            if resp.status_code == 200:
+                # Bodies without validators are kept too, as last-known-good data
+                self._db.execute("INSERT OR REPLACE INTO http VALUES (?, ?, ?, ?, ?)",
+                                 (key, etag, last_modified, resp.text, time.time()))
+                self._db.commit()
+        return resp
+
+    def _stale(self, row):
+        with self._lock:
+            self.stale_served += 1
+        return StoredResponse(row[2])
+
+    def stats(self):
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM http").fetchone()[0]
+        return {"not_modified": self.not_modified, "downloads": self.downloads,
+                "stale_served": self.stale_served, "entries": count}
@@ -0,0 +1,177 @@
+"""
+Throttle-aware HTTP session for Azure DevOps.
+
+Azure DevOps answers global consumption limits (TSTUs) with Retry-After and
+X-RateLimit-* headers, and eventually with 429. ThrottledSession honours them:
+once Azure asks us to back off, every request on the session waits behind the
+same gate instead of firing (and being rejected) on its own, 429 / 503 are
+retried after the advertised delay, and repeated failures open a circuit
+breaker that fails fast for a cool-down period so callers can serve their
+last-known-good data instead of piling onto a degraded service.
+"""
+import email.utils
+import threading
+import time
+
+import requests
+
+RETRY_STATUSES = (429, 503)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Azure is considered down; the request was not sent."""
+
+
+class ThrottledError(requests.ConnectionError):
+    """Azure asked to wait longer than the caller is willing to."""
+
+
+def _retry_after(resp):
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ThrottledSession(requests.Session):
+    """
+    requests.Session with a shared back-off gate, Retry-After handling and a
+    circuit breaker. on_event(kind, **fields) is called for "throttled",
+    "delayed" and "circuit_open" events (for metrics).
+    """
+
+    def __init__(self, max_wait=30.0, max_retries=3, failure_threshold=5, cooldown=60.0, on_event=None):
+        super().__init__()
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.on_event = on_event
+        self.throttled = 0
+        self.delayed_s = 0.0
+        self.short_circuited = 0
+        self._blocked_until = 0.0
+        self._failures = 0
+        self._open_until = 0.0
+        self._probe = False
+        self._lock = threading.Lock()
+
+    # ---------- circuit breaker ----------
+
+    @property
+    def circuit(self):
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return "closed"
+            return "open" if time.monotonic() < self._open_until else "half-open"
+
+    def _admit(self):
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return
+            if time.monotonic() >= self._open_until and not self._probe:
+                # Half-open: one request probes whether Azure is back
+                self._probe = True
+                return
+            self.short_circuited += 1
+        raise CircuitOpenError("Azure DevOps no responde; se reintentará en unos segundos")
+
+    def _record(self, ok):
+        with self._lock:
+            self._probe = False
+            if ok:
+                self._failures = 0
+                return
+            self._failures += 1
+            opened = self._failures >= self.failure_threshold
+            if opened:
+                self._open_until = time.monotonic() + self.cooldown
+        if opened:
+            self._emit("circuit_open", cooldown_s=self.cooldown)
+
+    # ---------- rate limits ----------
+
+    def _emit(self, kind, **fields):
+        if self.on_event:
+            try:
+                self.on_event(kind, **fields)
+            except Exception:
+                pass
+
+    def _block(self, seconds):
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def _observe(self, resp):
+        """Moves the gate according to the rate-limit headers of any response."""
+        retry_after = _retry_after(resp)
+        if retry_after:
+            self._block(retry_after)
+        if resp.headers.get("X-RateLimit-Remaining") == "0":
+            try:
+                self._block(max(0.0, float(resp.headers.get("X-RateLimit-Reset", 0)) - time.time()))
+            except ValueError:
+                pass
+        if resp.headers.get("X-RateLimit-Delay"):
+            # Azure already slowed this request down by that much
+            try:
+                delay = float(resp.headers["X-RateLimit-Delay"])
+            except ValueError:
+                delay = 0.0
+            self._emit("delayed", delay_s=delay, resource=resp.headers.get("X-RateLimit-Resource", ""))
+        return retry_after
+
+    def _wait_gate(self):
+        with self._lock:
+            wait = self._blocked_until - time.monotonic()
+        if wait <= 0:
+            return
+        if wait > self.max_wait:
+            with self._lock:
+                self._probe = False
+            raise ThrottledError(f"Azure DevOps pide esperar {wait:.0f} s")
+        with self._lock:
+            self.delayed_s += wait
+        time.sleep(wait)
+
+    def request(self, method, url, *args, **kwargs):
+        self._admit()
+        attempt = 0
+        while True:
+            self._wait_gate()
+            try:
+                resp = super().request(method, url, *args, **kwargs)
+            except Exception:
+                # Any failure to get a response (ChunkedEncodingError, InvalidURL...) counts,
+                # and frees the half-open probe slot
+                self._record(ok=False)
+                raise
+            except BaseException:
+                # The caller was interrupted: not Azure's fault, but the probe slot must be freed
+                with self._lock:
+                    self._probe = False
+                raise
+            retry_after = self._observe(resp)
+            if resp.status_code not in RETRY_STATUSES:
+                self._record(ok=resp.status_code < 500)
+                return resp
+            with self._lock:
+                self.throttled += 1
+            self._emit("throttled", status=resp.status_code, retry_after_s=retry_after or 0)
+            if attempt >= self.max_retries:
+                self._record(ok=False)
+                return resp
+            if not retry_after:
+                self._block(min(self.max_wait, 2 ** attempt))
+            attempt += 1
+
+    def stats(self):
+        return {"throttled": self.throttled, "delayed_s": round(self.delayed_s, 1),
+                "short_circuited": self.short_circuited, "circuit": self.circuit}
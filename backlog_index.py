@@ -0,0 +1,163 @@
+"""
+Local mirror of the existing backlog for duplicate detection.
+
+Work items of an area path are mirrored into SQLite and synced incrementally
+(only items changed since the last sync are downloaded). Titles and
+descriptions are indexed in memory as TF-IDF vectors behind an inverted index,
+so checking a generated PBI against thousands of existing ones touches only the
+items that share a term with it and never calls Azure.
+"""
+import html
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+# Minimum cosine similarity to flag an existing item as a possible duplicate
+DUPLICATE_THRESHOLD = 0.35
+# Titles weigh more than descriptions
+TITLE_WEIGHT = 3
+CLOSED_STATES = ("Removed",)
+# Terms are cut to this many characters, a poor man's Spanish stemmer
+STEM_LENGTH = 6
+
+STOPWORDS = set("""
+a al algo como con cual cuando de del desde donde el ella en entre es esta este esto
+hay la las le lo los mas mismo muy no o para pero por que se ser si sin sobre su sus
+tambien tiene todo un una uno unos unas y ya the and for with from that this
+""".split())
+
+
+def tokenize(text):
+    text = unicodedata.normalize("NFKD", html.unescape(re.sub(r"<[^>]+>", " ", text or "")))
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    # "solicitar" / "solicitud" and "exportar" / "exportación" share a term
+    return [w[:STEM_LENGTH] for w in re.findall(r"[a-z0-9]+", text) if len(w) > 2 and w not in STOPWORDS]
+
+
+def document_terms(title, text):
+    return Counter(tokenize(title) * TITLE_WEIGHT + tokenize(text))
+
+
+class BacklogIndex:
+    """SQLite mirror of work items per (org, project, area) plus an in-memory TF-IDF index."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS backlog_items (
+            org TEXT NOT NULL, project TEXT NOT NULL, id INTEGER NOT NULL,
+            area TEXT NOT NULL, title TEXT NOT NULL, text TEXT NOT NULL,
+            state TEXT, changed TEXT, PRIMARY KEY (org, project, id))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS backlog_sync (
+            org TEXT NOT NULL, project TEXT NOT NULL, area TEXT NOT NULL,
+            last_sync TEXT NOT NULL, PRIMARY KEY (org, project, area))""")
+        self._db.commit()
+        # (org, project) -> {"docs": {id: (area, title, Counter of terms)}, "postings": {term: set of ids}}
+        self._indexes = {}
+
+    # ---------- sync ----------
+
+    def last_sync(self, org, project, area):
+        with self._lock:
+            row = self._db.execute("SELECT last_sync FROM backlog_sync WHERE org = ? AND project = ? AND area = ?",
+                                   (org.lower(), project.lower(), area.lower())).fetchone()
+        return row[0] if row else None
+
+    def sync(self, org, project, area, changed_ids, fetch_items, batch_size=200):
+        """
+        Mirrors the items of `area`. changed_ids(since) returns the ids changed
+        after `since` (None on the first sync); fetch_items(ids) returns dicts
+        with id, area, title, text, state and changed for at most batch_size ids.
+        Returns the number of items updated.
+        """
+        started = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        ids = list(changed_ids(self.last_sync(org, project, area)))
+        items = []
+        for i in range(0, len(ids), batch_size):
+            items += fetch_items(ids[i:i + batch_size])
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO backlog_items VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [
+                (org.lower(), project.lower(), int(it["id"]), it.get("area", area), it.get("title", ""),
+                 it.get("text", ""), it.get("state"), it.get("changed")) for it in items])
+            self._db.execute("INSERT OR REPLACE INTO backlog_sync VALUES (?, ?, ?, ?)",
+                             (org.lower(), project.lower(), area.lower(), started))
+            self._db.commit()
+            index = self._indexes.get((org.lower(), project.lower()))
+            if index is not None:
+                for it in items:
+                    self._index_item(index, int(it["id"]), it.get("area", area), it.get("title", ""),
+                                     it.get("text", ""), it.get("state"))
+        return len(items)
+
+    # ---------- index ----------
+
+    def _index_item(self, index, item_id, area, title, text, state):
+        old = index["docs"].pop(item_id, None)
+        if old:
+            for term in old[2]:
+                index["postings"].get(term, set()).discard(item_id)
+        if state in CLOSED_STATES:
+            return
+        terms = document_terms(title, text)
+        index["docs"][item_id] = (area, title, terms)
+        for term in terms:
+            index["postings"].setdefault(term, set()).add(item_id)
+
+    def _index(self, org, project):
+        """Caller holds the lock. Builds the in-memory index from SQLite on first use."""
+        key = (org.lower(), project.lower())
+        if key not in self._indexes:
+            index = {"docs": {}, "postings": {}}
+            rows = self._db.execute("SELECT id, area, title, text, state FROM backlog_items WHERE org = ? AND project = ?",
+                                    key).fetchall()
+            for row in rows:
+                self._index_item(index, *row)
+            self._indexes[key] = index
+        return self._indexes[key]
+
+    def similar(self, org, project, area, title, text="", limit=3, threshold=DUPLICATE_THRESHOLD):
+        """[(id, title, score)] of items under `area` most similar to the given PBI."""
+        with self._lock:
+            index = self._index(org, project)
+            docs, postings = index["docs"], index["postings"]
+            n = len(docs)
+            if not n:
+                return []
+            idf = {}
+
+            def weight(term, tf):
+                if term not in idf:
+                    idf[term] = math.log((1 + n) / (1 + len(postings.get(term, ())))) + 1
+                return (1 + math.log(tf)) * idf[term]
+
+            query = {t: weight(t, tf) for t, tf in document_terms(title, text).items()}
+            query_norm = math.sqrt(sum(w * w for w in query.values()))
+            if not query_norm:
+                return []
+            candidates = set()
+            for term in query:
+                candidates |= postings.get(term, set())
+            area_prefix = area.lower().rstrip("\\")
+            scored = []
+            for item_id in candidates:
+                doc_area, doc_title, terms = docs[item_id]
+                if area_prefix and not (doc_area.lower() == area_prefix or doc_area.lower().startswith(area_prefix + "\\")):
+                    continue
+                vector = {t: weight(t, tf) for t, tf in terms.items()}
+                dot = sum(w * vector[t] for t, w in query.items() if t in vector)
+                norm = math.sqrt(sum(w * w for w in vector.values()))
+                score = dot / (query_norm * norm) if norm else 0
+                if score >= threshold:
+                    scored.append((item_id, doc_title, round(score, 2)))
+        return sorted(scored, key=lambda s: -s[2])[:limit]
+
+    def stats(self, org, project):
+        with self._lock:
+            index = self._index(org, project)
+            return {"items": len(index["docs"]), "terms": len(index["postings"])}
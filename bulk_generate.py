@@ -0,0 +1,225 @@
+"""
+Headless bulk PBI generation.
+
+Reads one feature request per line from a JSONL file and writes one result per
+line, using the same generation logic as the Streamlit app:
+
+    {"id": "time-reports", "module": "Time", "feature": "Reports", "role": "perfil RRHH",
+     "description": "...", "context": "...", "images": ["captures/report.png"]}
+
+Only "description" is required. "id" defaults to the line number.
+
+    python bulk_generate.py features.jsonl results.jsonl --concurrency 4
+    python bulk_generate.py features.jsonl results.jsonl --batch
+
+The output file doubles as the checkpoint: every finished line is appended and
+flushed as soon as it completes, and a re-run skips ids that already have a
+result (failed ids are retried). In --batch mode the submitted batch id is
+stored next to the output so a restart resumes polling instead of paying twice.
+"""
+import argparse
+import base64
+import json
+import mimetypes
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import anthropic
+
+import generation
+import image_prep
+
+
+def load_requests(path):
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            item.setdefault("id", str(n))
+            item["id"] = str(item["id"])
+            items.append(item)
+    return items
+
+
+def load_done(path):
+    """Ids whose latest record in the output file is a successful result."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Torn last line from a crash — that id is simply retried
+                continue
+            if "result" in record:
+                done.add(record["id"])
+            else:
+                done.discard(record["id"])
+    return done
+
+
+def load_images(paths, base_dir):
+    images = []
+    for p in paths or []:
+        full = p if os.path.isabs(p) else os.path.join(base_dir, p)
+        with open(full, "rb") as f:
+            data = base64.b64encode(f.read()).decode("utf-8")
+        images.append({"data": data, "media_type": mimetypes.guess_type(full)[0] or "image/png"})
+    return images
+
+
+def generation_args(item, base_dir, prepare=True):
+    """
+    Arguments of generation.generate for item. With prepare=False the images
+    are the original files, which is what the result cache key (like the
+    app's) is computed on.
+    """
+    images = load_images(item.get("images"), base_dir)
+    if prepare:
+        images, _ = image_prep.prepare_images(images)
+    return (item.get("module", ""), item.get("feature", ""), item.get("role", "perfil RRHH"),
+            item["description"], item.get("context", ""), images)
+
+
+class Checkpoint:
+    """Append-only JSONL writer; each record is flushed to disk before returning."""
+
+    def __init__(self, path):
+        self._f = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        with self._lock:
+            self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
+
+
+def run_concurrent(client, items, base_dir, checkpoint, concurrency, use_cache, cache):
+    def work(item):
+        raw_args = generation_args(item, base_dir, prepare=False)
+        key = generation.generation_cache_key(*raw_args)
+        if cache:
+            cached = cache.get(key)
+            if cached:
+                return cached
+        # Preprocessing only runs on a miss
+        images, _ = image_prep.prepare_images(raw_args[-1])
+        stats = generation.new_stats()
+        result, _ = generation.generate(client, *raw_args[:-1], images, use_cache=use_cache, stats=stats)
+        # As in the app, output recovered from a truncated document is not cached
+        if cache and not stats["parse_fallback"]:
+            cache.put(key, result)
+        return result
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(work, item): item["id"] for item in items}
+        for fut in as_completed(futures):
+            rid = futures[fut]
+            try:
+                checkpoint.write({"id": rid, "result": fut.result()})
+                print(f"✓ {rid}", file=sys.stderr)
+            except Exception as e:
+                failures += 1
+                checkpoint.write({"id": rid, "error": str(e)})
+                print(f"✗ {rid}: {e}", file=sys.stderr)
+    return failures
+
+
+def run_batch(client, items, base_dir, checkpoint, state_path, use_cache, poll_interval):
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+    pending_ids = {item["id"] for item in items}
+    if not state.get("batch_id") or not pending_ids.issubset(state.get("ids", [])):
+        batch = client.messages.batches.create(requests=[
+            # No continuations in a batch, so reserve the full budget up front
+            {"custom_id": item["id"], "params": generation.request_params(*generation_args(item, base_dir), use_cache=use_cache,
+                                                                          max_tokens=generation.MAX_TOKENS)}
+            for item in items
+        ])
+        state = {"batch_id": batch.id, "ids": sorted(pending_ids)}
+        with open(state_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        print(f"Batch {batch.id} enviado ({len(items)} peticiones)", file=sys.stderr)
+
+    batch_id = state["batch_id"]
+    while True:
+        batch = client.messages.batches.retrieve(batch_id)
+        if batch.processing_status == "ended":
+            break
+        counts = batch.request_counts
+        print(f"… {batch_id}: {counts.processing} en curso, {counts.succeeded} ok, {counts.errored} error", file=sys.stderr)
+        time.sleep(poll_interval)
+
+    failures = 0
+    for entry in client.messages.batches.results(batch_id):
+        if entry.custom_id not in pending_ids:
+            continue
+        try:
+            if entry.result.type != "succeeded":
+                raise RuntimeError(entry.result.type)
+            result, _ = generation.parse_pbis_tolerant(generation.response_text(entry.result.message))
+            checkpoint.write({"id": entry.custom_id, "result": result})
+        except Exception as e:
+            failures += 1
+            checkpoint.write({"id": entry.custom_id, "error": str(e)})
+    os.remove(state_path)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera PBIs en bloque a partir de un fichero JSONL.")
+    parser.add_argument("input", help="JSONL con una feature por línea")
+    parser.add_argument("output", help="JSONL de resultados (también sirve de checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=4, help="peticiones simultáneas (por defecto 4)")
+    parser.add_argument("--batch", action="store_true", help="enviar con la Message Batches API (asíncrono, más barato)")
+    parser.add_argument("--poll-interval", type=float, default=60, help="segundos entre consultas del batch")
+    parser.add_argument("--no-prompt-cache", action="store_true", help="desactivar la caché de prompt de Anthropic")
+    parser.add_argument("--result-cache", default=os.path.join(".cache", "generations.sqlite3"),
+                        help="caché de resultados compartida con la app ('' para desactivar)")
+    args = parser.parse_args(argv)
+
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if not api_key:
+        parser.error("define ANTHROPIC_API_KEY en el entorno")
+
+    items = load_requests(args.input)
+    done = load_done(args.output)
+    todo = [item for item in items if item["id"] not in done]
+    print(f"{len(items)} peticiones · {len(done)} ya hechas · {len(todo)} pendientes", file=sys.stderr)
+    if not todo:
+        return 0
+
+    client = anthropic.Anthropic(api_key=api_key)
+    base_dir = os.path.dirname(os.path.abspath(args.input))
+    use_cache = not args.no_prompt_cache
+    checkpoint = Checkpoint(args.output)
+    try:
+        if args.batch:
+            failures = run_batch(client, todo, base_dir, checkpoint, args.output + ".batch.json", use_cache, args.poll_interval)
+        else:
+            cache = None
+            if args.result_cache:
+                cache = generation.ResultCache(args.result_cache, ttl=7 * 24 * 3600, max_entries=500, max_bytes=50 * 1024 * 1024)
+            failures = run_concurrent(client, todo, base_dir, checkpoint, max(1, args.concurrency), use_cache, cache)
+    finally:
+        checkpoint.close()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
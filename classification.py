@@ -0,0 +1,93 @@
+"""
+Area and iteration paths as a trie.
+
+Azure DevOps returns classification nodes as a nested tree whose node paths
+include the structure segment ("\\SWArea\\Area\\Product\\Core"). Here they are
+flattened to the form work items use ("SWArea\\Product\\Core") and indexed by
+segment, so checking a path or listing the completions of what the user is
+typing costs O(depth) instead of a walk of the whole tree.
+"""
+
+SEPARATOR = "\\"
+STRUCTURE_SEGMENTS = ("Area", "Iteration")
+
+
+def node_path(node):
+    """Work item form of a classification node's path."""
+    parts = node.get("path", "").strip(SEPARATOR).split(SEPARATOR)
+    if len(parts) > 1 and parts[1] in STRUCTURE_SEGMENTS:
+        del parts[1]
+    return SEPARATOR.join(p for p in parts if p) or node.get("name", "")
+
+
+def flatten(node, path=None):
+    """Every path in the subtree rooted at node, parents before children."""
+    path = path or node_path(node)
+    paths = [path]
+    for child in node.get("children", []):
+        paths += flatten(child, f"{path}{SEPARATOR}{child['name']}")
+    return paths
+
+
+def _segments(path):
+    return [s for s in path.replace("/", SEPARATOR).split(SEPARATOR) if s]
+
+
+class PathTrie:
+    """Case-insensitive trie of classification paths."""
+
+    def __init__(self, paths=()):
+        self._root = {"children": {}, "path": None}
+        self._size = 0
+        for path in paths:
+            self.add(path)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, path):
+        node = self._root
+        for segment in _segments(path):
+            node = node["children"].setdefault(segment.lower(), {"children": {}, "path": None})
+        if node["path"] is None:
+            self._size += 1
+        node["path"] = path
+
+    def _find(self, segments):
+        node = self._root
+        for segment in segments:
+            node = node["children"].get(segment.lower())
+            if node is None:
+                return None
+        return node
+
+    def __contains__(self, path):
+        node = self._find(_segments(path))
+        return node is not None and node["path"] is not None
+
+    def canonical(self, path):
+        """The stored spelling of path, or None if it is not a known path."""
+        node = self._find(_segments(path))
+        return node["path"] if node else None
+
+    def children(self, path):
+        node = self._find(_segments(path))
+        return [c["path"] for c in node["children"].values() if c["path"]] if node else []
+
+    def complete(self, prefix, limit=10):
+        """
+        Known paths starting with prefix, shallowest first. The last segment of
+        prefix may be partial ("SWArea\\Prod" → "SWArea\\Product", ...).
+        """
+        segments = _segments(prefix)
+        complete_part = prefix.rstrip().endswith((SEPARATOR, "/"))
+        partial = "" if complete_part or not segments else segments.pop().lower()
+        node = self._find(segments)
+        if node is None:
+            return []
+        level = [c for key, c in sorted(node["children"].items()) if key.startswith(partial)]
+        results = []
+        while level and len(results) < limit:
+            results += [n["path"] for n in level if n["path"]]
+            level = [c for n in level for _, c in sorted(n["children"].items())]
+        return results[:limit]
@@ -0,0 +1,861 @@
+"""
+PBI generation core, independent of Streamlit.
+
+Holds the system prompt, prompt building, tolerant JSON parsing of the model
+output and the on-disk result cache, so both app.py and the bulk CLI
+(bulk_generate.py) run exactly the same generation logic.
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+
+SYSTEM_PROMPT = """Eres un experto en Product Management que genera Product Backlog Items (PBIs) completos y precisos para Azure DevOps.
+Tu audiencia son desarrolladores y QA que deben poder implementar y testear sin necesidad de preguntar al PM.
+El PBI es la fuente de verdad. Cada línea que escribas debe poder leerse de forma independiente y ser verificable.
+
+---
+
+## EL INPUT DEL USUARIO PUEDE SER
+
+- Texto breve e informal: estructura y completa la información.
+- Descripción larga de una feature: propón la división óptima en PBIs.
+- Capturas de pantalla o prototipo: analízalas exhaustivamente antes de escribir.
+
+---
+
+## FASE 1 — ANALIZAR EL PROTOTIPO (si hay capturas)
+
+Antes de escribir el PBI, analiza cada captura:
+
+1. Identifica todos los elementos visuales: títulos, etiquetas, placeholders, botones, chips, banners.
+2. Copia los textos literales exactos. No parafrasees.
+3. Clasifica cada control: tipo Soul, opciones disponibles, valor por defecto, si es obligatorio.
+4. Identifica comportamientos condicionales: qué aparece, desaparece o cambia al interactuar.
+5. Identifica banners y mensajes de error: tipo (info/warning/error) y condición de aparición.
+6. Detecta estados especiales: vacío, deshabilitado, solo lectura.
+7. Lo que no puedes ver: si hay estados que las capturas no cubren, márcalo con [⚠️ A CONFIRMAR] en tech_notes. NUNCA lo inventes.
+
+---
+
+## FASE 2 — DETECTAR DISCREPANCIAS
+
+Si hay descripción y capturas, compara y señala:
+- Contradicciones: la descripción contradice el prototipo.
+- Omisiones: elementos del prototipo no mencionados en la descripción.
+- Errores tipográficos: corrígelos en el PBI.
+Refleja el resultado en el campo "summary".
+
+---
+
+## REGLAS DE DIVISIÓN EN PBIs
+
+- Un cambio puntual o flujo simple = 1 PBI.
+- Divide solo cuando hay flujos claramente independientes con valor entregable por separado.
+- Justifica la decisión en "summary".
+
+---
+
+## HISTORIA DE USUARIO
+
+La historia describe una necesidad de negocio, no una pantalla ni una acción de UI.
+
+- "role": uno de los tres perfiles exactos de Endalia: Colaborador | Responsable | perfil RRHH. Si el PBI afecta a más de un perfil con experiencias distintas, debe dividirse en PBIs separados.
+- "when": contexto de negocio o momento del proceso. NO la ruta de navegación ni el nombre de la pantalla.
+- "then": resultado de negocio que el usuario obtiene. NO la descripción de la UI ni de los pasos.
+- "benefit": valor real para el usuario o la organización.
+
+Ejemplos de lo que NO debe aparecer en "then":
+❌ "puedo hacer clic en 'Añadir absentismos' y se abre un modal con checkboxes"
+✅ "puedo configurar qué tipos de absentismo aplican a cada política y bajo qué condiciones"
+
+---
+
+## ESPECIFICACIÓN FUNCIONAL
+
+La functional_spec es la fuente de verdad para el desarrollador. Debe estar estructurada por zonas de pantalla, con encabezados claros. No es un párrafo continuo.
+
+### Estructura obligatoria:
+
+Usa este patrón de encabezados en texto plano:
+
+[ZONA O COMPONENTE]
+  - Elemento, comportamiento o regla concreta
+
+Ejemplo:
+ÁREA PRINCIPAL
+  - Título de sección: 'Tipos de absentismo'
+  - Botón 'Añadir absentismos' (accent, tamaño M), esquina superior derecha, siempre visible
+  - Texto de ayuda '* Campos obligatorios', esquina superior derecha
+
+ESTADO VACÍO (sin tipos añadidos)
+  - Se muestra solo el título y el botón 'Añadir absentismos'
+  - No hay mensaje de estado vacío adicional
+
+### Reglas de contenido:
+
+- Textos literales siempre entre comillas dobles: "Añadir absentismos"
+- Nombres de campos y secciones entre comillas simples: 'Cantidad máxima'
+- Componentes Soul: usa SIEMPRE el nombre exacto del diccionario. No inventes variantes.
+- Comportamientos condicionales: especifica la condición exacta y el resultado exacto.
+- NO describas comportamientos estándar de Soul que el equipo ya conoce: hover, focus, disabled genérico, animaciones. Solo describe lo específico de esta feature.
+- NO incluyas comportamientos que no estén confirmados en el prototipo o la descripción. Si no estás seguro, usa [⚠️ A CONFIRMAR] en lugar de asumir.
+- NO describas implementación técnica (clases CSS, nombres de servicios, estructura de datos).
+- NO uses datos de ejemplo del prototipo como valores reales salvo que sean valores por defecto intencionales.
+
+---
+
+## DESIGN SYSTEM SOUL — COMPONENTES WEB
+
+Usa SIEMPRE los nombres exactos. No inventes componentes ni comportamientos que no estén aquí.
+
+### FEEDBACK
+
+**Alert** — banner informativo inline, NO flotante
+- Tipos: info (azul) | warning (amarillo) | error (rojo). NO existe success en Alert.
+- Una sola línea de texto. Uso: mensajes contextuales dentro de pantalla.
+- Nomenclatura: "banner Alert de tipo info/warning/error"
+
+**Toast** — notificación flotante temporal, esquina de pantalla
+- Subtipos: Toast Informative (solo lectura) | Toast Interactive (con link de acción)
+- Tipos: success | warning | error | info
+- Uso: confirmaciones de acciones (guardar, eliminar). NO para validaciones de formulario.
+
+**Chip Feedback** — etiqueta de estado, no interactiva
+- Tipos: success | info | warning | error | neutral
+- Nomenclatura: "chip de estado [tipo]"
+
+**Tooltip** — texto informativo al hover.
+
+### INPUTS DE FORMULARIO
+
+**Text Field Simple**
+- Errores: SOLO al salir del campo (on blur). NUNCA al cargar la pantalla.
+- Mensaje error campo vacío obligatorio: "Campo obligatorio"
+- Opciones: icono ⓘ en label, sufijo de texto, asterisco (*) en obligatorios
+
+**Input Suffix** — Text Field Simple con sufijo fijo (ej: "días", "%")
+
+**Select** — dropdown selección única.
+- Errores: solo al interactuar, igual que Text Field Simple.
+- Si solo hay una opción disponible: NO mostrar Select, mostrar directamente el contenido.
+
+**Switch Button Input** — toggle on/off
+- NO tiene estado error rojo. Puede mostrar mensaje informativo (azul) o alerta (amarillo).
+
+**Checkbox Input** — selección múltiple.
+**Radio Button Input** — selección única. Siempre una opción seleccionada por defecto. No permite deseleccionar.
+
+**Reglas globales de formularios Endalia:**
+- Errores de campo: únicamente on blur, nunca al cargar
+- Botón Guardar/Continuar: deshabilitado mientras haya campos obligatorios vacíos o con error visible
+- No se puede avanzar en wizard hasta que todos los campos obligatorios estén correctos
+
+### CONTENEDORES
+
+**Collapsable Container**
+- Header clickable con chevron (▶ cerrado / ▼ abierto)
+- Estado por defecto: EXPANDIDO salvo que se especifique lo contrario
+- Nomenclatura: "sección colapsable '[Nombre]', expandida/colapsada por defecto"
+
+**Modal Dialog** — 3 tamaños: pequeño (confirmación) | mediano (formulario) | grande (lateral)
+- Siempre: título + botón cierre (×) + footer con "Cancelar" (secundario) + acción primaria (accent)
+- Botón primario deshabilitado si hay campos obligatorios sin completar
+- NO cierra al hacer clic fuera — solo con botón × o botones del footer
+
+**Assistant Stepper** — wizard de pasos en Endalia
+- Pasos: completado (✓) | activo | pendiente
+- Errores de validación: se detectan SOLO al pulsar "Siguiente"
+- Retroceder sin lógica interna: vuelve sin modal. Con lógica interna creada: modal de confirmación.
+- Siempre termina en pantalla de resumen antes de ejecutar el proceso.
+
+### BOTONES
+
+**Text & Icon Button / Text Button**
+- Variantes: accent (azul sólido) | accent outline | variant (neutro) | danger (rojo) | danger outline | success | success outline
+- Tamaños: M (por defecto) | S
+
+**Link Button** — texto con estilo enlace, sin fondo. Uso: expandir secciones, acciones secundarias.
+
+**Chip Interactive Select** — chip seleccionable/deseleccionable (una selección).
+**Chip Interactive Multiselect** — igual, permite múltiple selección simultánea.
+
+### VISUALIZACIÓN
+
+**Data Display** — campo de solo lectura con label
+- Estructura: icono + Label + valor + subtítulo opcional + acción opcional (botón S)
+- Nunca usar botón de acción y help text a la vez.
+
+---
+
+## GLOSARIO DE DOMINIO — TERMINOLOGÍA ENDALIA HR
+
+Usa SIEMPRE los términos exactos. Nunca los sustituyas por sinónimos genéricos.
+
+### REGISTRO Y PLANIFICACIÓN HORARIA
+
+**Tramo** — Unidad mínima de planificación y/o registro. NO usar: "franja", "bloque", "período de tiempo".
+**Jornada** — Conjunto de registros de un empleado en un día. Estados: No iniciada | Iniciada | Finalizada | Validada | Cerrada. NO usar: "turno del día".
+**Horario** — Planificación constante (semanal o cíclica). Puede ser flexible, cíclico o alternativo. NO usar: "agenda".
+**Turno** — Unidad mínima de planificación para empleados gestionados por turnos. NO usar: "rotación".
+**Patrón de turnos** — Agrupación de turnos para planificación variable. NO usar: "ciclo de turnos".
+**Planificación** — Resultado de asignar horarios o turnos a un empleado. NO usar: "programación".
+**Registro** — Acción de añadir un tramo al sistema. NO usar en especificación técnica: "fichar".
+**Política de registro** — Configuración de modalidad, interfaces y restricciones para un colectivo.
+**Hora especial** — Planificación adicional al horario ordinario. NO usar: "hora extra" como genérico.
+**Compensación** — Proceso por el que una hora especial validada pasa a bolsa o nómina.
+**Compensaciones especiales** — Modalidad mensual. Fases: Apertura → Edición → Revisión → Cerrada.
+**Control horario** — Sección manager con subsecciones: Registro horario | Incidencias | Solicitudes | Compensaciones.
+**Incidencia** — Alerta automática por discrepancias entre planificación y registro.
+**Balance horario** — Vista tiempo trabajado vs. planificado. Granularidad: semanal | mensual | trimestral | por periodo.
+
+### VACACIONES Y AUSENCIAS
+
+**Absentismo / Tipo de absentismo** — Categoría de ausencia o permiso. NO usar: "tipo de vacación" como genérico.
+**Periodo** — (módulo V&A legacy) Configuración temporal de vacaciones.
+**Política de vacaciones y ausencias** — Configuración de comportamiento de absentismos para un colectivo.
+**Saldo** — Días u horas disponibles. Puede mostrarse como: Disponibles | Solicitado | Validado.
+**Bolsa de horas compensadas** — Saldo generado por compensaciones de horas especiales.
+
+### ESTRUCTURA GENERAL
+
+**Colaborador** — Perfil básico. Accede al menú "Yo".
+**Responsable / Manager** — Perfil con acceso a "Mi equipo".
+**RRHH** — Perfil administrativo con acceso a "Compañía".
+**Yo / Mi equipo / Compañía** — Las tres secciones del menú. NO usar: "sección personal", "sección admin".
+**Colectivo** — Agrupación de empleados para permisos o flujos de aprobación.
+**Flujo de aprobación** — Circuito de validación. Puede tener 0, 1 o 2 aprobaciones.
+
+### TÉRMINOS PROHIBIDOS
+
+| Evitar | Usar en su lugar |
+|---|---|
+| "franja horaria" | "tramo" |
+| "turno del día" | "jornada" o "turno" |
+| "horas extras" (genérico) | "horas especiales" |
+| "fichar" (en especificación) | "registrar" |
+| "admin" | "perfil RRHH" |
+| "panel de administración" | "apartado Compañía" |
+| "agenda" | "planificación" o "horario" |
+| "ciclo de turnos" | "patrón de turnos" |
+
+---
+
+## CRITERIOS DE ACEPTACIÓN
+
+Tres grupos. Sin prefijos, sin códigos. Cada línea es una afirmación verificable con sí/no.
+Formato: acción o condición concreta → resultado exacto y observable.
+
+Reglas:
+- Una sola cosa por línea. Si necesitas "y" para unir dos resultados, son dos líneas.
+- Máximo 8 criterios por grupo. Si hay más, el PBI probablemente debe dividirse.
+- Solo incluye criterios verificables sin ambigüedad. Si no sabes el resultado exacto, es una nota técnica, no un criterio.
+- happy_path: flujo principal sin errores, paso a paso desde la acción hasta el resultado.
+- validations: condiciones de borde y validaciones de campo.
+- error_states: fallos del sistema, errores de carga, errores de guardado.
+
+Ejemplo de criterio correcto:
+✅ "Al hacer clic en 'Añadir' con al menos un tipo seleccionado → el modal se cierra y se crea un acordeón expandido para cada tipo"
+
+Ejemplo de criterio incorrecto:
+❌ "El sistema maneja correctamente los errores de validación"
+❌ "El modal funciona según lo especificado"
+
+---
+
+## NOTAS TÉCNICAS
+
+Solo preguntas genuinas sin respuesta que bloquean o condicionan el desarrollo.
+Si no hay preguntas reales, devuelve el array vacío [].
+NO incluyas observaciones, resúmenes de lo desarrollado ni aclaraciones que ya están en la spec.
+
+Formato: pregunta directa y accionable.
+✅ "¿El valor por defecto de 'Cantidad máxima' se carga desde el tipo de absentismo base vía API o se configura manualmente en el wizard?"
+❌ "Hay que tener en cuenta los estados de error"
+
+---
+
+## REGLAS GENERALES
+
+- La descripción es la fuente de la intención de negocio. Si indica que algo no debe desarrollarse aunque esté en el prototipo, omítelo.
+- No mezcles estado actual con estado objetivo.
+- Si el prototipo muestra un único estado y hay estados alternativos relevantes no cubiertos, márcalo en tech_notes.
+- Corrige errores tipográficos de la descripción o el prototipo en el PBI.
+
+---
+
+RESPONDE SOLO JSON válido sin backticks ni markdown:
+{
+  "summary": "Justificación de la división (si hay más de 1 PBI) y análisis de discrepancias detectadas. Vacío si no aplica.",
+  "pbis": [{
+    "title": "Módulo - Feature - US X.X - Verbo + objeto concreto",
+    "objective": "Qué se consigue con este PBI en una frase. Orientado a negocio, no a UI.",
+    "role": "Colaborador | Responsable | perfil RRHH",
+    "when": "Contexto de negocio o momento del proceso, no ruta de navegación",
+    "then": "Resultado de negocio obtenido, no descripción de la UI",
+    "benefit": "Valor real para el usuario o la organización",
+    "functional_spec": "Especificación estructurada por zonas con encabezados en mayúsculas y listas con guión. Sin párrafos densos.",
+    "happy_path": [
+      "Acción concreta → resultado observable y verificable"
+    ],
+    "validations": [
+      "Condición de borde o validación → resultado exacto"
+    ],
+    "error_states": [
+      "Causa del error → comportamiento del sistema"
+    ],
+    "prototype_refs": [
+      "(Captura N) Descripción de lo que muestra la captura con textos literales"
+    ],
+    "dependencies": [],
+    "tech_notes": [
+      "Pregunta concreta y accionable para desarrollo o diseño"
+    ]
+  }]
+}
+"""
+
+MODEL = "claude-sonnet-4-20250514"
+MAX_TOKENS = 16000
+# Adaptive output budget (see max_tokens_for) and how many times a truncated answer is resumed
+SUMMARY_TOKENS = 1000
+TOKENS_PER_PBI = 3500
+MAX_CONTINUATIONS = 3
+
+
+def system_blocks(use_cache=True):
+    if not use_cache:
+        return SYSTEM_PROMPT
+    return [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+
+
+def build_user_content(module, feature, role, description, context, images, use_cache=False):
+    text = f"MÓDULO: {module or 'No especificado'}\nFEATURE: {feature or 'No especificada'}\nROL AFECTADO: {role}\n\nIMPORTANTE: El título de cada PBI DEBE comenzar exactamente con '{module} - {feature} - US X.X - ' seguido de la acción concreta. No omitas estos prefijos.\n\nDESCRIPCIÓN:\n{description}"
+    if context:
+        text += f"\n\nCONTEXTO ADICIONAL:\n{context}"
+    if images:
+        n_captures = max(img.get("capture", i + 1) for i, img in enumerate(images))
+        text += f"\n\nSe adjuntan {n_captures} captura(s) del prototipo (Captura 1, 2...). Analízalas y referéncialas en los PBIs."
+        if any(img.get("label") for img in images):
+            text += " Cada imagen va precedida de su etiqueta; usa siempre ese número de captura."
+    image_blocks = []
+    for img in images:
+        if img.get("label"):
+            image_blocks.append({"type": "text", "text": img["label"]})
+        image_blocks.append({"type": "image", "source": {"type": "base64", "media_type": img["media_type"], "data": img["data"]}})
+    if use_cache and image_blocks:
+        # Images go first so the cached prefix survives edits to the description
+        image_blocks[-1]["cache_control"] = {"type": "ephemeral"}
+        return image_blocks + [{"type": "text", "text": text}]
+    return [{"type": "text", "text": text}] + image_blocks
+
+
+def strip_control_chars(text):
+    # Remove control chars that break JSON parsing
+    return re.sub(r'[-\x08\x0b\x0c\x0e-\x1f]', '', text)
+
+
+def parse_pbis_json(raw):
+    # Clean markdown fences and control characters
+    clean = raw.replace("```json", "").replace("```", "").strip()
+    clean = strip_control_chars(clean)
+    try:
+        return json.loads(clean)
+    except json.JSONDecodeError:
+        # Try to extract JSON object if there's extra text around it
+        match = re.search(r'\{.*\}', clean, re.DOTALL)
+        if match:
+            return json.loads(match.group())
+        raise
+
+
+class PbiStreamParser:
+    """
+    Incremental parser for the {"summary", "pbis"} document as it streams in.
+    feed() scans only the new text and returns the events it completed:
+    ("summary", str) when the summary string closes and ("pbi", dict) for each
+    element of "pbis" as soon as its closing brace arrives.
+    """
+
+    def __init__(self):
+        self.buf = ""
+        self.summary = None
+        self.pbis = []
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._str_start = 0
+        self._key = None
+        self._after_colon = False
+        self._pbi_start = None
+
+    def feed(self, text):
+        self.buf += strip_control_chars(text)
+        events = []
+        buf = self.buf
+        for i in range(self._pos, len(buf)):
+            c = buf[i]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+                    if self._depth == 1:
+                        events.extend(self._on_top_level_string(buf[self._str_start:i + 1]))
+            elif c == '"':
+                self._in_str = True
+                self._str_start = i
+            elif c in "{[":
+                self._depth += 1
+                if c == "{" and self._depth == 3 and self._key == "pbis":
+                    self._pbi_start = i
+            elif c in "}]":
+                if c == "}" and self._depth == 3 and self._pbi_start is not None:
+                    try:
+                        pbi = json.loads(buf[self._pbi_start:i + 1])
+                        self.pbis.append(pbi)
+                        events.append(("pbi", pbi))
+                    except json.JSONDecodeError:
+                        pass
+                    self._pbi_start = None
+                self._depth -= 1
+            elif self._depth == 1 and c == ":":
+                self._after_colon = True
+            elif self._depth == 1 and c == ",":
+                self._after_colon = False
+        self._pos = len(buf)
+        return events
+
+    def _on_top_level_string(self, literal):
+        try:
+            value = json.loads(literal)
+        except json.JSONDecodeError:
+            return []
+        if not self._after_colon:
+            self._key = value
+            return []
+        self._after_colon = False
+        if self._key == "summary":
+            self.summary = value
+            return [("summary", value)]
+        return []
+
+
+SYSTEM_PROMPT_VERSION = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:12]
+
+
+def generation_cache_key(module, feature, role, description, context, images):
+    """Digest of every input that determines the model output."""
+    h = hashlib.sha256()
+    for part in (MODEL, SYSTEM_PROMPT_VERSION, module, feature, role, description, context):
+        h.update((part or "").encode("utf-8"))
+        h.update(b"\0")
+    for img in images:
+        h.update(img["media_type"].encode("utf-8"))
+        h.update(base64.b64decode(img["data"]))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    SQLite store of generation results keyed by generation_cache_key.
+    Entries expire after ttl seconds; beyond max_entries / max_bytes the
+    least recently used ones are evicted.
+    """
+
+    def __init__(self, path, ttl, max_entries, max_bytes):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,
+            created REAL NOT NULL, accessed REAL NOT NULL)""")
+        self._db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._db.commit()
+                row = None
+            if not row:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key, result):
+        value = json.dumps(result, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                             (key, value, len(value.encode("utf-8")), now, now))
+            self._db.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        while count > self.max_entries or size > self.max_bytes:
+            row = self._db.execute("SELECT key, size FROM results ORDER BY accessed LIMIT 1").fetchone()
+            if not row:
+                break
+            self._db.execute("DELETE FROM results WHERE key = ?", (row[0],))
+            count -= 1
+            size -= row[1]
+
+    def stats(self):
+        with self._lock:
+            count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count, "bytes": size}
+
+
+def expected_pbi_count(description):
+    """Same buckets as the form's complexity hint, extended for long specs."""
+    n = len(description or "")
+    if n < 80:
+        return 1
+    if n < 300:
+        return 2
+    return min(8, 2 + n // 600)
+
+
+def max_tokens_for(description):
+    """Output budget sized to the expected PBIs; continuations cover the rest."""
+    return min(MAX_TOKENS, SUMMARY_TOKENS + TOKENS_PER_PBI * expected_pbi_count(description))
+
+
+def request_params(module, feature, role, description, context, images, use_cache=True, max_tokens=None):
+    """Keyword arguments for client.messages.create / a Message Batches request."""
+    return {
+        "model": MODEL,
+        "max_tokens": max_tokens or max_tokens_for(description),
+        "system": system_blocks(use_cache),
+        "messages": [{"role": "user", "content": build_user_content(module, feature, role, description, context, images, use_cache)}],
+    }
+
+
+def continuation_params(params, partial):
+    """Same request with the truncated output as assistant prefill, so the model resumes mid-JSON."""
+    # The API rejects a prefill ending in whitespace
+    return dict(params, messages=params["messages"] + [{"role": "assistant", "content": partial.rstrip()}])
+
+
+def response_text(message):
+    return "".join(block.text for block in message.content if block.type == "text")
+
+
+def parse_pbis_tolerant(raw):
+    """
+    parse_pbis_json, falling back to the complete PBIs of a truncated or
+    malformed document. Returns (result, recovered) where recovered tells
+    whether the fallback was needed.
+    """
+    try:
+        return parse_pbis_json(raw), False
+    except json.JSONDecodeError:
+        parser = PbiStreamParser()
+        parser.feed(raw)
+        if parser.pbis:
+            return {"summary": parser.summary or "", "pbis": parser.pbis}, True
+        raise
+
+
+def new_stats():
+    """Per-generation counters filled in by the generate* functions (for telemetry)."""
+    return {"ttft_s": None, "calls": 0, "continuations": 0, "retries": 0, "parse_fallback": False, "missing_pbis": 0}
+
+
+def merge_stats(into, other):
+    for key in ("calls", "continuations", "retries", "missing_pbis"):
+        into[key] += other[key]
+    into["parse_fallback"] = into["parse_fallback"] or other["parse_fallback"]
+
+
+def _retries_taken(http_response):
+    # The SDK stamps every attempt with its retry number
+    try:
+        return int(http_response.request.headers.get("x-stainless-retry-count", 0))
+    except Exception:
+        return 0
+
+
+def create_with_continuation(client, params, stats=None):
+    """messages.create that keeps asking for more while stop_reason is max_tokens. Returns (raw, usages)."""
+    stats = stats if stats is not None else new_stats()
+    start = time.monotonic()
+    raw = ""
+    usages = []
+    for _ in range(MAX_CONTINUATIONS + 1):
+        raw_response = client.messages.with_raw_response.create(**(continuation_params(params, raw) if raw else params))
+        response = raw_response.parse()
+        if stats["ttft_s"] is None:
+            stats["ttft_s"] = time.monotonic() - start
+        stats["calls"] += 1
+        stats["continuations"] += 1 if raw else 0
+        stats["retries"] += _retries_taken(raw_response.http_response)
+        usages.append(response.usage)
+        raw = raw.rstrip() + response_text(response)
+        if response.stop_reason != "max_tokens":
+            break
+    return raw, usages
+
+
+def generate(client, module, feature, role, description, context, images, use_cache=True, stats=None):
+    """Blocking generation. Returns (result, usage); stats (see new_stats) is filled in if given."""
+    stats = stats if stats is not None else new_stats()
+    raw, usages = create_with_continuation(client, request_params(module, feature, role, description, context, images, use_cache), stats)
+    result, stats["parse_fallback"] = parse_pbis_tolerant(raw)
+    return result, sum_usage(usages)
+
+
+def generate_stream(client, module, feature, role, description, context, images, on_summary=None, on_pbi=None, use_cache=True,
+                    stats=None):
+    """
+    Streaming variant of generate. Calls on_summary(summary) and
+    on_pbi(pbi, index) as soon as each part of the JSON is complete, and
+    returns (result, usage) once the stream ends.
+    """
+    stats = stats if stats is not None else new_stats()
+    start = time.monotonic()
+    params = request_params(module, feature, role, description, context, images, use_cache)
+    parser = PbiStreamParser()
+    raw = ""
+    usages = []
+    for _ in range(MAX_CONTINUATIONS + 1):
+        with client.messages.stream(**(continuation_params(params, raw) if raw else params)) as stream:
+            stats["calls"] += 1
+            stats["continuations"] += 1 if raw else 0
+            stats["retries"] += _retries_taken(stream.response)
+            raw = raw.rstrip()
+            for text in stream.text_stream:
+                if stats["ttft_s"] is None:
+                    stats["ttft_s"] = time.monotonic() - start
+                raw += text
+                for kind, value in parser.feed(text):
+                    if kind == "summary" and on_summary:
+                        on_summary(value)
+                    elif kind == "pbi" and on_pbi:
+                        on_pbi(value, len(parser.pbis) - 1)
+            final = stream.get_final_message()
+        usages.append(final.usage)
+        if final.stop_reason != "max_tokens":
+            break
+    result, stats["parse_fallback"] = parse_pbis_tolerant(raw)
+    return result, sum_usage(usages)
+
+
+# ---------- Fan-out: plan first, then one request per PBI ----------
+
+PLAN_MAX_TOKENS = 2000
+PBI_MAX_TOKENS = 6000
+
+PLAN_INSTRUCTION = """FASE DE PLANIFICACIÓN — todavía NO redactes los PBIs.
+Decide la división en PBIs siguiendo las REGLAS DE DIVISIÓN y responde SOLO JSON válido sin backticks ni markdown:
+{
+  "summary": "Justificación de la división y análisis de discrepancias detectadas. Vacío si no aplica.",
+  "pbis": [{
+    "title": "Módulo - Feature - US X.X - Verbo + objeto concreto",
+    "scope": "Qué cubre este PBI y qué queda fuera, en una o dos frases"
+  }]
+}"""
+
+PBI_INSTRUCTION = """FASE DE REDACCIÓN — PBI {n} de {total}.
+La feature ya se ha dividido así:
+{plan}
+
+Redacta ÚNICAMENTE el PBI {n}: "{title}"
+Alcance: {scope}
+No repitas contenido que pertenece a los otros PBIs. Responde con el formato JSON indicado, con "summary" vacío y un único elemento en "pbis"."""
+
+
+def _phase_params(base, instruction, max_tokens, use_cache):
+    """Shared feature context (cached) followed by a phase-specific instruction."""
+    content = [dict(block) for block in base["messages"][0]["content"]]
+    if use_cache:
+        content[-1]["cache_control"] = {"type": "ephemeral"}
+    content.append({"type": "text", "text": instruction})
+    return dict(base, max_tokens=max_tokens, messages=[{"role": "user", "content": content}])
+
+
+def sum_usage(usages):
+    fields = ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+    return SimpleNamespace(**{f: sum(getattr(u, f, 0) or 0 for u in usages) for f in fields})
+
+
+def plan_pbis(client, module, feature, role, description, context, images, use_cache=True, stats=None):
+    """Short planning call. Returns ({"summary", "pbis": [{"title", "scope"}]}, usage)."""
+    base = request_params(module, feature, role, description, context, images, use_cache)
+    raw, usages = create_with_continuation(client, _phase_params(base, PLAN_INSTRUCTION, PLAN_MAX_TOKENS, use_cache), stats)
+    return parse_pbis_json(raw), sum_usage(usages)
+
+
+def generate_fanout(client, module, feature, role, description, context, images, on_summary=None, on_pbi=None,
+                    use_cache=True, max_workers=6, stats=None):
+    """
+    Two-phase generation for large features: plan_pbis fixes the split, then
+    every PBI is written by its own concurrent request sharing the cached
+    context. Callbacks run on the calling thread, in completion order.
+    Returns the merged (result, usage).
+    """
+    stats = stats if stats is not None else new_stats()
+    plan, plan_usage = plan_pbis(client, module, feature, role, description, context, images, use_cache, stats)
+    entries = plan.get("pbis") or []
+    if on_summary:
+        on_summary(plan.get("summary", ""))
+    base = request_params(module, feature, role, description, context, images, use_cache)
+    plan_text = "\n".join(f"{i+1}. {e.get('title', '')} — {e.get('scope', '')}" for i, e in enumerate(entries))
+
+    def write(i, entry):
+        instruction = PBI_INSTRUCTION.format(n=i + 1, total=len(entries), plan=plan_text,
+                                             title=entry.get("title", ""), scope=entry.get("scope", ""))
+        pbi_stats = new_stats()
+        usages = []
+        # One retry when the answer holds no PBI; after that the PBI is left out
+        for _ in range(2):
+            raw, call_usages = create_with_continuation(
+                client, _phase_params(base, instruction, PBI_MAX_TOKENS, use_cache), pbi_stats)
+            usages += call_usages
+            try:
+                result, recovered = parse_pbis_tolerant(raw)
+            except json.JSONDecodeError:
+                continue
+            if result.get("pbis"):
+                pbi_stats["parse_fallback"] = recovered
+                return result["pbis"][0], sum_usage(usages), pbi_stats
+        pbi_stats["missing_pbis"] += 1
+        return None, sum_usage(usages), pbi_stats
+
+    pbis = [None] * len(entries)
+    usages = [plan_usage]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(entries)))) as pool:
+        futures = {pool.submit(write, i, e): i for i, e in enumerate(entries)}
+        for fut in as_completed(futures):
+            i = futures[fut]
+            pbis[i], usage, pbi_stats = fut.result()
+            usages.append(usage)
+            merge_stats(stats, pbi_stats)
+            if on_pbi and pbis[i] is not None:
+                on_pbi(pbis[i], i)
+    return {"summary": plan.get("summary", ""), "pbis": [p for p in pbis if p is not None]}, sum_usage(usages)
+
+
+# ---------- Targeted refinement of a single PBI ----------
+
+REFINE_MAX_TOKENS = 4000
+
+REFINE_INSTRUCTION = """REFINAMIENTO DE UN ÚNICO PBI — no generes la feature completa.
+
+PBI ACTUAL (US {n} de {total}):
+{pbi}
+
+OTROS PBIs DE LA FEATURE (solo contexto, no los modifiques):
+{siblings}
+
+INSTRUCCIÓN DEL PM:
+{instruction}
+
+Aplica la instrucción respetando todas las reglas anteriores. Responde SOLO JSON válido sin backticks ni markdown, con UNA de estas dos formas:
+- Cambios acotados: {{"patch": [operaciones JSON Patch (RFC 6902) sobre el PBI actual, p. ej. {{"op": "replace", "path": "/happy_path/2", "value": "..."}}]}}
+- Reescritura completa: {{"pbi": {{...el PBI completo con el mismo formato...}}}}
+Prefiere "patch" salvo que cambie más de la mitad del PBI."""
+
+
+def _pointer(path):
+    if path == "":
+        return []
+    if not path.startswith("/"):
+        raise ValueError(f"Ruta JSON Patch no válida: {path!r}")
+    return [p.replace("~1", "/").replace("~0", "~") for p in path[1:].split("/")]
+
+
+def _resolve(doc, parts):
+    target = doc
+    for part in parts:
+        target = target[int(part)] if isinstance(target, list) else target[part]
+    return target
+
+
+def _patch_add(doc, parts, value):
+    parent, last = _resolve(doc, parts[:-1]), parts[-1]
+    if isinstance(parent, list):
+        parent.insert(len(parent) if last == "-" else int(last), value)
+    else:
+        parent[last] = value
+
+
+def _patch_remove(doc, parts):
+    parent, last = _resolve(doc, parts[:-1]), parts[-1]
+    return parent.pop(int(last) if isinstance(parent, list) else last)
+
+
+def apply_json_patch(doc, ops):
+    """Applies RFC 6902 operations to a copy of doc and returns it. Raises ValueError on a bad op."""
+    doc = json.loads(json.dumps(doc))
+    try:
+        for op in ops:
+            parts = _pointer(op["path"])
+            kind = op["op"]
+            if kind == "add":
+                _patch_add(doc, parts, op["value"])
+            elif kind == "remove":
+                _patch_remove(doc, parts)
+            elif kind == "replace":
+                _patch_remove(doc, parts)
+                _patch_add(doc, parts, op["value"])
+            elif kind in ("move", "copy"):
+                source = _pointer(op["from"])
+                value = _patch_remove(doc, source) if kind == "move" else json.loads(json.dumps(_resolve(doc, source)))
+                _patch_add(doc, parts, value)
+            elif kind == "test":
+                if _resolve(doc, parts) != op["value"]:
+                    raise ValueError(f"test fallido en {op['path']}")
+            else:
+                raise ValueError(f"Operación JSON Patch desconocida: {kind}")
+    except (KeyError, IndexError, TypeError) as e:
+        raise ValueError(f"JSON Patch no aplicable: {e}") from e
+    return doc
+
+
+def refine_pbi(client, pbi, instruction, siblings, index, use_cache=True, stats=None):
+    """
+    Regenerates or patches one PBI from a short PM instruction, sending only
+    that PBI and the titles/objectives of its siblings. Returns
+    (new_pbi, changes, usage) where changes is the number of patch operations
+    applied, or None when the model rewrote the whole PBI.
+    """
+    siblings_text = "\n".join(f"- {s.get('title', '')}: {s.get('objective', '')}" for s in siblings) or "(ninguno)"
+    text = REFINE_INSTRUCTION.format(n=index + 1, total=len(siblings) + 1, siblings=siblings_text, instruction=instruction,
+                                     pbi=json.dumps(pbi, ensure_ascii=False, indent=1))
+    params = {
+        "model": MODEL,
+        "max_tokens": REFINE_MAX_TOKENS,
+        "system": system_blocks(use_cache),
+        "messages": [{"role": "user", "content": [{"type": "text", "text": text}]}],
+    }
+    raw, usages = create_with_continuation(client, params, stats)
+    answer = parse_pbis_json(raw)
+    if "patch" in answer:
+        return apply_json_patch(pbi, answer["patch"]), len(answer["patch"]), sum_usage(usages)
+    if isinstance(answer.get("pbi"), dict):
+        return answer["pbi"], None, sum_usage(usages)
+    raise ValueError("La respuesta no contiene ni 'patch' ni 'pbi'")
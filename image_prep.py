@@ -0,0 +1,133 @@
+"""
+Preprocessing of prototype captures before they are sent to the model.
+
+Every capture is downscaled to the resolution the model actually uses, very
+tall frames are cut into readable tiles, the result is re-encoded in the
+smaller of PNG / WebP, and exact or near-duplicate captures are dropped using a
+perceptual hash. Each output image keeps a "Captura N" label with the original
+numbering, so prototype_refs still point at the right screenshot.
+"""
+import base64
+import hashlib
+import io
+import math
+
+from PIL import Image
+
+# Beyond these the API downsizes the image itself (and bills the same tokens)
+MAX_LONG_EDGE = 1568
+MAX_PIXELS = 1_150_000
+# Frames taller than TILE_ASPECT × width are split into tiles of TILE_HEIGHT_RATIO × width
+TILE_ASPECT = 2.5
+TILE_HEIGHT_RATIO = 1.5
+TILE_OVERLAP = 0.05
+# Max Hamming distance between 64-bit dHashes to treat two captures as the same screen
+NEAR_DUPLICATE_DISTANCE = 4
+
+
+def estimate_tokens(width, height):
+    """Anthropic's published approximation, after the API's own resize."""
+    scale = min(1.0, MAX_LONG_EDGE / max(width, height), math.sqrt(MAX_PIXELS / (width * height)))
+    return math.ceil((width * scale) * (height * scale) / 750)
+
+
+def dhash(img):
+    small = img.convert("L").resize((9, 8), Image.LANCZOS)
+    px = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return bits
+
+
+def _fit(img):
+    w, h = img.size
+    scale = min(1.0, MAX_LONG_EDGE / max(w, h), math.sqrt(MAX_PIXELS / (w * h)))
+    if scale >= 1.0:
+        return img
+    return img.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS)
+
+
+def _tiles(img):
+    w, h = img.size
+    if h <= w * TILE_ASPECT:
+        return [img]
+    tile_h = int(w * TILE_HEIGHT_RATIO)
+    step = int(tile_h * (1 - TILE_OVERLAP))
+    tiles = []
+    top = 0
+    while True:
+        bottom = min(h, top + tile_h)
+        tiles.append(img.crop((0, top, w, bottom)))
+        if bottom >= h:
+            return tiles
+        top += step
+
+
+def _encode(img):
+    """Smallest of lossless PNG and high-quality WebP."""
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    candidates = []
+    for fmt, media_type, kwargs in (("PNG", "image/png", {"optimize": True}),
+                                    ("WEBP", "image/webp", {"quality": 90, "method": 4})):
+        buf = io.BytesIO()
+        img.save(buf, format=fmt, **kwargs)
+        candidates.append((buf.getvalue(), media_type))
+    return min(candidates, key=lambda c: len(c[0]))
+
+
+def prepare_images(images):
+    """
+    Takes [{"data": b64, "media_type"}] in "Captura N" order and returns
+    (prepared_images, report). Prepared images carry "label" and "capture"
+    (the original 1-based number); report has bytes/tokens before and after.
+    """
+    prepared = []
+    report = {"captures": len(images), "duplicates": 0, "tiles": 0,
+              "bytes_before": 0, "bytes_after": 0, "tokens_before": 0, "tokens_after": 0}
+    seen_digest = {}
+    seen_hash = []
+    for n, img in enumerate(images, start=1):
+        raw = base64.b64decode(img["data"])
+        report["bytes_before"] += len(raw)
+        try:
+            pil = Image.open(io.BytesIO(raw))
+            pil.load()
+        except Exception:
+            # Unknown format: send as is, the API will complain if it cares
+            prepared.append(dict(img, label=f"Captura {n}", capture=n))
+            report["bytes_after"] += len(raw)
+            continue
+        report["tokens_before"] += estimate_tokens(*pil.size)
+
+        digest = hashlib.sha256(raw).hexdigest()
+        h = dhash(pil)
+        original = seen_digest.get(digest)
+        if original is None:
+            original = next((m for m, other in seen_hash if bin(h ^ other).count("1") <= NEAR_DUPLICATE_DISTANCE), None)
+        if original is not None:
+            report["duplicates"] += 1
+            for p in prepared:
+                if p["capture"] == original:
+                    p["label"] += f" (igual que Captura {n})"
+            continue
+        seen_digest[digest] = n
+        seen_hash.append((n, h))
+
+        tiles = _tiles(pil)
+        if len(tiles) > 1:
+            report["tiles"] += len(tiles)
+        for t, tile in enumerate(tiles, start=1):
+            tile = _fit(tile)
+            data, media_type = _encode(tile)
+            if tile is pil and len(raw) <= len(data):
+                # Already the right size and better compressed than we can do
+                data, media_type = raw, img["media_type"]
+            label = f"Captura {n}" if len(tiles) == 1 else f"Captura {n} (parte {t}/{len(tiles)}, de arriba a abajo)"
+            prepared.append({"data": base64.b64encode(data).decode("utf-8"), "media_type": media_type,
+                             "label": label, "capture": n})
+            report["bytes_after"] += len(data)
+            report["tokens_after"] += estimate_tokens(*tile.size)
+    return prepared, report
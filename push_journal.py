@@ -0,0 +1,185 @@
+"""
+Write-ahead journal of pushes to Azure DevOps.
+
+Every "create PBI (+ tasks)" is recorded as an intent keyed by a digest of the
+PBI and its target before anything is sent, and each completed step (the PBI,
+then every task) is written back as soon as Azure returns its id. Work items
+are also stamped with a tag derived from the key, so a step whose id never
+reached the journal (the rerun died right after the call) can be found in
+Azure instead of being created twice.
+
+Intents that failed because Azure was unreachable move to the outbox and are
+retried with exponential backoff until they go through. Starting an attempt
+claims the intent with a lease, atomically, so two sessions (say, both
+flushing the outbox) never push the same intent at once.
+
+Captures are not part of the payload: it refers to them by content digest and
+their bytes are kept once in a side table, only while some intent that is not
+done still needs them. Done intents keep just their ids (that is what makes a
+repeated push a no-op) and, like failed ones, are deleted after a retention.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+TAG_PREFIX = "pbi-gen-"
+OUTBOX_BASE_DELAY = 30
+OUTBOX_MAX_DELAY = 3600
+DONE_RETENTION = 90 * 24 * 3600
+FAILED_RETENTION = 7 * 24 * 3600
+# How long an attempt holds its intent before another one may take over (it died)
+PUSH_LEASE = 300
+
+PENDING, DONE, OUTBOX, FAILED = "pending", "done", "outbox", "failed"
+
+
+class InProgressError(Exception):
+    """Another attempt holds the lease on this intent."""
+
+
+def intent_key(pbi, target):
+    """Same PBI to the same place → same key, whatever session or rerun sends it."""
+    blob = json.dumps({"pbi": pbi, "target": target}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def pbi_tag(key):
+    return f"{TAG_PREFIX}{key[:16]}"
+
+
+def task_tag(key, n):
+    return f"{TAG_PREFIX}{key[:16]}-t{n}"
+
+
+class PushJournal:
+    """SQLite journal of push intents and their completed steps."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS push_journal (
+            key TEXT PRIMARY KEY, scope TEXT NOT NULL, payload TEXT NOT NULL,
+            state TEXT NOT NULL, pbi_id INTEGER, task_ids TEXT NOT NULL,
+            attempts INTEGER NOT NULL, next_attempt REAL, error TEXT,
+            created REAL NOT NULL, updated REAL NOT NULL)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS push_blobs (
+            digest TEXT PRIMARY KEY, data BLOB NOT NULL)""")
+        self._db.commit()
+        self.purge()
+
+    def _row(self, key):
+        row = self._db.execute("""SELECT key, scope, payload, state, pbi_id, task_ids, attempts, next_attempt, error
+                                  FROM push_journal WHERE key = ?""", (key,)).fetchone()
+        if not row:
+            return None
+        return {"key": row[0], "scope": row[1], "payload": json.loads(row[2]), "state": row[3], "pbi_id": row[4],
+                "task_ids": {int(k): v for k, v in json.loads(row[5]).items()}, "attempts": row[6],
+                "next_attempt": row[7], "error": row[8]}
+
+    def get(self, key):
+        with self._lock:
+            return self._row(key)
+
+    def begin(self, key, scope, payload, blobs=None):
+        """
+        Records the intent (if new) and claims it for one attempt, counting it.
+        Returns the entry as it was before; raises InProgressError if another
+        attempt holds it. blobs ({digest: bytes}) are the captures the payload
+        refers to; each is stored once, whatever the number of intents using it.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO push_journal VALUES (?, ?, ?, ?, NULL, '{}', 0, NULL, NULL, ?, ?)",
+                             (key, scope, json.dumps(payload, ensure_ascii=False), PENDING, now, now))
+            entry = self._row(key)
+            if entry["state"] != DONE:
+                # The claim: a pending intent whose lease has not run out belongs to someone else
+                claimed = self._db.execute(
+                    """UPDATE push_journal SET state = ?, next_attempt = ?, attempts = attempts + 1, updated = ?
+                       WHERE key = ? AND state != ? AND NOT (state = ? AND COALESCE(next_attempt, 0) > ?)""",
+                    (PENDING, now + PUSH_LEASE, now, key, DONE, PENDING, now)).rowcount
+                if claimed != 1:
+                    self._db.commit()
+                    raise InProgressError("Este PBI ya se está enviando desde otra sesión")
+                self._db.executemany("INSERT OR IGNORE INTO push_blobs VALUES (?, ?)", (blobs or {}).items())
+            self._db.commit()
+            return entry
+
+    def record_pbi(self, key, pbi_id):
+        with self._lock:
+            self._db.execute("UPDATE push_journal SET pbi_id = ?, updated = ? WHERE key = ?", (pbi_id, time.time(), key))
+            self._db.commit()
+
+    def record_task(self, key, n, task_id):
+        with self._lock:
+            entry = self._row(key)
+            task_ids = dict(entry["task_ids"])
+            task_ids[n] = task_id
+            self._db.execute("UPDATE push_journal SET task_ids = ?, updated = ? WHERE key = ?",
+                             (json.dumps(task_ids), time.time(), key))
+            self._db.commit()
+
+    def blob(self, digest):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM push_blobs WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def complete(self, key):
+        """Marks the intent done and drops its payload: only the ids are needed from now on."""
+        with self._lock:
+            self._db.execute("UPDATE push_journal SET state = ?, payload = '{}', error = NULL, next_attempt = NULL, "
+                             "updated = ? WHERE key = ?", (DONE, time.time(), key))
+            self._release_blobs()
+            self._db.commit()
+
+    def fail(self, key, error):
+        self._set_state(key, FAILED, error, None)
+
+    def to_outbox(self, key, error):
+        """Parks the intent for a later retry, backing off exponentially with the attempts."""
+        with self._lock:
+            attempts = self._row(key)["attempts"]
+        delay = min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * 2 ** max(0, attempts - 1))
+        self._set_state(key, OUTBOX, error, time.time() + delay)
+
+    def _set_state(self, key, state, error, next_attempt):
+        with self._lock:
+            self._db.execute("UPDATE push_journal SET state = ?, error = ?, next_attempt = ?, updated = ? WHERE key = ?",
+                             (state, error, next_attempt, time.time(), key))
+            self._db.commit()
+
+    def _release_blobs(self):
+        """Caller holds the lock. Deletes the captures no unfinished intent refers to any more."""
+        needed = set()
+        for (payload,) in self._db.execute("SELECT payload FROM push_journal WHERE state != ?", (DONE,)):
+            needed.update(d for d in json.loads(payload).get("captures", []) if d)
+        stored = [r[0] for r in self._db.execute("SELECT digest FROM push_blobs")]
+        self._db.executemany("DELETE FROM push_blobs WHERE digest = ?", [(d,) for d in stored if d not in needed])
+
+    def purge(self, now=None):
+        """Deletes done and failed intents past their retention."""
+        now = now or time.time()
+        with self._lock:
+            self._db.execute("DELETE FROM push_journal WHERE (state = ? AND updated < ?) OR (state = ? AND updated < ?)",
+                             (DONE, now - DONE_RETENTION, FAILED, now - FAILED_RETENTION))
+            self._release_blobs()
+            self._db.commit()
+
+    def due(self, scope, now=None):
+        """Outbox entries of this credential scope whose backoff has elapsed."""
+        with self._lock:
+            keys = [r[0] for r in self._db.execute(
+                "SELECT key FROM push_journal WHERE state = ? AND scope = ? AND next_attempt <= ? ORDER BY created",
+                (OUTBOX, scope, now or time.time()))]
+            return [self._row(k) for k in keys]
+
+    def stats(self, scope=None):
+        with self._lock:
+            query = "SELECT state, COUNT(*) FROM push_journal"
+            rows = self._db.execute(query + " WHERE scope = ? GROUP BY state" if scope else query + " GROUP BY state",
+                                    (scope,) if scope else ()).fetchall()
+        return {state: count for state, count in rows}
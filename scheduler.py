@@ -0,0 +1,343 @@
+"""
+Process-wide, rate-limit-aware scheduler for Anthropic calls.
+
+All sessions of the Streamlit server share one RateLimitScheduler. Requests
+wait in per-user queues served round-robin, so one PM generating a large
+feature cannot starve the others; a request is only let through when both the
+requests-per-minute and input-tokens-per-minute buckets have room and a
+concurrency slot is free. Buckets are re-synced from the API's
+anthropic-ratelimit-* headers after every response, and 429 / 5xx / overloaded
+errors are retried with jittered exponential backoff (honouring retry-after).
+
+ScheduledClient wraps an anthropic.Anthropic so generation.py can use it
+unchanged.
+"""
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import anthropic
+
+RETRYABLE = (anthropic.RateLimitError, anthropic.InternalServerError,
+             anthropic.APIConnectionError, anthropic.APITimeoutError)
+
+# Rough input size of a request, for the token bucket (images are billed ~1.6k tokens each)
+CHARS_PER_TOKEN = 3.5
+TOKENS_PER_IMAGE = 1600
+
+
+def estimate_input_tokens(params):
+    chars = 0
+    images = 0
+    system = params.get("system", "")
+    chars += len(system) if isinstance(system, str) else sum(len(b.get("text", "")) for b in system)
+    for message in params.get("messages", []):
+        content = message["content"]
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for block in content:
+            if block.get("type") == "image":
+                images += 1
+            else:
+                chars += len(block.get("text", ""))
+    return int(chars / CHARS_PER_TOKEN) + images * TOKENS_PER_IMAGE
+
+
+def _seconds_until(reset):
+    try:
+        when = datetime.fromisoformat(reset.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """Continuously refilling bucket of `per_minute` units."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60 / self.capacity
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def sync(self, remaining, limit=None, now=None):
+        """Trust the server's view of what is left in the current window."""
+        self._refill(now or time.monotonic())
+        if limit:
+            self.capacity = float(limit)
+        self.level = min(self.capacity, float(remaining))
+
+    def drain(self, seconds, now=None):
+        """Empty the bucket so that it only has room again after `seconds`."""
+        self._refill(now or time.monotonic())
+        self.level = -seconds * self.capacity / 60
+
+
+class RateLimitScheduler:
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrent,
+                 max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.completed = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failed = 0
+        self._queues = {}
+        self._order = deque()
+        self._cond = threading.Condition()
+
+    # ---------- fair queue ----------
+
+    def _head(self):
+        return self._queues[self._order[0]][0] if self._order else None
+
+    def _position(self, ticket):
+        """1-based place of ticket in round-robin service order."""
+        queues = [list(self._queues[u]) for u in self._order]
+        pos = 0
+        for depth in range(max((len(q) for q in queues), default=0)):
+            for q in queues:
+                if depth < len(q):
+                    pos += 1
+                    if q[depth] is ticket:
+                        return pos
+        return None
+
+    def _dequeue(self, ticket):
+        """Caller holds the lock. Drops a ticket that gave up waiting."""
+        queue = self._queues.get(ticket["user"])
+        for i, queued in enumerate(queue or ()):
+            if queued is ticket:
+                del queue[i]
+                if not queue:
+                    del self._queues[ticket["user"]]
+                    self._order.remove(ticket["user"])
+                return
+
+    def acquire(self, user, tokens, on_wait=None):
+        """
+        Blocks until it is this request's turn. on_wait(position) is called
+        without the lock held, and may raise (e.g. Streamlit stopping the run):
+        the ticket is then dropped so the callers behind it are not stuck.
+        """
+        ticket = {"user": user, "tokens": tokens}
+        with self._cond:
+            if user not in self._queues:
+                self._queues[user] = deque()
+                self._order.append(user)
+            self._queues[user].append(ticket)
+        granted = False
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    wait = None
+                    if self._head() is ticket and self.in_flight < self.max_concurrent:
+                        wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+                        if wait == 0:
+                            self._queues[user].popleft()
+                            self._order.popleft()
+                            if self._queues[user]:
+                                self._order.append(user)
+                            else:
+                                del self._queues[user]
+                            self.requests.take(1, now)
+                            self.tokens.take(tokens, now)
+                            self.in_flight += 1
+                            granted = True
+                            self._cond.notify_all()
+                            return ticket
+                    position = self._position(ticket)
+                if on_wait:
+                    on_wait(position)
+                with self._cond:
+                    self._cond.wait(timeout=min(wait, 5.0) if wait else 1.0)
+        finally:
+            if not granted:
+                with self._cond:
+                    self._dequeue(ticket)
+                    self._cond.notify_all()
+
+    def release(self, ticket, ok=True):
+        with self._cond:
+            self.in_flight -= 1
+            if ok:
+                self.completed += 1
+            self._cond.notify_all()
+
+    # ---------- rate-limit headers and retries ----------
+
+    def observe(self, headers):
+        if not headers:
+            return
+        with self._cond:
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "input-tokens")):
+                remaining = headers.get(f"anthropic-ratelimit-{kind}-remaining")
+                if remaining is not None:
+                    try:
+                        bucket.sync(float(remaining), headers.get(f"anthropic-ratelimit-{kind}-limit"))
+                    except ValueError:
+                        pass
+            self._cond.notify_all()
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        try:
+            delay = max(delay, float(headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+        if isinstance(error, anthropic.RateLimitError):
+            with self._cond:
+                self.throttled += 1
+                reset = (_seconds_until(headers.get("anthropic-ratelimit-requests-reset"))
+                         or _seconds_until(headers.get("anthropic-ratelimit-input-tokens-reset")) or delay)
+                # Everybody waits, not only the caller that got the 429
+                self.requests.drain(min(reset, self.max_delay))
+        return delay
+
+    def start(self, user, tokens, fn, on_wait=None):
+        """
+        Waits for a fair turn, then calls fn() retrying retryable API errors.
+        Returns (value, ticket, retries); the caller must release(ticket) once
+        it is done with the response (for streams, after the last event).
+        """
+        attempt = 0
+        while True:
+            ticket = self.acquire(user, tokens, on_wait)
+            try:
+                return fn(), ticket, attempt
+            except RETRYABLE as e:
+                self.release(ticket, ok=False)
+                if attempt >= self.max_retries:
+                    with self._cond:
+                        self.failed += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                attempt += 1
+                with self._cond:
+                    self.retries += 1
+                time.sleep(delay)
+            except BaseException:
+                self.release(ticket, ok=False)
+                with self._cond:
+                    self.failed += 1
+                raise
+
+    def snapshot(self):
+        with self._cond:
+            now = time.monotonic()
+            self.requests._refill(now)
+            self.tokens._refill(now)
+            return {
+                "queued": sum(len(q) for q in self._queues.values()),
+                "users_waiting": len(self._queues),
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "failed": self.failed,
+                "requests_available": max(0, int(self.requests.level)),
+                "tokens_available": max(0, int(self.tokens.level)),
+            }
+
+
+class ScheduledClient:
+    """
+    The subset of anthropic.Anthropic used by generation.py
+    (messages.with_raw_response.create and messages.stream), routed through a
+    RateLimitScheduler on behalf of `user`. SDK-level retries are disabled so
+    that every retry goes back through the fair queue.
+    """
+
+    def __init__(self, client, scheduler, user, on_wait=None):
+        self._client = client.with_options(max_retries=0)
+        self._scheduler = scheduler
+        self._user = user
+        self._on_wait = on_wait
+        self._owner = threading.current_thread()
+        self.retries = 0
+        self.messages = _ScheduledMessages(self)
+
+    def _wait_callback(self):
+        # UI callbacks only work on the thread that runs the Streamlit script
+        return self._on_wait if threading.current_thread() is self._owner else None
+
+    def _start(self, params, fn):
+        value, ticket, retries = self._scheduler.start(self._user, estimate_input_tokens(params), fn, self._wait_callback())
+        self.retries += retries
+        return value, ticket
+
+
+class _ScheduledRawMessages:
+
+    def __init__(self, owner):
+        self._owner = owner
+
+    def create(self, **params):
+        owner = self._owner
+        raw, ticket = owner._start(params, lambda: owner._client.messages.with_raw_response.create(**params))
+        owner._scheduler.release(ticket)
+        owner._scheduler.observe(raw.headers)
+        return raw
+
+
+class _ScheduledMessages:
+
+    def __init__(self, owner):
+        self._owner = owner
+        self.with_raw_response = _ScheduledRawMessages(owner)
+
+    def stream(self, **params):
+        return _ScheduledStream(self._owner, params)
+
+
+class _ScheduledStream:
+    """Holds its concurrency slot from the first byte until the stream is closed."""
+
+    def __init__(self, owner, params):
+        self._owner = owner
+        self._params = params
+        self._manager = None
+        self._ticket = None
+
+    def __enter__(self):
+        owner = self._owner
+
+        def open_stream():
+            manager = owner._client.messages.stream(**self._params)
+            return manager, manager.__enter__()
+
+        (self._manager, stream), self._ticket = owner._start(self._params, open_stream)
+        owner._scheduler.observe(stream.response.headers)
+        return stream
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            return self._manager.__exit__(exc_type, exc, tb)
+        finally:
+            self._owner._scheduler.release(self._ticket, ok=exc_type is None)
@@ -0,0 +1,261 @@
+"""
+Latency and token telemetry.
+
+Every generation, Figma export and Azure push appends one JSON record to an
+append-only JSONL file. The same records feed the in-app metrics panel
+(p50/p95 over time) and a Prometheus text exposition served on a small HTTP
+endpoint for scraping.
+
+The file is read incrementally (only the lines appended since the last read
+are parsed) and compacted once it grows past max_bytes: records older than
+the retention are dropped, and if that is not enough the older half is
+rotated to <path>.1. What the dropped records counted is first added to
+<path>.totals.json, so the Prometheus counters never go backwards.
+"""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Numeric fields summed into Prometheus counters, by record field name
+COUNTER_FIELDS = {
+    "input_tokens": "pbi_tokens_total{kind=\"input\"}",
+    "output_tokens": "pbi_tokens_total{kind=\"output\"}",
+    "cache_read_tokens": "pbi_tokens_total{kind=\"cache_read\"}",
+    "cache_creation_tokens": "pbi_tokens_total{kind=\"cache_creation\"}",
+    "images": "pbi_images_total",
+    "image_bytes": "pbi_image_bytes_total",
+    "retries": "pbi_retries_total",
+    "continuations": "pbi_continuations_total",
+    "retry_after_s": "pbi_azure_throttle_seconds_total{kind=\"retry_after\"}",
+    "delay_s": "pbi_azure_throttle_seconds_total{kind=\"server_delay\"}",
+}
+
+RETENTION_S = 30 * 24 * 3600
+MAX_BYTES = 20 * 1024 * 1024
+
+
+class TelemetryStore:
+    """Append-only JSONL store; safe to share between sessions and threads."""
+
+    def __init__(self, path, retention_s=RETENTION_S, max_bytes=MAX_BYTES):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.retention_s = retention_s
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.totals_path = path + ".totals.json"
+        # Records parsed so far, and where parsing stopped in which file
+        self._records = []
+        self._offset = 0
+        self._file_id = None
+        self._baseline = None
+
+    def append(self, record):
+        record = dict(record)
+        record.setdefault("ts", time.time())
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                size = f.tell()
+            if size > self.max_bytes:
+                self._compact()
+
+    def _refresh(self):
+        """Caller holds the lock. Parses the lines appended since the last call."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._records, self._offset, self._file_id = [], 0, None
+            return
+        file_id = (stat.st_dev, stat.st_ino)
+        if file_id != self._file_id or stat.st_size < self._offset:
+            # Compacted or replaced: start over
+            self._records, self._offset, self._file_id = [], 0, file_id
+        if stat.st_size == self._offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            chunk = f.read()
+        # A line still being written is picked up next time
+        end = chunk.rfind(b"\n") + 1
+        for line in chunk[:end].splitlines():
+            try:
+                self._records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        self._offset += end
+
+    def prometheus(self):
+        """prometheus_text of every record, counting those already compacted out of the file."""
+        with self._lock:
+            self._refresh()
+            records = list(self._records)
+            baseline = json.loads(json.dumps(self._load_baseline()))
+        return prometheus_text(records, baseline)
+
+    def _load_baseline(self):
+        """Caller holds the lock."""
+        if self._baseline is None:
+            self._baseline = new_totals()
+            if os.path.exists(self.totals_path):
+                with open(self.totals_path, encoding="utf-8") as f:
+                    self._baseline = json.load(f)
+        return self._baseline
+
+    def _compact(self):
+        """Caller holds the lock."""
+        self._refresh()
+        cutoff = time.time() - self.retention_s
+        kept = [r for r in self._records if r.get("ts", 0) >= cutoff]
+        dropped = [r for r in self._records if r.get("ts", 0) < cutoff]
+        lines = [json.dumps(r, ensure_ascii=False) + "\n" for r in kept]
+        if sum(len(line.encode("utf-8")) for line in lines) > self.max_bytes // 2:
+            half = len(lines) // 2
+            with open(self.path + ".1", "w", encoding="utf-8") as f:
+                f.writelines(lines[:half])
+            dropped += kept[:half]
+            lines = lines[half:]
+        baseline = aggregate(dropped, self._load_baseline())
+        tmp = self.totals_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(baseline, f)
+        os.replace(tmp, self.totals_path)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(tmp, self.path)
+        self._file_id = None
+
+    def read(self, since=None, op=None):
+        with self._lock:
+            self._refresh()
+            records = list(self._records)
+        return [r for r in records
+                if (since is None or r.get("ts", 0) >= since) and (op is None or r.get("op") == op)]
+
+    @contextmanager
+    def timed(self, op, **fields):
+        """
+        Records one `op` with its latency and success. The yielded dict can be
+        filled with extra fields (tokens, bytes...) inside the block.
+        """
+        record = dict(fields, op=op)
+        start = time.monotonic()
+        try:
+            yield record
+            record.setdefault("ok", True)
+        except BaseException as e:
+            record["ok"] = False
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["latency_s"] = round(time.monotonic() - start, 3)
+            self.append(record)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile, q in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def latency_series(records, bucket_s=3600):
+    """[(bucket_start, p50, p95, count)] of latency_s per time bucket."""
+    buckets = {}
+    for r in records:
+        if r.get("latency_s") is not None:
+            buckets.setdefault(int(r["ts"] // bucket_s * bucket_s), []).append(r["latency_s"])
+    return [(start, percentile(v, 50), percentile(v, 95), len(v)) for start, v in sorted(buckets.items())]
+
+
+def new_totals():
+    return {"ops": {}, "ttft_count": 0, "parse_fallbacks": 0, "counters": {field: 0 for field in COUNTER_FIELDS}}
+
+
+def aggregate(records, totals=None):
+    """Adds what records count (operations, latency sums, counter fields) to totals, in place."""
+    totals = totals if totals is not None else new_totals()
+    for r in records:
+        op = totals["ops"].setdefault(r.get("op", "unknown"),
+                                      {"ok": 0, "error": 0, "latency_sum": 0.0, "latency_count": 0})
+        op["ok" if r.get("ok", True) else "error"] += 1
+        if r.get("latency_s") is not None:
+            op["latency_sum"] += r["latency_s"]
+            op["latency_count"] += 1
+        totals["ttft_count"] += r.get("ttft_s") is not None
+        totals["parse_fallbacks"] += bool(r.get("parse_fallback"))
+        for field in COUNTER_FIELDS:
+            totals["counters"][field] = totals["counters"].get(field, 0) + (r.get(field) or 0)
+    return totals
+
+
+def prometheus_text(records, baseline=None):
+    """
+    Prometheus text exposition of the given records. Counters (and summary
+    _sum / _count) are added to baseline (updated in place), the totals of
+    records no longer in the file; quantiles only cover the records given.
+    """
+    totals = aggregate(records, baseline)
+    by_op = {}
+    for r in records:
+        by_op.setdefault(r.get("op", "unknown"), []).append(r)
+    lines = [
+        "# HELP pbi_operations_total Operations recorded, by op and outcome.",
+        "# TYPE pbi_operations_total counter",
+    ]
+    for op, counts in sorted(totals["ops"].items()):
+        lines.append(f'pbi_operations_total{{op="{op}",status="ok"}} {counts["ok"]}')
+        lines.append(f'pbi_operations_total{{op="{op}",status="error"}} {counts["error"]}')
+    lines += ["# HELP pbi_latency_seconds Operation latency.", "# TYPE pbi_latency_seconds summary"]
+    for op, counts in sorted(totals["ops"].items()):
+        values = [r["latency_s"] for r in by_op.get(op, []) if r.get("latency_s") is not None]
+        for q in (0.5, 0.95, 0.99):
+            lines.append(f'pbi_latency_seconds{{op="{op}",quantile="{q}"}} {percentile(values, q * 100) or 0}')
+        lines.append(f'pbi_latency_seconds_sum{{op="{op}"}} {round(counts["latency_sum"], 3)}')
+        lines.append(f'pbi_latency_seconds_count{{op="{op}"}} {counts["latency_count"]}')
+    ttft = [r["ttft_s"] for r in records if r.get("ttft_s") is not None]
+    lines += ["# HELP pbi_ttft_seconds Time to first token of generations.", "# TYPE pbi_ttft_seconds summary"]
+    for q in (0.5, 0.95):
+        lines.append(f'pbi_ttft_seconds{{quantile="{q}"}} {percentile(ttft, q * 100) or 0}')
+    lines.append(f"pbi_ttft_seconds_count {totals['ttft_count']}")
+    lines += ["# HELP pbi_parse_fallbacks_total Generations recovered by the tolerant parser.",
+              "# TYPE pbi_parse_fallbacks_total counter",
+              f"pbi_parse_fallbacks_total {totals['parse_fallbacks']}"]
+    declared = set()
+    for field, metric in COUNTER_FIELDS.items():
+        name = metric.split("{")[0]
+        if name not in declared:
+            declared.add(name)
+            lines += [f"# TYPE {name} counter"]
+        lines.append(f"{metric} {totals['counters'].get(field, 0)}")
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(store, port, host="0.0.0.0"):
+    """Serves GET /metrics in a daemon thread. Returns the server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = store.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server